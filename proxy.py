@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 
-# This program uses the hexdump module. Install it through pip (pip3 install
-# hexdump) or download it at https://pypi.python.org/pypi/hexdump
+# This program uses the hexdump module to print frames. Install it through pip
+# (pip3 install hexdump) or download it at https://pypi.python.org/pypi/hexdump
 #
 #  _   _  _____ _    _   _____
 # | \ | |/ ____| |  | | |  __ \
@@ -43,23 +43,548 @@
 #         +----------+-----------+ Network
 #
 
-import hexdump
 import socket
 import argparse
 import sys
 import struct
 import collections
 import threading
+import bisect
+import time
+import queue
+import itertools
+import zlib
+import mmap
+import os
+import json
+import signal
+import socketserver
+import gc
+import array
+import fcntl
+
+# Imported on first use, by load_numpy
+numpy = None
+numpy_loaded = False
+
+# ************************************************
+#  Sharded store for sessions and MACs
+# ************************************************
+
+"""
+The three loops share the session and MAC tables. Each table is split in
+shards, each one with its own lock, so threads only contend when they touch
+the same shard and compound operations (get-or-insert, touch, expiry) stay
+atomic without relying on the GIL.
+"""
+
+STORE_DEFAULT_SHARDS = 64
+
+def stable_hash(key):
+    # Unlike hash(), does not depend on PYTHONHASHSEED
+    if isinstance(key, bytes):
+        return zlib.crc32(key)
+    h = 0
+    for item in key:
+        if isinstance(item, int):
+            item = item.to_bytes(8, byteorder='big', signed=True)
+        elif not isinstance(item, bytes):
+            item = repr(item).encode()
+        h = zlib.crc32(item, h)
+    return h
+
+
+class StoreShard(object):
+
+    def __init__(self, ordered=True):
+        self.lock = threading.Lock()
+        # key -> [value, last_seen], oldest touched first
+        self.entries = collections.OrderedDict() if ordered else {}
+
+
+class ShardedStore(object):
+    """Dictionary-like table striped in shards with a lock each"""
+
+    def __init__(self, num_shards=STORE_DEFAULT_SHARDS):
+        self.shards = [StoreShard() for i in range(num_shards)]
+
+    def shard(self, key):
+        return self.shards[stable_hash(key) % len(self.shards)]
+
+    def get(self, key, default=None, touch=False):
+        shard = self.shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                return default
+            if touch:
+                entry[1] = time.monotonic()
+                shard.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        shard = self.shard(key)
+        with shard.lock:
+            shard.entries[key] = [value, time.monotonic()]
+            shard.entries.move_to_end(key)
+
+    def get_or_insert(self, key, value):
+        """Returns (value stored, True if it was inserted now). The value
+        is built even if the key is there: on hot paths, get() first"""
+        shard = self.shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None:
+                return entry[0], False
+            shard.entries[key] = [value, time.monotonic()]
+            return value, True
+
+    def touch(self, key):
+        shard = self.shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                return False
+            entry[1] = time.monotonic()
+            shard.entries.move_to_end(key)
+            return True
+
+    def evict(self, key):
+        """Removes the key, returns its value or None"""
+        shard = self.shard(key)
+        with shard.lock:
+            entry = shard.entries.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def evict_expired(self, max_age, on_evict=None):
+        """Removes the entries not touched for max_age seconds.
+        on_evict(key, value) is called for each one"""
+        evicted = 0
+        limit = time.monotonic() - max_age
+        for shard in self.shards:
+            with shard.lock:
+                entries = shard.entries
+                while entries:
+                    key = next(iter(entries))
+                    if entries[key][1] >= limit:
+                        break
+                    entry = entries.pop(key)
+                    if on_evict is not None:
+                        on_evict(key, entry[0])
+                    evicted += 1
+        return evicted
+
+    def evict_lru(self, count, on_evict=None):
+        """Removes about count least recently touched entries, evenly
+        from every shard"""
+        evicted = 0
+        per_shard = -(-count // len(self.shards))
+        for shard in self.shards:
+            with shard.lock:
+                for i in range(min(per_shard, len(shard.entries))):
+                    (key, entry) = shard.entries.popitem(last=False)
+                    if on_evict is not None:
+                        on_evict(key, entry[0])
+                    evicted += 1
+        return evicted
+
+    def clear(self):
+        for shard in self.shards:
+            with shard.lock:
+                shard.entries.clear()
+
+    def items(self):
+        """Snapshot of the (key, value) pairs, one shard locked at a time"""
+        result = []
+        for shard in self.shards:
+            with shard.lock:
+                result.extend((k, e[0]) for k, e in shard.entries.items())
+        return result
+
+    def __contains__(self, key):
+        shard = self.shard(key)
+        with shard.lock:
+            return key in shard.entries
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
+
+
+# ************************************************
+#  Session slab
+# ************************************************
+
+"""
+A session keeps the headers that wrapped the inner frame in the
+encapsulated side and, already built, the headers to prepend on the way
+back (swapped Ethernet/IP, NSH with the SI decremented). Instead of one
+Python object per header, each session is a fixed-size record in a slab of
+anonymous mmap chunks, and the index only maps the flow key to the record
+number. Record layout:
+
+  meta      created, last_seen, pkts/bytes to SF, pkts/bytes from SF,
+            length of each of the 6 headers, length of the template
+  headers   outer Ethernet | IP | UDP | VxLAN | Ethernet NSH | NSH
+  template  headers to prepend to the frames coming back from the SF
+
+Sessions whose headers do not fit the record (IP options, long NSH) are
+kept as (headers, template, last_seen) tuples in the index.
+"""
+
+SLAB_META_FMT = '!ddQQQQ6BH'
+SLAB_META_SIZE = struct.calcsize(SLAB_META_FMT)
+SLAB_HEADERS_SIZE = 100
+SLAB_RECORD_SIZE = SLAB_META_SIZE + 2 * SLAB_HEADERS_SIZE
+SLAB_RECORDS_PER_CHUNK = 4096
+SLAB_DEFAULT_MAX_RECORDS = 1 << 20
+
+
+class SessionSlab(object):
+    """Fixed-size records allocated in chunks, on demand, up to max_records"""
+
+    def __init__(self, record_size=SLAB_RECORD_SIZE,
+            records_per_chunk=SLAB_RECORDS_PER_CHUNK,
+            max_records=SLAB_DEFAULT_MAX_RECORDS):
+        self.record_size = record_size
+        self.records_per_chunk = records_per_chunk
+        self.max_records = max_records
+        self.chunks = []
+        self.free_slots = []
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def alloc(self):
+        """Returns a free record number, None if the slab is full"""
+        with self.lock:
+            if self.free_slots:
+                return self.free_slots.pop()
+            if self.next_slot >= self.max_records:
+                return None
+            if self.next_slot >= len(self.chunks) * self.records_per_chunk:
+                self.chunks.append(mmap.mmap(-1,
+                    self.record_size * self.records_per_chunk))
+            slot = self.next_slot
+            self.next_slot += 1
+            return slot
+
+    def free(self, slot):
+        with self.lock:
+            self.free_slots.append(slot)
+
+    def record(self, slot):
+        """Returns (buffer, offset) of the record"""
+        (chunk, index) = divmod(slot, self.records_per_chunk)
+        return self.chunks[chunk], index * self.record_size
+
+    def used(self):
+        return self.next_slot - len(self.free_slots)
+
+
+def make_session_key(eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port, tcp_src_port):
+    # 28 bytes instead of a 7-tuple of objects
+    return struct.pack('!6s6sH4s4sHH', eth_dst, eth_src, eth_type,
+        ip_dst, ip_src, tcp_dst_port, tcp_src_port)
+
+
+def make_session_template(outer_eth_header, ip_header, udp_header,
+        vxlan_header, eth_nsh_header, nsh_header):
+    # Headers of the frames going back to the SFF
+    return (make_ethernet_header_swap(outer_eth_header)
+        + make_ip_header_swap(ip_header)
+        + udp_header
+        + vxlan_header
+        + make_ethernet_header_swap(eth_nsh_header)
+        + make_nsh_decr_si(nsh_header))
+
+
+def make_encapsulated_frame(session_template, frame):
+    """Session template + frame, with the outer IP total length, its
+    checksum and the UDP length of this frame: the template keeps the ones
+    of the first frame, and frames change length (SFs adding bytes)"""
+    new_pkt = bytearray(session_template)
+    new_pkt += frame
+    ihl = (new_pkt[14] & 0x0F) * 4
+    ip_total_length = len(new_pkt) - 14
+    (old_ip_total_length, ) = struct.unpack_from('!H', new_pkt, 16)
+    if old_ip_total_length != ip_total_length:
+        (ip_checksum, ) = struct.unpack_from('!H', new_pkt, 24)
+        struct.pack_into('!H', new_pkt, 16, ip_total_length)
+        struct.pack_into('!H', new_pkt, 24,
+            update_checksum_16(ip_checksum, old_ip_total_length, ip_total_length))
+    # UDP checksum 0: not computed, the one of the SFF covers other bytes
+    struct.pack_into('!HH', new_pkt, 14 + ihl + 4, ip_total_length - ihl, 0)
+    return new_pkt
+
+
+class SessionTable(object):
+    """Flow key -> session record. The index is striped like a
+    ShardedStore but maps straight to the record number, last_seen is
+    kept in the record itself. on_evict(keys) is called, without locks
+    held, with the keys of the sessions evicted (not on clear())"""
+
+    def __init__(self, max_sessions=SLAB_DEFAULT_MAX_RECORDS,
+            num_shards=STORE_DEFAULT_SHARDS, on_evict=None):
+        self.shards = [StoreShard(ordered=False) for i in range(num_shards)]
+        self.slab = SessionSlab(max_records=max_sessions)
+        # Guards next_shard_to_evict and dropped, shared by every thread
+        self.lock = threading.Lock()
+        self.next_shard_to_evict = 0
+        self.on_evict = on_evict
+        # Sessions not stored because every record was in use
+        self.dropped = 0
+
+    def shard(self, key):
+        return self.shards[stable_hash(key) % len(self.shards)]
+
+    def _free(self, slot):
+        if not isinstance(slot, tuple):
+            self.slab.free(slot)
+
+    def _last_seen(self, slot):
+        if isinstance(slot, tuple):
+            return slot[2]
+        (buf, offset) = self.slab.record(slot)
+        return struct.unpack_from('!d', buf, offset + 8)[0]
+
+    def _evict_shard(self, shard, limit):
+        # Called with the shard locked, returns the keys evicted
+        evicted = []
+        for (key, slot) in list(shard.entries.items()):
+            if self._last_seen(slot) < limit:
+                del shard.entries[key]
+                self._free(slot)
+                evicted.append(key)
+        return evicted
+
+    def _evicted(self, keys):
+        if keys and self.on_evict is not None:
+            self.on_evict(keys)
+
+    def _alloc(self):
+        slot = self.slab.alloc()
+        # Full: make room shard after shard, dropping the sessions idle for
+        # more than half of the age range of the shard, until a record is
+        # free. Only records held by puts in flight can make it fail
+        for i in range(len(self.shards)):
+            if slot is not None:
+                break
+            with self.lock:
+                shard = self.shards[self.next_shard_to_evict]
+                self.next_shard_to_evict = (self.next_shard_to_evict + 1) % len(self.shards)
+            evicted = []
+            with shard.lock:
+                if shard.entries:
+                    seen = [self._last_seen(slot) for slot in shard.entries.values()]
+                    evicted = self._evict_shard(shard, (min(seen) + max(seen)) / 2 + 1e-6)
+            self._evicted(evicted)
+            slot = self.slab.alloc()
+        return slot
+
+    def put(self, key, headers, frame_length=0):
+        """Stores the 6 headers of the session and builds its template.
+        Counts a packet going to the SF. Returns False if there was no
+        room for it"""
+        raw = b''.join(headers)
+        now = time.time()
+        shard = self.shard(key)
+
+        if len(raw) > SLAB_HEADERS_SIZE:
+            with shard.lock:
+                old_slot = shard.entries.get(key)
+                shard.entries[key] = (headers, make_session_template(*headers), now)
+            if old_slot is not None:
+                self._free(old_slot)
+            return True
+
+        # Records are only read and written with the shard locked: once
+        # unlocked, an eviction can give the record to another flow
+        new_slot = None
+        while True:
+            with shard.lock:
+                slot = shard.entries.get(key)
+                if (slot is None or isinstance(slot, tuple)) and new_slot is not None:
+                    shard.entries[key] = new_slot
+                    (slot, new_slot) = (new_slot, None)
+                if slot is not None and not isinstance(slot, tuple):
+                    self._update_record(slot, headers, raw, now, frame_length)
+                    break
+            # Allocated unlocked, making room locks other shards
+            new_slot = self._alloc()
+            if new_slot is None:
+                with self.lock:
+                    self.dropped += 1
+                return False
+            (buf, offset) = self.slab.record(new_slot)
+            struct.pack_into(SLAB_META_FMT, buf, offset, now, now,
+                0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        if new_slot is not None:
+            # Another thread created the session meanwhile
+            self.slab.free(new_slot)
+        return True
+
+    def _update_record(self, slot, headers, raw, now, frame_length):
+        # Called with the shard locked
+        (buf, offset) = self.slab.record(slot)
+        meta = struct.unpack_from(SLAB_META_FMT, buf, offset)
+        lengths = tuple(len(h) for h in headers)
+        headers_offset = offset + SLAB_META_SIZE
+        template_length = meta[12]
+        # Most packets of a flow come with the same headers
+        if (meta[6:12] != lengths or
+                buf[headers_offset:headers_offset + len(raw)] != raw):
+            template = make_session_template(*headers)
+            buf[headers_offset:headers_offset + len(raw)] = raw
+            template_offset = headers_offset + SLAB_HEADERS_SIZE
+            buf[template_offset:template_offset + len(template)] = template
+            template_length = len(template)
+        struct.pack_into(SLAB_META_FMT, buf, offset, meta[0], now,
+            meta[2] + 1, meta[3] + frame_length, meta[4], meta[5],
+            *lengths, template_length)
+
+    def _get_slot(self, key):
+        shard = self.shard(key)
+        with shard.lock:
+            return shard.entries.get(key)
+
+    def get_template(self, key, frame_length=0):
+        """Returns the headers to prepend to a frame coming back from the
+        SF, None if there is no session. Counts a packet from the SF"""
+        shard = self.shard(key)
+        with shard.lock:
+            slot = shard.entries.get(key)
+            if slot is None:
+                return None
+            if isinstance(slot, tuple):
+                return slot[1]
+            (buf, offset) = self.slab.record(slot)
+            meta = struct.unpack_from(SLAB_META_FMT, buf, offset)
+            struct.pack_into('!d', buf, offset + 8, time.time())
+            struct.pack_into('!QQ', buf, offset + 32, meta[4] + 1, meta[5] + frame_length)
+            template_offset = offset + SLAB_META_SIZE + SLAB_HEADERS_SIZE
+            return bytes(buf[template_offset:template_offset + meta[12]])
+
+    def get(self, key):
+        """Returns the 6 headers of the session, None if there is none"""
+        shard = self.shard(key)
+        with shard.lock:
+            slot = shard.entries.get(key)
+            if slot is None:
+                return None
+            if isinstance(slot, tuple):
+                return slot[0]
+            (buf, offset) = self.slab.record(slot)
+            meta = struct.unpack_from(SLAB_META_FMT, buf, offset)
+            headers = []
+            position = offset + SLAB_META_SIZE
+            for length in meta[6:12]:
+                headers.append(bytes(buf[position:position + length]))
+                position += length
+            return tuple(headers)
+
+    def get_stats(self, key):
+        """Returns (created, last_seen, pkts_to_sf, bytes_to_sf,
+        pkts_from_sf, bytes_from_sf), None if there is no record"""
+        shard = self.shard(key)
+        with shard.lock:
+            slot = shard.entries.get(key)
+            if slot is None or isinstance(slot, tuple):
+                return None
+            (buf, offset) = self.slab.record(slot)
+            return struct.unpack_from(SLAB_META_FMT, buf, offset)[:6]
+
+    def evict(self, key):
+        shard = self.shard(key)
+        with shard.lock:
+            slot = shard.entries.pop(key, None)
+        if slot is None:
+            return False
+        self._free(slot)
+        self._evicted([key])
+        return True
+
+    def evict_expired(self, max_age):
+        evicted = 0
+        limit = time.time() - max_age
+        for shard in self.shards:
+            with shard.lock:
+                keys = self._evict_shard(shard, limit)
+            self._evicted(keys)
+            evicted += len(keys)
+        return evicted
+
+    def clear(self):
+        for shard in self.shards:
+            with shard.lock:
+                for slot in shard.entries.values():
+                    self._free(slot)
+                shard.entries.clear()
+
+    def scan(self, cursor=(0, 0), limit=100, match=None):
+        """Returns up to limit (key, headers, stats) with match(key, headers)
+        true, and the cursor to continue from (None at the end). Only the
+        keys of one shard are copied at a time"""
+        (shard_index, position) = cursor
+        result = []
+        while shard_index < len(self.shards):
+            shard = self.shards[shard_index]
+            with shard.lock:
+                keys = list(itertools.islice(shard.entries.keys(), position, None))
+            for key in keys:
+                if len(result) >= limit:
+                    return result, (shard_index, position)
+                position += 1
+                headers = self.get(key)
+                if headers is None:
+                    continue
+                if match is None or match(key, headers):
+                    result.append((key, headers, self.get_stats(key)))
+            shard_index += 1
+            position = 0
+        return result, None
+
+    def evict_matching(self, match):
+        evicted = 0
+        for shard in self.shards:
+            with shard.lock:
+                keys = list(shard.entries.keys())
+            for key in keys:
+                headers = self.get(key)
+                if headers is not None and match(key, headers) and self.evict(key):
+                    evicted += 1
+        return evicted
+
+    def keys(self):
+        result = []
+        for shard in self.shards:
+            with shard.lock:
+                result.extend(shard.entries.keys())
+        return result
+
+    def __contains__(self, key):
+        return self._get_slot(key) is not None
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
 
-from uuid import getnode as get_mac
 
 # ************************************************
 #  Global definition of data structures and sockets
 # ************************************************
 
-sessions = {}
+def forget_sessions(keys):
+    """Drops the state kept for the connections of evicted sessions"""
+    for key in keys:
+        latency_windows.evict(key)
+        # Session key: eth_dst, eth_src, eth_type, ip_dst, ip_src, ports
+        (tcp_dst_port, tcp_src_port) = struct.unpack_from('!HH', key, 22)
+        conn_key = make_tcp_connection_key(key[18:22], tcp_src_port, key[14:18], tcp_dst_port)
+        tcp_offsets.evict(conn_key)
+        flow_replicas.evict(conn_key)
+
+
+sessions = SessionTable(on_evict=forget_sessions)
 sessions_reply_info= {}
-mac_database = {}
+mac_database = ShardedStore()
 
 sckt_encap = None
 sckt_unencap_in = None
@@ -69,6 +594,41 @@ encap_if = None
 unencap_in_if = None
 unencap_out_if = None
 
+# Rewrite TCP seq/ack numbers for SFs that add bytes to the stream
+track_tcp_offsets = False
+tcp_offsets = ShardedStore()
+
+# Seconds without traffic before a session is removed, 0 keeps them forever
+session_timeout = 0
+
+# Frames back from the SF without a session (expired, evicted or flushed
+# while the frame was in the SF), dropped
+unmatched_frames = 0
+
+# Frames of a capture the packet functions could not parse (not TCP,
+# truncated), dropped
+malformed_frames = 0
+
+# SF latency: session key -> segments sent to the SF, histograms
+measure_sf_latency = False
+latency_windows = ShardedStore()
+spi_latency = {}
+replica_latency = {}
+
+# Pool of SF replicas (replica_ring, defined with ReplicaRing),
+# connection key -> FlowReplica, replica MAC -> replica
+flow_replicas = ShardedStore()
+replica_macs = {}
+
+# pf() prints messages up to this level
+LOG_NONE = 0
+LOG_INFO = 1
+LOG_DEBUG = 2
+log_level = LOG_DEBUG
+
+# Frames taken from a socket on each wake up of a loop
+batch_size = 1
+
 
 # ************************************************
 #  Util functions
@@ -89,10 +649,81 @@ def pack_namedtuple(struct_fmt, nt):
         arg_values.append( getattr(nt, x) )
     return struct.pack( *arg_values )
 
-def pf(str):
+def pf(str, level=LOG_DEBUG):
+    if level > log_level:
+        return
     print(str)
     sys.stdout.flush()
 
+# ************************************************
+#  Pcap files
+# ************************************************
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_LINKTYPE_ETHERNET = 1
+
+class PcapWriter(object):
+    """Writes Ethernet frames in the classic libpcap format"""
+
+    def __init__(self, filename, snaplen=65535):
+        self.f = open(filename, 'wb')
+        self.snaplen = snaplen
+        self.f.write(struct.pack('=LHHlLLL', PCAP_MAGIC, 2, 4, 0, 0,
+            snaplen, PCAP_LINKTYPE_ETHERNET))
+
+    def write(self, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        ts_sec = int(timestamp)
+        # Rounded, so that timestamps read from a pcap file are written back as they were
+        ts_usec = int(round((timestamp - ts_sec) * 1000000))
+        if ts_usec == 1000000:
+            (ts_sec, ts_usec) = (ts_sec + 1, 0)
+        data = frame[:self.snaplen]
+        self.f.write(struct.pack('=LLLL', ts_sec, ts_usec, len(data), len(frame)))
+        self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+
+class PcapReader(object):
+    """Iterates over the (timestamp, frame) of a libpcap file, one record
+    at a time, whatever the byte order and timestamp resolution"""
+
+    def __init__(self, filename):
+        self.f = open(filename, 'rb')
+        header = self.f.read(24)
+        if len(header) < 24:
+            raise ValueError(filename + ': not a pcap file')
+        for byte_order in ('<', '>'):
+            magic = struct.unpack(byte_order + 'L', header[:4])[0]
+            if magic in (PCAP_MAGIC, PCAP_MAGIC_NSEC):
+                break
+        else:
+            raise ValueError(filename + ': not a pcap file')
+        self.record_fmt = byte_order + 'LLLL'
+        self.ts_divisor = 1000000000.0 if magic == PCAP_MAGIC_NSEC else 1000000.0
+        linktype = struct.unpack(byte_order + 'L', header[20:24])[0]
+        if linktype != PCAP_LINKTYPE_ETHERNET:
+            raise ValueError(filename + ': link type ' + str(linktype) + ' is not Ethernet')
+
+    def __iter__(self):
+        while True:
+            record = self.f.read(16)
+            if len(record) < 16:
+                return
+            (ts_sec, ts_frac, incl_len, orig_len) = struct.unpack(self.record_fmt, record)
+            frame = self.f.read(incl_len)
+            if len(frame) < incl_len:
+                # Truncated capture
+                return
+            yield ts_sec + ts_frac / self.ts_divisor, frame
+
+    def close(self):
+        self.f.close()
+
 # ************************************************
 #  Class definitions for network headers
 # ************************************************
@@ -124,9 +755,10 @@ class StructEthHeader(object, metaclass=MetaStruct):
             + ', eth_type=' + str(getattr(self, 'eth_type')) + ")")
 
 
-class StructNshHeader(object, metaclass=MetaStruct):
-    fields = 'nsh_flags_length nsh_md_type nsh_np nsh_sph nsh_ctx1 nsh_ctx2 nsh_ctx3 nsh_ctx4'
-    struct_fmt = '!HBBLLLLL'
+class StructNshBaseHeader(object, metaclass=MetaStruct):
+    """Base header and Service Path header, common to all MD-types"""
+    fields = 'nsh_flags_length nsh_md_type nsh_np nsh_sph'
+    struct_fmt = '!HBBL'
 
     def pack(self):
         return pack_namedtuple(self.struct_fmt, self)
@@ -137,6 +769,10 @@ class StructNshHeader(object, metaclass=MetaStruct):
             + ", nsh_si=" + str(self.get_nsh_si()))
         return str1 + str2
 
+    def get_nsh_length(self):
+        # In 4-byte words
+        return getattr(self, 'nsh_flags_length') & 0x003F
+
     def get_nsh_spi(self):
         return ((getattr(self, 'nsh_sph') & 0xFFFFFF00) >> 8)
 
@@ -153,6 +789,23 @@ class StructNshHeader(object, metaclass=MetaStruct):
         return (new_nsh_spi << 8) + new_nsh_si
 
 
+class StructNshHeader(object, metaclass=MetaStruct):
+    """MD-type 1, four fixed context headers"""
+    fields = 'nsh_flags_length nsh_md_type nsh_np nsh_sph nsh_ctx1 nsh_ctx2 nsh_ctx3 nsh_ctx4'
+    struct_fmt = '!HBBLLLLL'
+
+    def pack(self):
+        return pack_namedtuple(self.struct_fmt, self)
+
+    __str__ = StructNshBaseHeader.__str__
+    get_nsh_length = StructNshBaseHeader.get_nsh_length
+    get_nsh_spi = StructNshBaseHeader.get_nsh_spi
+    get_nsh_si = StructNshBaseHeader.get_nsh_si
+    make_nsh_sph_with_spi = StructNshBaseHeader.make_nsh_sph_with_spi
+    make_nsh_sph_with_si = StructNshBaseHeader.make_nsh_sph_with_si
+    make_nsh_sph_with_spi_si = StructNshBaseHeader.make_nsh_sph_with_spi_si
+
+
 class StructUdpHeader(object, metaclass=MetaStruct):
 
     fields = 'udp_src_port udp_dst_port udp_data_length udp_checksum'
@@ -234,6 +887,8 @@ class StructVxLanGPEHeader(object, metaclass=MetaStruct):
 
 
 def print_frame(source, frame):
+    # Only needed for debugging, not to be loaded by every start
+    import hexdump
     print("Full frame: {}".format(source))
     hexdump.hexdump(frame)
 
@@ -245,7 +900,7 @@ def print_msg_hdr(outer_eth_header,
     if outer_eth_header != None:
         pf(str(StructEthHeader(outer_eth_header)))
     if nsh_header != None:
-        pf(str(StructNshHeader(nsh_header)))
+        pf(str(StructNshBaseHeader(nsh_header[:NSH_BASE_LENGTH])))
     if eth_nsh_header != None:
         pf(str(StructEthHeader(eth_nsh_header)))
     if ip_header != None:
@@ -298,16 +953,45 @@ def make_ethernet_header_swap(header):
         eth_src=getattr(outer_eth_header_nt, 'eth_dst'))
     return nt.pack()
 
+# EtherType: "Network Service Header" 0x894F
+ETH_TYPE_NSH = 0x894F
+ETH_TYPE_NSH_BYTES = struct.pack('!H', ETH_TYPE_NSH)
+SIOCGIFHWADDR = 0x8927
+
+interface_macs = {}
+# Interface whose MAC is the source of the NSH Ethernet headers built
+# here: the encapsulated interface of the proxy, the interface of the
+# traffic generator. The proxy path itself reuses the received headers
+local_mac_if = None
+
+
+def get_interface_mac(ifname):
+    """MAC of a local interface, read once from the kernel"""
+    mac = interface_macs.get(ifname)
+    if mac is None:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sckt:
+            ifreq = fcntl.ioctl(sckt.fileno(), SIOCGIFHWADDR,
+                struct.pack('256s', ifname.encode()[:15]))
+        # struct ifreq: 16 bytes of name, then a sockaddr (family, MAC)
+        mac = interface_macs.setdefault(ifname, ifreq[18:24])
+    return mac
+
+
+def get_local_mac():
+    """MAC of local_mac_if. Without one (in-memory and pcap modes), the one
+    of uuid.getnode(), which can be a random one"""
+    if local_mac_if is not None:
+        return get_interface_mac(local_mac_if)
+    mac = interface_macs.get(None)
+    if mac is None:
+        from uuid import getnode as get_mac
+        mac = interface_macs.setdefault(None, get_mac().to_bytes(6, byteorder='big'))
+    return mac
+
+
 def make_outer_ethernet_nsh_header(inner_eth_header):
-    outer_eth_nsh_header_nt = StructEthHeader(inner_eth_header)
-
-    mac_src=struct.pack("!6s", bytes.fromhex((hex(get_mac())[2:])))
-    # EtherType: "Network Service Header" 0x894F
-    nt = outer_eth_nsh_header_nt._replace(
-        eth_dst=getattr(outer_eth_nsh_header_nt, 'eth_dst'),
-        eth_src=mac_src,
-        eth_type=0x894F)
-    return nt.pack()
+    # Same destination as the inner frame
+    return inner_eth_header[:6] + get_local_mac() + ETH_TYPE_NSH_BYTES
 
 #####################################################################
 """
@@ -327,39 +1011,140 @@ NSH MD-type 1 -> four Context Headers 4-byte each
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
     |                Mandatory Context Header                       |
     +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+NSH MD-type 2 -> zero or more variable length Context Headers (TLVs)
+     0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |          Metadata Class       |      Type     |U|    Length   |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+    |                   Variable-Length Metadata                    |
+    +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+The whole header length is in the Length field, in 4-byte words, whatever
+the MD-type. The proxy does not look into the metadata: the header is
+kept as received and only its Service Index is changed on the way back,
+TLVs are decoded only when asked for (get_nsh_metadata).
+
+The length and MD-type are in the 2nd and 3rd bytes, so the layout of a
+header is cached by them: a frame costs one dictionary lookup instead of
+unpacking and checking the base header. MD-type 1, nearly all the traffic,
+is matched on those bytes before the lookup.
 """
+
+NSH_BASE_LENGTH = 8
+NSH_MD_TYPE_1 = 0x1
+NSH_MD_TYPE_2 = 0x2
+NSH_MD_TYPE_1_LENGTH = 24
+NSH_TLV_HEADER_FMT = '!HBB'
+NSH_TLV_HEADER_LENGTH = 4
+NSH_SPH_STRUCT = struct.Struct('!L')
+
+
+class NshLayout(object):
+    """Length and MD-type of the NSH headers starting with the same bytes,
+    length is None for invalid headers"""
+
+    def __init__(self, length_md_type):
+        if len(length_md_type) < 2:
+            # Truncated before the MD-type
+            self.length = None
+            self.md_type = None
+            return
+        self.length = (length_md_type[0] & 0x3F) * 4
+        self.md_type = length_md_type[1] & 0x0F
+        if self.length < NSH_BASE_LENGTH or (self.md_type == NSH_MD_TYPE_1
+                and self.length != NSH_MD_TYPE_1_LENGTH):
+            self.length = None
+
+
+nsh_layouts = {}
+
+
+def get_nsh_layout(nsh_header):
+    length_md_type = nsh_header[1:3]
+    layout = nsh_layouts.get(length_md_type)
+    if layout is None:
+        # At most 2^16 keys, in practice a handful
+        layout = NshLayout(length_md_type)
+        nsh_layouts[bytes(length_md_type)] = layout
+    return layout
+
+
 def parse_nsh(packet):
-    header_length = 8
-    context_length = 16
-    header = packet[:header_length + context_length]
-    payload = packet[header_length + context_length:]
+    """Returns (None, packet) if the header length is not valid"""
+    # 6 words long (MD-type 1, nearly all the traffic, or 2) is valid
+    # whatever the MD-type: checked inline, a call or a global lookup
+    # would be half of the time
+    if len(packet) >= 24 and packet[1] == 6:
+        return packet[:24], packet[24:]
+    layout = nsh_layouts.get(packet[1:3])
+    if layout is None:
+        layout = get_nsh_layout(packet)
+    header_length = layout.length
+    if header_length is None or header_length > len(packet):
+        return None, packet
+    header = packet[:header_length]
+    payload = packet[header_length:]
     return header, payload
 
+
+def get_nsh_metadata(nsh_header):
+    """Context headers of MD-type 1, list of (md_class, type, value) of
+    MD-type 2, None for other MD-types"""
+    layout = get_nsh_layout(nsh_header)
+    if layout.length is None:
+        return None
+    if layout.md_type == NSH_MD_TYPE_1:
+        return list(struct.unpack_from('!LLLL', nsh_header, NSH_BASE_LENGTH))
+    if layout.md_type != NSH_MD_TYPE_2:
+        return None
+    tlvs = []
+    offset = NSH_BASE_LENGTH
+    while offset + NSH_TLV_HEADER_LENGTH <= layout.length:
+        (md_class, md_type, length) = struct.unpack_from(NSH_TLV_HEADER_FMT, nsh_header, offset)
+        offset += NSH_TLV_HEADER_LENGTH
+        length &= 0x7F
+        tlvs.append((md_class, md_type, bytes(nsh_header[offset:offset + length])))
+        # Values are padded to 4 bytes
+        offset += (length + 3) & ~3
+    return tlvs
+
+
 def make_nsh_decr_si(nsh_header):
-    nt = StructNshHeader(nsh_header)
-    # Decrement NSH Service Index
+    nt = StructNshBaseHeader(nsh_header[:NSH_BASE_LENGTH])
+    # Decrement NSH Service Index, the context headers are kept byte for byte
     nt = nt._replace( nsh_sph=nt.make_nsh_sph_with_si(nt.get_nsh_si() - 1) )
-    return nt.pack()
+    return nt.pack() + nsh_header[NSH_BASE_LENGTH:]
+
+# NSH MD-type 1 -> 8 bytes Base Header + four Context Headers 4-byte each
+# Version MUST be set to 0x0 by the sender, in this first revision of NSH.
+# For an MD Type of 0x1 (i.e. no variable length metadata is present),
+#  the C bit MUST be set to 0x0.
+# The Length MUST be of value 0x6 for MD Type equal to 0x1
+# Only the Service Path header changes from a header to another
+NSH_MD_TYPE_1_BASE = struct.pack('!HBB',
+    0x6,
+    NSH_MD_TYPE_1, # MD Type = 0x1, four Context Headers
+    0x3) # Ethernet
+NSH_MD_TYPE_1_CONTEXT = bytes(16)
 
 def make_nsh_mdtype1(nsh_spi, nsh_si):
-    # NSH MD-type 1 -> 8 bytes Base Header + four Context Headers 4-byte each
-    nsh_header = bytes(8 + 16)
-    # Version MUST be set to 0x0 by the sender, in this first revision of NSH.
-    # For an MD Type of 0x1 (i.e. no variable length metadata is present),
-    #  the C bit MUST be set to 0x0.
-    # The Length MUST be of value 0x6 for MD Type equal to 0x1
-    nt = StructNshHeader(nsh_header)
+    return (NSH_MD_TYPE_1_BASE + NSH_SPH_STRUCT.pack((nsh_spi << 8) + nsh_si)
+        + NSH_MD_TYPE_1_CONTEXT)
+
+def make_nsh_mdtype2(nsh_spi, nsh_si, tlvs):
+    # NSH MD-type 2 -> 8 bytes Base Header + (md_class, type, value) TLVs
+    context = b''
+    for (md_class, md_type, value) in tlvs:
+        context += struct.pack(NSH_TLV_HEADER_FMT, md_class, md_type, len(value))
+        context += value + bytes(-len(value) % 4)
+    nt = StructNshBaseHeader(bytes(NSH_BASE_LENGTH))
     nt = nt._replace(
-        nsh_flags_length=0x6,
-        nsh_md_type= 0x1, # MD Type = 0x1, four Context Headers
+        nsh_flags_length=(NSH_BASE_LENGTH + len(context)) // 4,
+        nsh_md_type=NSH_MD_TYPE_2,
         nsh_np=0x3, # Ethernet
-        nsh_sph=nt.make_nsh_sph_with_spi_si(nsh_spi, nsh_si),
-        nsh_ctx1=0,
-        nsh_ctx2=0,
-        nsh_ctx3=0,
-        nsh_ctx4=0
-        )
-    return nt.pack()
+        nsh_sph=nt.make_nsh_sph_with_spi_si(nsh_spi, nsh_si))
+    return nt.pack() + context
 
 #####################################################################
 
@@ -396,12 +1181,12 @@ def make_ip_header(header, new_ip_total_length):
     return nt.pack()
 
 def make_ip_header_swap(header):
-    ip_header_nt = StructIpHeader(header)
-    # Swap src <-> dst
+    ip_header_nt = StructIpHeader(header[:20])
+    # Swap src <-> dst, keeping the options
     nt = ip_header_nt._replace(
         ip_src=getattr(ip_header_nt, 'ip_dst'),
         ip_dst=getattr(ip_header_nt, 'ip_src'))
-    return nt.pack()
+    return nt.pack() + header[20:]
 #####################################################################
 
 def parse_udp(packet):
@@ -463,7 +1248,8 @@ def make_ip_package(ip_header, header_without_options, options, payload):
 
 def make_tpc_hdr_ack(header_without_options, port, num_bytes_added):
     nt = StructTcpHeaderWithoutOptions(header_without_options)
-    new_tcp_ack = getattr(nt, 'tcp_ack')
+    old_tcp_ack = getattr(nt, 'tcp_ack')
+    new_tcp_ack = old_tcp_ack
 
     (tcp_fin_f, tcp_syn_f, tcp_rst_f, tcp_psh_f, tcp_ack_f,
         tcp_urg_f) = parse_tcp_flags(getattr(nt, 'tcp_flags'))
@@ -471,24 +1257,39 @@ def make_tpc_hdr_ack(header_without_options, port, num_bytes_added):
     # If packet does not belong to TCP 3-Way Handshake:
     # reduce the ACK according to the added bytes
     if ( (tcp_ack_f == True) and (tcp_syn_f == False) ):
-        new_tcp_ack -= num_bytes_added
-    nt_new_header_without_options = nt._replace(tcp_ack=new_tcp_ack)
+        new_tcp_ack = (new_tcp_ack - num_bytes_added) & 0xFFFFFFFF
+    # Incremental checksum update (RFC1624), no need to recompute over the payload
+    nt_new_header_without_options = nt._replace(tcp_ack=new_tcp_ack,
+        tcp_checksum=update_checksum_32(getattr(nt, 'tcp_checksum'),
+            old_tcp_ack, new_tcp_ack))
     return nt_new_header_without_options.pack()
 
 
 def make_tpc_hdr_seq(header_without_options, port, num_bytes_added):
     nt = StructTcpHeaderWithoutOptions(header_without_options)
-    new_tcp_seq = getattr(nt, 'tcp_seq_number')
+    old_tcp_seq = getattr(nt, 'tcp_seq_number')
+    new_tcp_seq = old_tcp_seq
 
     (tcp_fin_f, tcp_syn_f, tcp_rst_f, tcp_psh_f, tcp_ack_f,
         tcp_urg_f) = parse_tcp_flags(getattr(nt, 'tcp_flags'))
     if ( (tcp_ack_f == True) and (tcp_syn_f == False) ):
-        new_tcp_seq += num_bytes_added
+        new_tcp_seq = (new_tcp_seq + num_bytes_added) & 0xFFFFFFFF
 
-    nt_new_header_without_options = nt._replace(tcp_seq_number=new_tcp_seq)
+    nt_new_header_without_options = nt._replace(tcp_seq_number=new_tcp_seq,
+        tcp_checksum=update_checksum_32(getattr(nt, 'tcp_checksum'),
+            old_tcp_seq, new_tcp_seq))
     return nt_new_header_without_options.pack()
 
 
+def get_tcp_payload_length(ip_header, header_without_options):
+    # Use the IP Total Length: short frames carry Ethernet padding after the
+    # TCP segment that must not be counted as payload
+    ip_header_nt = StructIpHeader(ip_header)
+    nt = StructTcpHeaderWithoutOptions(header_without_options)
+    return (getattr(ip_header_nt, 'ip_total_length') - len(ip_header)
+        - (getattr(nt, 'tcp_byte_data_offset') >> 4) * 4)
+
+
 def get_tpc_sync(header_without_options):
     nt = StructTcpHeaderWithoutOptions(header_without_options)
     (tcp_fin_f, tcp_syn_f, tcp_rst_f, tcp_psh_f, tcp_ack_f,
@@ -534,14 +1335,13 @@ def get_tcp_flags_str(fin, syn, rst, psh, ack, urg):
 
 #Base on #https://github.com/secdev/scapy/blob/master/scapy/utils.py
 def calculate_checksum(pkt):
-    import array
     if len(pkt) % 2 == 1:
         pkt += b'\0'
     s = sum(array.array("H", pkt))
     s = (s >> 16) + (s & 0xffff)
     s += s >> 16
     s = ~s
-    if struct.pack("H",1) == "\x00\x01": # big endian
+    if sys.byteorder == 'big':
         return s & 0xffff
     else:
         return (((s>>8)&0xff)|s<<8) & 0xffff
@@ -573,6 +1373,17 @@ def calculate_ip_checksum(pkt):
     pkt = pkt[0:10] + b'\0' + b'\0' + pkt[12:len(pkt)]
     return calculate_checksum(pkt)
 
+# Incremental checksum update, RFC1624 eqn. 3: HC' = ~(~HC + ~m + m')
+def update_checksum_16(checksum, old_word, new_word):
+    s = (~checksum & 0xffff) + (~old_word & 0xffff) + new_word
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+def update_checksum_32(checksum, old_value, new_value):
+    checksum = update_checksum_16(checksum, old_value >> 16, new_value >> 16)
+    return update_checksum_16(checksum, old_value & 0xffff, new_value & 0xffff)
+
 def need_reset_tcp_connection(tcp_header_without_options):
     nt = StructTcpHeaderWithoutOptions(tcp_header_without_options)
     (tcp_fin_f, tcp_syn_f, tcp_rst_f, tcp_psh_f, tcp_ack_f,
@@ -605,6 +1416,1171 @@ class Sockets(Enum):
      output_socket = 1
      input_socket = 2
 
+# ************************************************
+#  Batch checksums
+# ************************************************
+
+"""
+IPv4 header and TCP/UDP checksums of a whole batch of frames at once. With
+NumPy the frames are joined in one buffer, seen as big endian 16-bit
+words, and every checksum is the difference of two entries of their
+cumulative sum, so there is no Python work per byte nor per frame (except
+the join). Without NumPy the same results come from a loop over the
+frames.
+
+l3_offsets is the offset of the IPv4 header in each frame (an int for
+all of them), it must be even. Frames that are not IPv4, or shorter than
+their headers say, are reported as invalid. Other L4 protocols than TCP
+and UDP only get their IP header checked.
+"""
+
+IP_PROTOCOL_TCP = 6
+IP_PROTOCOL_UDP = 17
+# Offset of the checksum in the L4 header
+L4_CHECKSUM_OFFSET = {IP_PROTOCOL_TCP: 16, IP_PROTOCOL_UDP: 6}
+
+checksum_errors = 0
+verify_checksums = False
+
+
+def fold_checksum(s):
+    """One's complement sum of 16-bit words, ints or NumPy vectors"""
+    for i in range(3):
+        s = (s & 0xffff) + (s >> 16)
+    return s
+
+
+def sum16(data):
+    """Sum, not folded, of the big endian 16-bit words of data"""
+    if len(data) % 2 == 1:
+        data = bytes(data) + b'\0'
+    words = array.array('H', bytes(data))
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return sum(words)
+
+
+def get_l3_offsets(frames, l3_offsets):
+    if isinstance(l3_offsets, int):
+        return [l3_offsets] * len(frames)
+    return l3_offsets
+
+
+def load_numpy():
+    """Imports NumPy the first time, returns None if it is missing: batch
+    checksums fall back to a loop over the frames"""
+    global numpy
+    global numpy_loaded
+
+    if not numpy_loaded:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        numpy_loaded = True
+    return numpy
+
+
+def checksum_sums(frames, l3_offsets):
+    """Returns the vectors valid, protocol, ip_sum, ip_field, l4_sum,
+    l4_field: sums not folded, over the headers with their checksum
+    fields, l4_sum including the pseudo header"""
+    if load_numpy() is not None:
+        return checksum_sums_numpy(frames, l3_offsets)
+    if not frames:
+        return ([],) * 6
+    results = []
+    for (frame, l3) in zip(frames, get_l3_offsets(frames, l3_offsets)):
+        if len(frame) < l3 + 20 or frame[l3] >> 4 != 4:
+            results.append((False, 0, 0, 0, 0, 0))
+            continue
+        ihl = (frame[l3] & 0x0F) * 4
+        (total_length, protocol) = (struct.unpack_from('!H', frame, l3 + 2)[0], frame[l3 + 9])
+        if ihl < 20 or total_length < ihl or len(frame) < l3 + total_length:
+            results.append((False, 0, 0, 0, 0, 0))
+            continue
+        ip_sum = sum16(frame[l3:l3 + ihl])
+        ip_field = struct.unpack_from('!H', frame, l3 + 10)[0]
+        l4_sum = l4_field = 0
+        checksum_offset = L4_CHECKSUM_OFFSET.get(protocol)
+        valid = True
+        if checksum_offset is not None:
+            l4_length = total_length - ihl
+            if l4_length < checksum_offset + 2:
+                valid = False
+            else:
+                l4_sum = (sum16(frame[l3 + ihl:l3 + total_length])
+                    + sum16(frame[l3 + 12:l3 + 20]) + protocol + l4_length)
+                l4_field = struct.unpack_from('!H', frame, l3 + ihl + checksum_offset)[0]
+        results.append((valid, protocol, ip_sum, ip_field, l4_sum, l4_field))
+    return tuple(list(column) for column in zip(*results))
+
+
+def checksum_sums_numpy(frames, l3_offsets):
+    count = len(frames)
+    if not count:
+        return (numpy.zeros(0, dtype=bool),) + (numpy.zeros(0, dtype=numpy.int64),) * 5
+    lengths = numpy.fromiter((len(frame) for frame in frames), dtype=numpy.int64, count=count)
+    # Each frame starts on a word
+    padded = lengths + (lengths & 1)
+    starts = numpy.zeros(count, dtype=numpy.int64)
+    numpy.cumsum(padded[:-1], out=starts[1:])
+    # Room after the last frame for the reads of the invalid ones
+    buf = numpy.frombuffer(b''.join(frame if len(frame) % 2 == 0 else bytes(frame) + b'\0'
+        for frame in frames) + bytes(64), dtype=numpy.uint8)
+    words = buf.view('>u2').astype(numpy.int64)
+    cumsum = numpy.zeros(len(words) + 1, dtype=numpy.int64)
+    numpy.cumsum(words, out=cumsum[1:])
+
+    l3 = starts + numpy.asarray(l3_offsets, dtype=numpy.int64)
+    valid = lengths >= l3 - starts + 20
+    # Out of range fields of invalid frames read byte 0, masked out below
+    at = numpy.where(valid, l3, 0)
+    valid &= (buf[at] >> 4) == 4
+    ihl = (buf[at] & 0x0F).astype(numpy.int64) * 4
+    total_length = buf[at + 2].astype(numpy.int64) * 256 + buf[at + 3]
+    protocol = buf[at + 9].astype(numpy.int64)
+    valid &= (ihl >= 20) & (total_length >= ihl) & (lengths >= at - starts + total_length)
+    at = numpy.where(valid, at, 0)
+    ihl = numpy.where(valid, ihl, 20)
+    total_length = numpy.where(valid, total_length, 20)
+
+    w_ip = at // 2
+    w_l4 = w_ip + ihl // 2
+    ip_sum = cumsum[w_l4] - cumsum[w_ip]
+    ip_field = words[w_ip + 5]
+
+    l4_length = total_length - ihl
+    tcp = protocol == IP_PROTOCOL_TCP
+    udp = protocol == IP_PROTOCOL_UDP
+    checksum_offset = numpy.where(tcp, 16, 6)
+    has_l4 = valid & (tcp | udp)
+    valid &= ~(tcp | udp) | (l4_length >= checksum_offset + 2)
+    has_l4 &= valid
+    end = at + total_length
+    # An odd length segment ends with half a word
+    l4_sum = (cumsum[w_l4 + l4_length // 2] - cumsum[w_l4]
+        + numpy.where(l4_length & 1, buf[numpy.maximum(end - 1, 0)].astype(numpy.int64) << 8, 0)
+        + cumsum[w_ip + 10] - cumsum[w_ip + 6] + protocol + l4_length)
+    l4_field = words[numpy.where(has_l4, w_l4 + checksum_offset // 2, 0)]
+    l4_sum = numpy.where(has_l4, l4_sum, 0)
+    l4_field = numpy.where(has_l4, l4_field, 0)
+    return valid, protocol, ip_sum, ip_field, l4_sum, l4_field
+
+
+def verify_checksums_batch(frames, l3_offsets=14):
+    """Vector of booleans: IP header and TCP/UDP checksums are right"""
+    (valid, protocol, ip_sum, ip_field, l4_sum, l4_field) = checksum_sums(frames, l3_offsets)
+    if numpy is not None:
+        has_l4 = (protocol == IP_PROTOCOL_TCP) | (protocol == IP_PROTOCOL_UDP)
+        # UDP checksum 0: not computed by the sender
+        no_l4_checksum = ~has_l4 | ((protocol == IP_PROTOCOL_UDP) & (l4_field == 0))
+        return (valid & (fold_checksum(ip_sum) == 0xffff)
+            & (no_l4_checksum | (fold_checksum(l4_sum) == 0xffff)))
+    results = []
+    for (valid, protocol, ip_sum, ip_field, l4_sum, l4_field) in zip(valid, protocol,
+            ip_sum, ip_field, l4_sum, l4_field):
+        if valid and fold_checksum(ip_sum) != 0xffff:
+            valid = False
+        if valid and protocol in L4_CHECKSUM_OFFSET:
+            # UDP checksum 0: not computed by the sender
+            if not (protocol == IP_PROTOCOL_UDP and l4_field == 0):
+                valid = fold_checksum(l4_sum) == 0xffff
+        results.append(valid)
+    return results
+
+
+def compute_checksums_batch(frames, l3_offsets=14):
+    """List of (ip_checksum, l4_checksum) to write in the frames, ignoring
+    the values already there, None for invalid frames"""
+    results = []
+    for (valid, protocol, ip_sum, ip_field, l4_sum, l4_field) in zip(*checksum_sums(frames, l3_offsets)):
+        if not valid:
+            results.append(None)
+            continue
+        ip_checksum = ~fold_checksum(int(ip_sum - ip_field)) & 0xffff
+        l4_checksum = None
+        if protocol in L4_CHECKSUM_OFFSET:
+            l4_checksum = ~fold_checksum(int(l4_sum - l4_field)) & 0xffff
+            if protocol == IP_PROTOCOL_UDP and l4_checksum == 0:
+                l4_checksum = 0xffff
+        results.append((ip_checksum, l4_checksum))
+    return results
+
+
+def get_inner_l3_offset(frame):
+    """Offset of the inner IPv4 header of a VxLAN-GPE/NSH frame, None for
+    other frames"""
+    if len(frame) < 14 + 20 or frame[12:14] != b'\x08\x00' or frame[14 + 9] != IP_PROTOCOL_UDP:
+        return None
+    udp = 14 + (frame[14] & 0x0F) * 4
+    if frame[udp + 2:udp + 4] != b'\x12\xb6': # 4790
+        return None
+    nsh = udp + 8 + 8 + 14
+    if len(frame) < nsh + NSH_BASE_LENGTH:
+        return None
+    nsh_length = get_nsh_layout(frame[nsh:nsh + 3]).length
+    if nsh_length is None:
+        return None
+    return nsh + nsh_length + 14
+
+
+def filter_inner_checksums(frames, timestamps):
+    """Drops the VxLAN-GPE/NSH frames whose inner packet has a wrong
+    checksum, with their timestamps"""
+    global checksum_errors
+
+    offsets = [get_inner_l3_offset(frame) for frame in frames]
+    checked = [i for i in range(len(frames)) if offsets[i] is not None]
+    if not checked:
+        return frames, timestamps
+    valid = verify_checksums_batch([frames[i] for i in checked], [offsets[i] for i in checked])
+    bad = set(checked[j] for j in range(len(checked)) if not valid[j])
+    if not bad:
+        return frames, timestamps
+    checksum_errors += len(bad)
+    pf("   Wrong inner checksums, frames dropped: " + str(len(bad)), LOG_INFO)
+    keep = [i for i in range(len(frames)) if i not in bad]
+    return ([frames[i] for i in keep],
+        [timestamps[i] for i in keep] if timestamps is not None else None)
+
+# ************************************************
+#  TCP sequence/ACK offset tracking
+# ************************************************
+
+"""
+A Service Function may add (or remove) bytes to a TCP stream without fixing
+the sequence numbers, e.g. when injecting an HTTP header. The proxy sees every
+segment twice: on its way to the SF (unencapsulate_packet) and on its way back
+(encapsulate_*_packet). Comparing the payload length of both copies gives the
+number of bytes the SF added at that sequence position.
+
+  - Leg proxy -> SF: ACK numbers and SACK blocks of the opposite direction
+    are moved back to the original sequence space.
+  - Leg SF -> proxy: the sequence number is moved to the modified sequence
+    space, i.e. increased by the bytes added before it.
+
+Positions are stored relative to the first sequence number seen, so the
+comparisons survive the 32-bit wrap. A connection is forgotten once both
+FINs are ACKed and nothing of it is left in the SF, on RST, or with one of
+its sessions.
+"""
+
+TCP_OFFSETS_MAX_OUTSTANDING = 1024
+
+TCP_OPT_EOL = 0
+TCP_OPT_NOP = 1
+TCP_OPT_SACK = 5
+
+class TcpSeqDeltaTable(object):
+    """Cumulative bytes added by the SF to one direction of a TCP connection"""
+
+    def __init__(self, isn):
+        self.isn = isn
+        self.orig_pos = []   # relative seq (original space) where a delta starts
+        self.mod_pos = []    # same position in the modified space
+        self.cum_delta = []  # cumulative delta from that position on
+
+    def rel(self, seq):
+        return (seq - self.isn) & 0xFFFFFFFF
+
+    def last_orig_pos(self):
+        return self.orig_pos[-1] if self.orig_pos else 0
+
+    def add(self, orig_seq_end, delta):
+        pos = self.rel(orig_seq_end)
+        cum = (self.cum_delta[-1] if self.cum_delta else 0) + delta
+        self.orig_pos.append(pos)
+        self.mod_pos.append(pos + cum)
+        self.cum_delta.append(cum)
+
+    def _lookup(self, positions, rel_value):
+        # In-order traffic always hits the last entry
+        if not positions or rel_value >= positions[-1]:
+            return self.cum_delta[-1] if positions else 0
+        i = bisect.bisect_right(positions, rel_value)
+        return self.cum_delta[i - 1] if i > 0 else 0
+
+    def seq_delta(self, seq):
+        return self._lookup(self.orig_pos, self.rel(seq))
+
+    def ack_delta(self, ack):
+        return self._lookup(self.mod_pos, self.rel(ack))
+
+
+class TcpFlowOffsets(object):
+    """Delta tables of both directions of a TCP connection going through the SF.
+    Direction 0 goes from client to server, direction 1 from server to client.
+    Both legs change them from different loops: only used with lock held"""
+
+    def __init__(self, key, server_port):
+        self.lock = threading.Lock()
+        self.key = key
+        self.server_port = server_port
+        self.tables = [None, None]
+        # seq -> payload length of the segments sent to the SF, per direction
+        self.outstanding = [{}, {}]
+        # Relative seq right after the FIN of each direction, and whether
+        # the other end ACKed it
+        self.fin_end = [None, None]
+        self.fin_acked = [False, False]
+        # Segments sent to the SF and not back yet
+        self.in_sf = 0
+
+    def closed(self):
+        return self.fin_acked[0] and self.fin_acked[1]
+
+    def direction(self, header_without_options):
+        if goes_from_client_to_server(header_without_options, self.server_port):
+            return 0
+        return 1
+
+    def table(self, direction, seq):
+        if self.tables[direction] is None:
+            self.tables[direction] = TcpSeqDeltaTable(seq)
+        return self.tables[direction]
+
+
+def make_tcp_connection_key(ip_src, tcp_src_port, ip_dst, tcp_dst_port):
+    # Same key for both directions of the connection, 12 bytes like
+    # make_session_key, cheap to hash
+    source = ip_src + tcp_src_port.to_bytes(2, byteorder='big')
+    destination = ip_dst + tcp_dst_port.to_bytes(2, byteorder='big')
+    if source < destination:
+        return source + destination
+    return destination + source
+
+
+def get_tcp_offsets(ip_header, header_without_options, create):
+    ip_header_nt = StructIpHeader(ip_header)
+    nt = StructTcpHeaderWithoutOptions(header_without_options)
+    conn_key = make_tcp_connection_key(
+        getattr(ip_header_nt, 'ip_src'), getattr(nt, 'tcp_src_port'),
+        getattr(ip_header_nt, 'ip_dst'), getattr(nt, 'tcp_dst_port'))
+
+    global tcp_offsets
+    if need_reset_tcp_connection(header_without_options):
+        return tcp_offsets.evict(conn_key)
+
+    # Found and touched with the shard locked once
+    flow = tcp_offsets.get(conn_key, touch=True)
+    if flow is not None or not create:
+        return flow
+    # The first segment seen (normally the SYN) goes to the server
+    (flow, inserted) = tcp_offsets.get_or_insert(conn_key,
+        TcpFlowOffsets(conn_key, getattr(nt, 'tcp_dst_port')))
+    return flow
+
+
+def make_tcp_options_sack_shifted(header_without_options, options, table):
+    # Move SACK block edges back to the original sequence space
+    new_options = bytearray(options)
+    checksum = getattr(StructTcpHeaderWithoutOptions(header_without_options),
+        'tcp_checksum')
+    i = 0
+    while i < len(options):
+        kind = options[i]
+        if kind == TCP_OPT_EOL:
+            break
+        if kind == TCP_OPT_NOP:
+            i += 1
+            continue
+        if i + 1 >= len(options) or options[i + 1] < 2:
+            break
+        length = options[i + 1]
+        if kind == TCP_OPT_SACK:
+            for j in range(i + 2, min(i + length, len(options)) - 3, 4):
+                (edge,) = struct.unpack_from('!L', options, j)
+                new_edge = (edge - table.ack_delta(edge)) & 0xFFFFFFFF
+                if new_edge != edge:
+                    struct.pack_into('!L', new_options, j, new_edge)
+                    checksum = update_checksum_32(checksum, edge, new_edge)
+        i += length
+
+    nt = StructTcpHeaderWithoutOptions(header_without_options)
+    return nt._replace(tcp_checksum=checksum).pack(), bytes(new_options)
+
+
+def make_tcp_segment_to_sf(ip_header, header_without_options, options, payload):
+    """Record the segment sent to the SF and restore its ACK/SACK numbers
+    to the sequence space of the SF"""
+    flow = get_tcp_offsets(ip_header, header_without_options, create=True)
+    if flow is None:
+        return header_without_options, options
+    with flow.lock:
+        nt = StructTcpHeaderWithoutOptions(header_without_options)
+        seq = getattr(nt, 'tcp_seq_number')
+        direction = flow.direction(header_without_options)
+        table = flow.table(direction, seq)
+
+        payload_length = get_tcp_payload_length(ip_header, header_without_options)
+        if payload_length > 0:
+            outstanding = flow.outstanding[direction]
+            if len(outstanding) >= TCP_OFFSETS_MAX_OUTSTANDING:
+                del outstanding[next(iter(outstanding))]
+            outstanding[seq] = payload_length
+        flow.in_sf += 1
+
+        flags = getattr(nt, 'tcp_flags')
+        if flags & TCP_FLAG_FIN:
+            flow.fin_end[direction] = table.rel(seq + payload_length + 1)
+
+        # ACKs travel in the opposite direction to the data they acknowledge
+        ack = getattr(nt, 'tcp_ack')
+        reverse_table = flow.tables[1 - direction]
+        fin_end = flow.fin_end[1 - direction]
+        if fin_end is not None and flags & TCP_FLAG_ACK:
+            orig_ack = (ack - reverse_table.ack_delta(ack)) & 0xFFFFFFFF
+            if reverse_table.rel(orig_ack) >= fin_end:
+                flow.fin_acked[1 - direction] = True
+        if reverse_table is not None and reverse_table.cum_delta:
+            header_without_options = make_tpc_hdr_ack(header_without_options,
+                flow.server_port, reverse_table.ack_delta(ack))
+            if options:
+                (header_without_options, options) = make_tcp_options_sack_shifted(
+                    header_without_options, options, reverse_table)
+        return header_without_options, options
+
+
+def make_tcp_segment_from_sf(ip_header, header_without_options):
+    """Learn the bytes added by the SF and move the sequence number of the
+    segment coming back from the SF to the modified sequence space"""
+    flow = get_tcp_offsets(ip_header, header_without_options, create=False)
+    if flow is None:
+        return header_without_options
+    with flow.lock:
+        nt = StructTcpHeaderWithoutOptions(header_without_options)
+        seq = getattr(nt, 'tcp_seq_number')
+        direction = flow.direction(header_without_options)
+        table = flow.table(direction, seq)
+
+        orig_payload_length = flow.outstanding[direction].pop(seq, None)
+        if orig_payload_length is not None:
+            payload_length = get_tcp_payload_length(ip_header, header_without_options)
+            orig_seq_end = (seq + orig_payload_length) & 0xFFFFFFFF
+            # Retransmissions must not account the same bytes twice
+            if (payload_length != orig_payload_length and
+                    table.rel(orig_seq_end) > table.last_orig_pos()):
+                table.add(orig_seq_end, payload_length - orig_payload_length)
+
+        flow.in_sf = max(flow.in_sf - 1, 0)
+        if flow.closed() and not flow.in_sf:
+            # Both FINs ACKed and nothing left in the SF to fix
+            tcp_offsets.evict(flow.key)
+
+        if not table.cum_delta:
+            return header_without_options
+        return make_tpc_hdr_seq(header_without_options, flow.server_port,
+            table.seq_delta(seq))
+
+# ************************************************
+#  SF replicas
+# ************************************************
+
+"""
+The proxy can front a pool of replicas of the same SF. Each replica has
+its own unencapsulated interface pair, or shares the default pair and is
+reached through its own destination MAC. A new TCP connection is given a
+replica by a consistent hash ring over the connection key (same for both
+directions), and the choice is kept in flow_replicas so the connection
+sticks to it. Adding or removing a replica only moves the connections
+whose ring points change hands.
+
+A replica that keeps receiving frames without sending any back is ejected
+from the ring for REPLICA_EJECT_TIME seconds.
+"""
+
+REPLICA_VNODES = 100
+REPLICA_HEALTH_INTERVAL = 1.0
+REPLICA_EJECT_MIN_TX = 10
+REPLICA_EJECT_TIME = 30.0
+# Receive timeout of the sockets of a replica, for its loops to see it removed
+REPLICA_STOP_INTERVAL = 1.0
+
+
+class SfReplica(object):
+
+    def __init__(self, name, in_if=None, out_if=None, mac=None, weight=1):
+        self.name = name
+        self.in_if = in_if
+        self.out_if = out_if
+        self.mac = mac
+        self.weight = weight
+        self.sckt_in = None
+        self.sckt_out = None
+        self.healthy = True
+        # Removed by a reload: its loops close its sockets and end
+        self.stopped = False
+        self.ejected_at = 0
+        self.tx_packets = 0
+        self.rx_packets = 0
+        self.checked_tx_packets = 0
+        self.checked_rx_packets = 0
+
+    def __str__(self):
+        return ("SfReplica(name=" + self.name
+            + ", in_if=" + str(self.in_if) + ", out_if=" + str(self.out_if)
+            + ", mac=" + (mac2str(self.mac) if self.mac else 'None')
+            + ", weight=" + str(self.weight) + ", healthy=" + str(self.healthy)
+            + ", tx=" + str(self.tx_packets) + ", rx=" + str(self.rx_packets) + ")")
+
+
+def mix_hash(h):
+    # MurmurHash3 finalizer: crc32 of similar keys lands in clusters
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xFFFFFFFF
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xFFFFFFFF
+    h ^= h >> 16
+    return h
+
+
+class ReplicaRing(object):
+    """Consistent hash ring, weight * REPLICA_VNODES points per replica"""
+
+    def __init__(self, replicas=()):
+        self.replicas = collections.OrderedDict()
+        self.ring = ((), ())
+        for replica in replicas:
+            self.replicas[replica.name] = replica
+        self.build()
+
+    def build(self):
+        points = []
+        for replica in self.replicas.values():
+            for i in range(replica.weight * REPLICA_VNODES):
+                points.append((mix_hash(stable_hash((replica.name.encode(), i))), replica))
+        points.sort(key=lambda point: point[0])
+        # Replaced as a whole, lookups from other threads see old or new ring
+        self.ring = (tuple(p[0] for p in points), tuple(p[1] for p in points))
+
+    def add(self, replica):
+        self.replicas[replica.name] = replica
+        self.build()
+
+    def remove(self, name):
+        replica = self.replicas.pop(name, None)
+        self.build()
+        return replica
+
+    def lookup(self, key_hash):
+        """First healthy replica clockwise from key_hash, None if none is"""
+        (hashes, owners) = self.ring
+        if not hashes:
+            return None
+        start = bisect.bisect_left(hashes, mix_hash(key_hash))
+        for i in range(len(hashes)):
+            replica = owners[(start + i) % len(hashes)]
+            if replica.healthy:
+                return replica
+        return None
+
+    def __len__(self):
+        return len(self.replicas)
+
+
+# No pool unless configured, only the default interfaces
+replica_ring = ReplicaRing()
+# SPI -> ReplicaRing, for the Service Paths not using replica_ring
+spi_replica_rings = {}
+
+
+class FlowReplica(object):
+    """Replica given to a TCP connection. In MAC mode also the original
+    destination MAC of each direction, keyed by source IP and port"""
+
+    def __init__(self, replica):
+        self.replica = replica
+        self.orig_eth_dst = {}
+
+
+def parse_replica_spec(spec):
+    """name=sf1,in=veth1,out=veth2[,weight=2] or name=sf2,mac=02:00:00:00:00:01,
+    raises ValueError on anything else"""
+    if any('=' not in item for item in spec.split(',')):
+        raise ValueError('replica ' + spec + ': comma separated key=value expected')
+    fields = dict(item.split('=', 1) for item in spec.split(','))
+    if 'name' not in fields:
+        raise ValueError('replica ' + spec + ': name is missing')
+    if ('in' in fields) != ('out' in fields):
+        raise ValueError('replica ' + fields['name'] + ': in and out go together,'
+            ' the SF is reached on one interface and sends back on the other')
+    mac = None
+    if 'mac' in fields:
+        mac = bytes.fromhex(fields['mac'].replace(':', ''))
+    return SfReplica(fields['name'], in_if=fields.get('in'),
+        out_if=fields.get('out'), mac=mac, weight=int(fields.get('weight', 1)))
+
+
+def get_replica_ring(nsh_spi):
+    # A Service Path may have a pool of its own
+    return spi_replica_rings.get(nsh_spi, replica_ring)
+
+
+def all_replicas():
+    replicas = collections.OrderedDict()
+    for ring in [replica_ring] + list(spi_replica_rings.values()):
+        for replica in ring.replicas.values():
+            replicas[id(replica)] = replica
+    return list(replicas.values())
+
+
+def get_flow_replica(ring, ip_header, header_without_options):
+    ip_header_nt = StructIpHeader(ip_header)
+    nt = StructTcpHeaderWithoutOptions(header_without_options)
+    conn_key = make_tcp_connection_key(
+        getattr(ip_header_nt, 'ip_src'), getattr(nt, 'tcp_src_port'),
+        getattr(ip_header_nt, 'ip_dst'), getattr(nt, 'tcp_dst_port'))
+
+    global flow_replicas
+    flow = flow_replicas.get(conn_key, touch=True)
+    if flow is not None and flow.replica.healthy:
+        return flow
+
+    replica = ring.lookup(stable_hash(conn_key))
+    if replica is None:
+        # All ejected, better a replica that may be slow than none
+        replica = next(iter(ring.replicas.values()))
+    if flow is None:
+        (flow, inserted) = flow_replicas.get_or_insert(conn_key, FlowReplica(replica))
+    else:
+        # Its replica was ejected or removed
+        flow.replica = replica
+    return flow
+
+
+def make_frame_to_replica(frame, flow, ip_src, tcp_src_port):
+    # MAC mode: the replica is reached through its own destination MAC
+    flow.orig_eth_dst[ip_src + tcp_src_port.to_bytes(2, byteorder='big')] = frame[:6]
+    return flow.replica.mac + frame[6:]
+
+
+def make_frame_from_replica(frame, ip_header, header_without_options):
+    """Restores the destination MAC changed by make_frame_to_replica"""
+    ip_header_nt = StructIpHeader(ip_header)
+    nt = StructTcpHeaderWithoutOptions(header_without_options)
+    ip_src = getattr(ip_header_nt, 'ip_src')
+    tcp_src_port = getattr(nt, 'tcp_src_port')
+    conn_key = make_tcp_connection_key(ip_src, tcp_src_port,
+        getattr(ip_header_nt, 'ip_dst'), getattr(nt, 'tcp_dst_port'))
+    flow = flow_replicas.get(conn_key)
+    if flow is None:
+        return frame
+    orig_eth_dst = flow.orig_eth_dst.get(
+        ip_src + tcp_src_port.to_bytes(2, byteorder='big'))
+    if orig_eth_dst is None:
+        return frame
+    return orig_eth_dst + frame[6:]
+
+
+def check_replicas_health():
+    now = time.monotonic()
+    for replica in all_replicas():
+        # Frames coming back through the default interfaces without a MAC
+        # of their own cannot be told apart
+        if replica.in_if is None and replica.mac is None:
+            continue
+        tx = replica.tx_packets - replica.checked_tx_packets
+        rx = replica.rx_packets - replica.checked_rx_packets
+        replica.checked_tx_packets = replica.tx_packets
+        replica.checked_rx_packets = replica.rx_packets
+        if replica.healthy and tx >= REPLICA_EJECT_MIN_TX and rx == 0:
+            replica.healthy = False
+            replica.ejected_at = now
+            pf("   Replica ejected: " + str(replica), LOG_INFO)
+        elif not replica.healthy and now - replica.ejected_at >= REPLICA_EJECT_TIME:
+            replica.healthy = True
+            pf("   Replica readmitted: " + str(replica), LOG_INFO)
+
+# ************************************************
+#  SF latency
+# ************************************************
+
+"""
+Time the SF holds each TCP segment: from the kernel receive timestamp of
+the encapsulated frame (SO_TIMESTAMPNS) to the one of the same segment
+coming back from the SF, matched by session key, seq, ack, SYN/FIN/RST
+flags and payload length (a pure ACK and the segment right after it share
+seq and ack). Segments whose length the SF changes are not timed. Each session
+keeps at most LATENCY_WINDOW segments waiting for their return (the
+oldest are forgotten), and at most LATENCY_MAX_FLOWS sessions are tracked,
+so memory does not depend on the traffic. Results are kept in
+histograms per SPI and per replica.
+"""
+
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC_FMT = '@ll'
+TIMESPEC_SIZE = struct.calcsize(TIMESPEC_FMT)
+
+LATENCY_WINDOW = 64
+# TCP flags telling apart segments with the same seq and ack: FIN, SYN, RST
+LATENCY_TCP_FLAGS = 0x07
+LATENCY_MAX_FLOWS = 65536
+# 4 buckets per power of 2, from 1ns to ~1000s
+LATENCY_BUCKETS_PER_OCTAVE = 4
+LATENCY_OCTAVES = 40
+LATENCY_NUM_BUCKETS = LATENCY_OCTAVES * LATENCY_BUCKETS_PER_OCTAVE
+
+
+class LatencyHistogram(object):
+    """Log-linear histogram of nanoseconds, fixed size"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = [0] * LATENCY_NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def bucket(ns):
+        if ns < 1:
+            return 0
+        octave = ns.bit_length() - 1
+        # Next 2 bits after the leading one
+        sub = ((ns << 2) >> octave) & 0x3 if octave >= 2 else (ns & 0x3)
+        return min(octave * LATENCY_BUCKETS_PER_OCTAVE + sub, LATENCY_NUM_BUCKETS - 1)
+
+    @staticmethod
+    def bucket_upper(index):
+        (octave, sub) = divmod(index, LATENCY_BUCKETS_PER_OCTAVE)
+        return ((1 << octave) * (LATENCY_BUCKETS_PER_OCTAVE + sub + 1)) // LATENCY_BUCKETS_PER_OCTAVE
+
+    def add(self, ns):
+        index = LatencyHistogram.bucket(ns)
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += ns
+            if self.min is None or ns < self.min:
+                self.min = ns
+            if ns > self.max:
+                self.max = ns
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile"""
+        with self.lock:
+            if not self.count:
+                return 0
+            rank = p / 100.0 * self.count
+            seen = 0
+            for (index, n) in enumerate(self.buckets):
+                seen += n
+                if n and seen >= rank:
+                    return min(LatencyHistogram.bucket_upper(index), self.max)
+            return self.max
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('count', self.count), ('min_ns', self.min or 0), ('max_ns', self.max),
+            ('avg_ns', self.total // self.count if self.count else 0),
+            ('p50_ns', self.percentile(50)), ('p99_ns', self.percentile(99)),
+            ('p999_ns', self.percentile(99.9))])
+
+
+def enable_timestamps(sckt):
+    sckt.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+
+
+def get_timestamp_ns(ancdata):
+    for (level, msg_type, data) in ancdata:
+        if level == socket.SOL_SOCKET and msg_type == SCM_TIMESTAMPNS:
+            (sec, nsec) = struct.unpack(TIMESPEC_FMT, data[:TIMESPEC_SIZE])
+            return sec * 1000000000 + nsec
+    # Not provided by the kernel, take it now
+    return time.time_ns()
+
+
+def timestamps_enabled():
+    return measure_sf_latency or low_latency
+
+
+def get_latency_histogram(histograms, name):
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms.setdefault(name, LatencyHistogram())
+    return histogram
+
+
+class LatencyWindow(object):
+    """Segments of a session inside the SF, oldest first. Changed by the
+    loop sending to the SF and the one receiving from it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}
+
+
+def latency_segment(ip_header, header_without_options):
+    """What identifies a segment inside the window of its session"""
+    nt = StructTcpHeaderWithoutOptions(header_without_options)
+    return (getattr(nt, 'tcp_seq_number'), getattr(nt, 'tcp_ack'),
+        getattr(nt, 'tcp_flags') & LATENCY_TCP_FLAGS,
+        get_tcp_payload_length(ip_header, header_without_options))
+
+
+def latency_to_sf(key, segment, timestamp, nsh_spi, replica_name):
+    # Only the first segment of a session builds a window
+    window = latency_windows.get(key)
+    if window is None:
+        (window, inserted) = latency_windows.get_or_insert(key, LatencyWindow())
+        if inserted and len(latency_windows) > LATENCY_MAX_FLOWS:
+            latency_windows.evict_lru(len(latency_windows) - LATENCY_MAX_FLOWS)
+    with window.lock:
+        if len(window.sent) >= LATENCY_WINDOW:
+            # Never came back, or lost: forget the oldest
+            del window.sent[next(iter(window.sent))]
+        window.sent[segment] = (timestamp, nsh_spi, replica_name)
+
+
+def latency_from_sf(key, segment, timestamp):
+    window = latency_windows.get(key, touch=True)
+    if window is None:
+        return
+    with window.lock:
+        sent = window.sent.pop(segment, None)
+    if sent is None:
+        return
+    (sent_timestamp, nsh_spi, replica_name) = sent
+    ns = timestamp - sent_timestamp
+    if ns < 0:
+        # Matched a segment sent after this one came back: a wrong match
+        return
+    get_latency_histogram(spi_latency, nsh_spi).add(ns)
+    if replica_name is not None:
+        get_latency_histogram(replica_latency, replica_name).add(ns)
+
+# ************************************************
+#  Low latency
+# ************************************************
+
+"""
+--low_latency trades CPU for latency: each loop thread is pinned to one of
+the --cpus cores, the sockets busy poll the NIC queue and bypass the qdisc,
+receives spin on non-blocking calls, and once warmed up the objects alive
+are frozen out of the GC and the collection thresholds raised so that
+collections do not stall the loops. Forwarding latency (kernel receive
+timestamp to send) is kept per loop to compare with the normal mode
+(--sf_latency measures it too).
+
+Loops are threads sharing the GIL, so spinning is bounded to
+LOW_LATENCY_SPINS polls before blocking again: a loop spinning forever
+would hold the other loops off the interpreter.
+"""
+
+SOL_PACKET = getattr(socket, 'SOL_PACKET', 263)
+PACKET_QDISC_BYPASS = getattr(socket, 'PACKET_QDISC_BYPASS', 20)
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+
+LOW_LATENCY_BUSY_POLL_USECS = 50
+LOW_LATENCY_SOCKET_BUFFER = 4 * 1024 * 1024
+LOW_LATENCY_SPINS = 1000
+LOW_LATENCY_WARMUP = 5
+LOW_LATENCY_GC_THRESHOLD = (100000, 50, 1000)
+
+low_latency = False
+low_latency_cpus = []
+pinned_threads = itertools.count()
+forwarding_latency = {}
+
+
+def parse_cpu_list(text):
+    """'2,3,6-8' -> [2, 3, 6, 7, 8]"""
+    cpus = []
+    for part in text.split(','):
+        if '-' in part:
+            (first, last) = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def setup_socket(sckt):
+    """Options of every socket the loops receive from or send to"""
+    if timestamps_enabled():
+        enable_timestamps(sckt)
+    if not low_latency:
+        return
+    options = [
+        (socket.SOL_SOCKET, SO_BUSY_POLL, LOW_LATENCY_BUSY_POLL_USECS),
+        (socket.SOL_SOCKET, socket.SO_RCVBUF, LOW_LATENCY_SOCKET_BUFFER),
+        (socket.SOL_SOCKET, socket.SO_SNDBUF, LOW_LATENCY_SOCKET_BUFFER),
+        (SOL_PACKET, PACKET_QDISC_BYPASS, 1)]
+    for (level, option, value) in options:
+        try:
+            sckt.setsockopt(level, option, value)
+        except OSError as e:
+            # SO_BUSY_POLL above net.core.busy_read needs CAP_NET_ADMIN
+            pf("   Socket option " + str(option) + " not set: " + str(e), LOG_INFO)
+
+
+def pin_current_thread():
+    """Pins the calling loop thread to the next core of --cpus"""
+    if not low_latency or not low_latency_cpus:
+        return
+    cpu = low_latency_cpus[next(pinned_threads) % len(low_latency_cpus)]
+    # pid 0 is the calling thread
+    os.sched_setaffinity(0, {cpu})
+    pf("   " + threading.current_thread().name + " pinned to CPU " + str(cpu), LOG_INFO)
+
+
+def freeze_gc_loop():
+    """After the warm up, what is alive (sockets, tables, templates) stays"""
+    time.sleep(LOW_LATENCY_WARMUP)
+    gc.collect()
+    gc.freeze()
+    gc.set_threshold(*LOW_LATENCY_GC_THRESHOLD)
+    pf("   GC frozen: " + str(gc.get_freeze_count()) + " objects", LOG_INFO)
+
+
+def recv_spin(recv, *args):
+    """Non-blocking receives, then a blocking one if nothing came"""
+    for i in range(LOW_LATENCY_SPINS):
+        try:
+            return recv(*args, socket.MSG_DONTWAIT)
+        except (BlockingIOError, socket.timeout):
+            pass
+    return recv(*args)
+
+
+def forwarding_latency_to_dict():
+    return dict((name, h.to_dict()) for (name, h) in list(forwarding_latency.items()))
+
+# ************************************************
+#  QoS
+# ************************************************
+
+"""
+With a "qos" section in the configuration file, frames are not sent
+straight from the packet functions:
+
+  - admission: token buckets, in packets per second, per SPI for the
+    frames going back to the SFF and per SF replica for the frames going
+    to the SF. Frames over the rate are dropped.
+  - egress queues: one queue per priority in front of each socket, of
+    queue_length frames (tail drop). The SPI gives the priority, 0 is
+    the highest.
+  - scheduling: after each received batch, the loop sends what is
+    queued, in strict priority or DRR (weights per priority, in frames
+    of QOS_DRR_QUANTUM bytes).
+
+  "qos": {
+    "scheduler": "drr",
+    "queue_length": 1024,
+    "weights": [8, 4, 2, 1],
+    "spi": {"20": {"pps": 10000, "burst": 100, "priority": 0}},
+    "sf": {"sf1": {"pps": 50000}}
+  }
+
+The clock of the buckets is read once per batch, admission is a couple
+of dictionary lookups and a few float operations per frame. Buckets are
+not locked: two loops admitting on the same bucket at once can, rarely,
+let one frame too many in.
+"""
+
+QOS_PRIORITIES = 4
+QOS_DEFAULT_PRIORITY = 2
+QOS_DEFAULT_QUEUE_LENGTH = 1024
+QOS_DEFAULT_WEIGHTS = [8, 4, 2, 1]
+QOS_DRR_QUANTUM = 1514
+QOS_SCHEDULERS = ('strict', 'drr')
+
+qos = None
+qos_now = 0.0
+# Socket -> EgressQueues, kept across reloads not to lose queued frames
+egress_queues = {}
+egress_queues_lock = threading.Lock()
+
+
+class TokenBucket(object):
+
+    def __init__(self, pps, burst=None):
+        self.rate = float(pps)
+        self.burst = float(burst if burst is not None else max(pps / 10.0, 1))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.passed = 0
+        self.dropped = 0
+
+    def admit(self, now):
+        if now > self.last:
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, self.burst)
+            self.last = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+        self.tokens -= 1
+        self.passed += 1
+        return True
+
+    def to_dict(self):
+        return collections.OrderedDict([('pps', self.rate), ('burst', self.burst),
+            ('passed', self.passed), ('dropped', self.dropped)])
+
+
+class QosConfig(object):
+
+    def __init__(self, config):
+        self.scheduler = config.get('scheduler', 'strict')
+        if self.scheduler not in QOS_SCHEDULERS:
+            raise ValueError('unknown scheduler: ' + str(self.scheduler))
+        self.queue_length = int(config.get('queue_length', QOS_DEFAULT_QUEUE_LENGTH))
+        self.weights = [int(w) for w in config.get('weights', QOS_DEFAULT_WEIGHTS)]
+        if len(self.weights) != QOS_PRIORITIES or min(self.weights) < 1:
+            raise ValueError('weights: ' + str(QOS_PRIORITIES) + ' values of at least 1')
+        self.spi_buckets = {}
+        self.spi_priorities = {}
+        for (spi, spi_config) in config.get('spi', {}).items():
+            if 'pps' in spi_config:
+                self.spi_buckets[int(spi)] = TokenBucket(spi_config['pps'], spi_config.get('burst'))
+            priority = int(spi_config.get('priority', QOS_DEFAULT_PRIORITY))
+            if not 0 <= priority < QOS_PRIORITIES:
+                raise ValueError('priority of SPI ' + str(spi) + ': 0 to ' + str(QOS_PRIORITIES - 1))
+            self.spi_priorities[int(spi)] = priority
+        self.sf_buckets = dict((name, TokenBucket(sf_config['pps'], sf_config.get('burst')))
+            for (name, sf_config) in config.get('sf', {}).items())
+
+
+class EgressQueues(object):
+    """One queue per priority in front of a socket"""
+
+    def __init__(self, sckt):
+        self.sckt = sckt
+        self.queues = [collections.deque() for i in range(QOS_PRIORITIES)]
+        self.deficits = [0] * QOS_PRIORITIES
+        self.sent = [0] * QOS_PRIORITIES
+        self.dropped = [0] * QOS_PRIORITIES
+        self.lock = threading.Lock()
+
+    def enqueue(self, frame, priority, queue_length):
+        queue = self.queues[priority]
+        if len(queue) >= queue_length:
+            self.dropped[priority] += 1
+            return False
+        queue.append(frame)
+        return True
+
+    def drain(self, config):
+        """Sends what is queued. If another loop is already sending, it
+        will also send what this one queued"""
+        while True:
+            if not self.lock.acquire(False):
+                return
+            try:
+                if config.scheduler == 'drr':
+                    self.drain_drr(config.weights)
+                else:
+                    self.drain_strict()
+            finally:
+                self.lock.release()
+            # Queued while the lock was being released
+            if not any(self.queues):
+                return
+
+    def drain_strict(self):
+        queues = self.queues
+        while True:
+            for priority in range(QOS_PRIORITIES):
+                if queues[priority]:
+                    break
+            else:
+                return
+            send_frame(self.sckt, queues[priority].popleft())
+            self.sent[priority] += 1
+
+    def drain_drr(self, weights):
+        queues = self.queues
+        while any(queues):
+            for priority in range(QOS_PRIORITIES):
+                queue = queues[priority]
+                if not queue:
+                    self.deficits[priority] = 0
+                    continue
+                self.deficits[priority] += QOS_DRR_QUANTUM * weights[priority]
+                while queue and len(queue[0]) <= self.deficits[priority]:
+                    frame = queue.popleft()
+                    self.deficits[priority] -= len(frame)
+                    send_frame(self.sckt, frame)
+                    self.sent[priority] += 1
+
+    def to_dict(self):
+        return collections.OrderedDict([('queued', [len(q) for q in self.queues]),
+            ('sent', self.sent), ('dropped', self.dropped)])
+
+
+def send_frame(sckt, frame):
+    while frame:
+        sent = sckt.send(frame)
+        frame = frame[sent:]
+
+
+def get_egress_queues(sckt):
+    queues = egress_queues.get(sckt)
+    if queues is None:
+        with egress_queues_lock:
+            queues = egress_queues.setdefault(sckt, EgressQueues(sckt))
+    return queues
+
+
+def get_template_spi(session_template):
+    """SPI of the NSH header of a session template"""
+    nsh_offset = 14 + (session_template[14] & 0x0F) * 4 + 8 + 8 + 14
+    return NSH_SPH_STRUCT.unpack_from(session_template, nsh_offset + 4)[0] >> 8
+
+
+def qos_enqueue(sckt, frame, nsh_spi, to_sf, sf_name=None):
+    """Admission and queueing of a frame, False if it is dropped. Frames
+    to the SF take a token of their replica, frames back to the SFF one of
+    their SPI"""
+    config = qos
+    if to_sf:
+        bucket = config.sf_buckets.get(sf_name) if sf_name is not None else None
+    else:
+        bucket = config.spi_buckets.get(nsh_spi)
+    if bucket is not None and not bucket.admit(qos_now):
+        return False
+    priority = config.spi_priorities.get(nsh_spi, QOS_DEFAULT_PRIORITY)
+    return get_egress_queues(sckt).enqueue(frame, priority, config.queue_length)
+
+
+def qos_begin_batch():
+    global qos_now
+    qos_now = time.monotonic()
+
+
+def qos_flush():
+    """Sends what is queued on every socket"""
+    config = qos
+    for queues in list(egress_queues.values()):
+        if config is None:
+            # QoS removed by a reload
+            with queues.lock:
+                for queue in queues.queues:
+                    while queue:
+                        send_frame(queues.sckt, queue.popleft())
+        elif any(queues.queues):
+            queues.drain(config)
+
+
+def qos_to_dict():
+    config = qos
+    if config is None:
+        return {'qos': None}
+    return {'scheduler': config.scheduler,
+            'spi': dict((str(spi), b.to_dict()) for (spi, b) in config.spi_buckets.items()),
+            'sf': dict((name, b.to_dict()) for (name, b) in config.sf_buckets.items()),
+            'queues': dict((socket_name(sckt), q.to_dict()) for (sckt, q) in list(egress_queues.items()))}
+
+
+def socket_name(sckt):
+    name = getattr(sckt, 'name', None)
+    if name is None:
+        name = sckt.getsockname()[0]
+    return name
+
 # ************************************************
 #  Loops for encapsulating / unencapsulating
 # ************************************************
@@ -620,7 +2596,7 @@ def macDb2str(mac_db):
         tmp_str += "   " + mac2str(key_mac) + " in " + str(socket_value.value) + "(" + str(socket_value.name) + ")\n"
     return tmp_str
 
-def unencapsulate_packet(frame):
+def unencapsulate_packet(frame, timestamp=None):
 
     (outer_eth_header, outer_eth_payload) = parse_ethernet(frame)
     outer_eth_header_nt = StructEthHeader(outer_eth_header)
@@ -649,7 +2625,11 @@ def unencapsulate_packet(frame):
                 eth_nsh_header_nt = StructEthHeader(eth_nsh_header)
 
                 (nsh_header, nsh_payload) = parse_nsh(eth_nsh_payload)
-                nsh_header_nt = StructNshHeader(nsh_header)
+                if nsh_header is None:
+                    pf("   Invalid NSH length, packet dropped")
+                    return
+                # Only the SPI is needed, no need to unpack the whole header
+                nsh_spi = NSH_SPH_STRUCT.unpack_from(nsh_header, 4)[0] >> 8
 
 
                 (inner_eth_header, inner_eth_payload) = parse_ethernet(nsh_payload)
@@ -676,7 +2656,7 @@ def unencapsulate_packet(frame):
                 #Build a key with mac/ip swapped
                 isReply=False
 
-                key = (eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port, tcp_src_port)
+                key = make_session_key(eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port, tcp_src_port)
                 pf("\n^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^")
                 pf("^^^ Receiving packet encapsulated ^^^")
                 pf("^^ " + ip2str(ip_src)+":"+str(tcp_src_port)+
@@ -687,18 +2667,30 @@ def unencapsulate_packet(frame):
 
                 global sessions
 
-                sessions[key]=(outer_eth_header,
-                                     ip_header,
-                                     udp_header,
-                                     vxlan_header,
-                                     eth_nsh_header,
-                                     nsh_header)
+                if not sessions.put(key, (outer_eth_header,
+                                          ip_header,
+                                          udp_header,
+                                          vxlan_header,
+                                          eth_nsh_header,
+                                          nsh_header), len(nsh_payload)):
+                    pf("   No room for the session, packet dropped", LOG_INFO)
+                    return
 
                 pf("   # of sessions: "+ str(len(sessions)))
 
 
                 new_pkt=nsh_payload
 
+                global track_tcp_offsets
+                if track_tcp_offsets:
+                    (inner_tcp_header_without_options, inner_tcp_options) = \
+                        make_tcp_segment_to_sf(inner_ip_header,
+                            inner_tcp_header_without_options,
+                            inner_tcp_options, inner_tcp_payload)
+                    new_pkt = inner_eth_header + inner_ip_header + \
+                              inner_tcp_header_without_options + \
+                              inner_tcp_options + inner_tcp_payload
+
                 pf("   Sending packet deencapsulated")
 
                 # Send all data
@@ -707,26 +2699,51 @@ def unencapsulate_packet(frame):
                 global mac_database
 
                 egress_socket = None
-
-                if eth_dst in mac_database:
-                    if mac_database[eth_dst] == Sockets.input_socket:
-                        egress_socket = sckt_unencap_out
-                        mac_database[eth_src] = Sockets.output_socket
-                        pf("   Dst mac in database. Leaving via 'out' interface")
-                    else:
-                        egress_socket = sckt_unencap_in
-                        mac_database[eth_src] = Sockets.input_socket
-                        pf("   Dst mac in database. Leaving via 'in' interface")
-                else:
-                    egress_socket = sckt_unencap_out
-                    mac_database[eth_src] = Sockets.output_socket
-                    mac_database[eth_dst] = Sockets.input_socket
+                sckt_out = sckt_unencap_out
+                sckt_in = sckt_unencap_in
+
+                replica_name = None
+                ring = get_replica_ring(nsh_spi)
+                if len(ring):
+                    flow = get_flow_replica(ring, inner_ip_header, inner_tcp_header_without_options)
+                    replica_name = flow.replica.name
+                    flow.replica.tx_packets += 1
+                    sckt_out = flow.replica.sckt_out
+                    sckt_in = flow.replica.sckt_in
+                    if flow.replica.mac is not None:
+                        new_pkt = make_frame_to_replica(new_pkt, flow, ip_src, tcp_src_port)
+                    pf("   Replica: " + flow.replica.name)
+
+                # An unknown dst mac is learnt at the 'in' side
+                (dst_socket, dst_inserted) = mac_database.get_or_insert(
+                    eth_dst, Sockets.input_socket)
+                if dst_inserted:
+                    egress_socket = sckt_out
+                    mac_database.put(eth_src, Sockets.output_socket)
                     pf("   Dst mac not in database. Leaving via 'out' interface")
+                elif dst_socket == Sockets.input_socket:
+                    egress_socket = sckt_out
+                    mac_database.put(eth_src, Sockets.output_socket)
+                    pf("   Dst mac in database. Leaving via 'out' interface")
+                else:
+                    egress_socket = sckt_in
+                    mac_database.put(eth_src, Sockets.input_socket)
+                    pf("   Dst mac in database. Leaving via 'in' interface")
+
+                if log_level >= LOG_DEBUG:
+                    pf("   ****")
+                    pf("   **** MAC database: ")
+                    pf(macDb2str(mac_database))
+                    pf("   ****")
 
-                pf("   ****")
-                pf("   **** MAC database: ")
-                pf(macDb2str(mac_database))
-                pf("   ****")
+                if timestamp is not None:
+                    latency_to_sf(key, latency_segment(inner_ip_header,
+                        inner_tcp_header_without_options), timestamp, nsh_spi, replica_name)
+
+                if qos is not None:
+                    if not qos_enqueue(egress_socket, new_pkt, nsh_spi, True, replica_name):
+                        pf("   Packet dropped by QoS")
+                    new_pkt = None
 
                 while new_pkt:
                     pf("   Length of packet: "+ str(len(new_pkt)))
@@ -736,7 +2753,7 @@ def unencapsulate_packet(frame):
 
 
 
-def encapsulate_request_packet(frame):
+def encapsulate_request_packet(frame, timestamp=None):
 
 
     (outer_eth_header, outer_eth_payload) = parse_ethernet(frame)
@@ -759,6 +2776,12 @@ def encapsulate_request_packet(frame):
             eth_src = getattr(outer_eth_header_nt, "eth_src")
             eth_type = getattr(outer_eth_header_nt, "eth_type")
 
+            if eth_dst in replica_macs:
+                replica_macs[eth_dst].rx_packets += 1
+                frame = make_frame_from_replica(frame, ip_header, tcp_header_without_options)
+                outer_eth_header = frame[:14]
+                eth_dst = frame[:6]
+
             ip_dst = getattr(ip_header_nt, "ip_dst")
             ip_src = getattr(ip_header_nt, "ip_src")
 
@@ -766,7 +2789,7 @@ def encapsulate_request_packet(frame):
             tcp_src_port = getattr(tcp_header_nt, "tcp_src_port")
 
 
-            key = (eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port, tcp_src_port)
+            key = make_session_key(eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port, tcp_src_port)
 
             pf("\nvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv")
             pf("vvv Receiving packet unencapsulated  (In) vvv")
@@ -777,36 +2800,32 @@ def encapsulate_request_packet(frame):
             pf("   Length of packet: " + str(len(frame)))
 
 
-            if key in sessions:
+            # Headers already swapped, with the SI decremented
+            session_template = sessions.get_template(key, len(frame))
+            if session_template is not None:
                 pf("   Session found")
 
-                (new_outer_eth_header,
-                 new_ip_header,
-                 new_udp_header,
-                 new_vxlan_header,
-                 new_eth_nsh_header,
-                 new_nsh_header) = sessions[key]
+                if timestamp is not None:
+                    latency_from_sf(key, latency_segment(ip_header, tcp_header_without_options),
+                        timestamp)
 
-                #Swap headers and send
+                if track_tcp_offsets:
+                    frame = outer_eth_header + ip_header + \
+                            make_tcp_segment_from_sf(ip_header,
+                                tcp_header_without_options) + \
+                            tcp_options + tcp_payload
 
-                new_outer_eth_header_swapped = make_ethernet_header_swap(new_outer_eth_header)
-                new_ip_header_swapped = make_ip_header_swap(new_ip_header)
-                new_nsh_header_decremented = make_nsh_decr_si(new_nsh_header)
 
-                new_eth_nsh_header_swapped = make_ethernet_header_swap(new_eth_nsh_header)
-
-
-                new_pkt = new_outer_eth_header_swapped + \
-                          new_ip_header_swapped + \
-                          new_udp_header + \
-                          new_vxlan_header + \
-                          new_eth_nsh_header_swapped + \
-                          new_nsh_header_decremented + \
-                          frame
+                new_pkt = make_encapsulated_frame(session_template, frame)
 
                 pf("   Sending packet encapsulated")
                 global sckt_encap
 
+                if qos is not None:
+                    if not qos_enqueue(sckt_encap, new_pkt, get_template_spi(session_template), False):
+                        pf("   Packet dropped by QoS")
+                    new_pkt = None
+
                 while new_pkt:
                     pf("   Length of packet: "+ str(len(new_pkt)))
                     sent = sckt_encap.send(new_pkt)
@@ -814,11 +2833,12 @@ def encapsulate_request_packet(frame):
                     pf("   Packet sent")
 
             else:
-                pf("   Packet received, not matching session")
-                exit(-1)
+                global unmatched_frames
+                unmatched_frames += 1
+                pf("   Packet received, not matching session, dropped")
 
 
-def encapsulate_reply_packet(frame):
+def encapsulate_reply_packet(frame, timestamp=None):
 
 
     (outer_eth_header, outer_eth_payload) = parse_ethernet(frame)
@@ -842,13 +2862,19 @@ def encapsulate_reply_packet(frame):
             eth_src = getattr(outer_eth_header_nt, "eth_src")
             eth_type = getattr(outer_eth_header_nt, "eth_type")
 
+            if eth_dst in replica_macs:
+                replica_macs[eth_dst].rx_packets += 1
+                frame = make_frame_from_replica(frame, ip_header, tcp_header_without_options)
+                outer_eth_header = frame[:14]
+                eth_dst = frame[:6]
+
             ip_dst = getattr(ip_header_nt, "ip_dst")
             ip_src = getattr(ip_header_nt, "ip_src")
 
             tcp_dst_port = getattr(tcp_header_nt, "tcp_dst_port")
             tcp_src_port = getattr(tcp_header_nt, "tcp_src_port")
 
-            key = (eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port, tcp_src_port)
+            key = make_session_key(eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port, tcp_src_port)
 
             pf("\nvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv")
             pf("vvv Receiving packet unencapsulated (Out) vvv")
@@ -858,36 +2884,32 @@ def encapsulate_reply_packet(frame):
             pf("vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv")
             pf("   Length of packet: " + str(len(frame)))
 
-            if key in sessions:
+            # Headers already swapped, with the SI decremented
+            session_template = sessions.get_template(key, len(frame))
+            if session_template is not None:
                 pf("   Session found")
 
-                (new_outer_eth_header,
-                 new_ip_header,
-                 new_udp_header,
-                 new_vxlan_header,
-                 new_eth_nsh_header,
-                 new_nsh_header) = sessions[key]
-
-                # Swap headers and send
+                if timestamp is not None:
+                    latency_from_sf(key, latency_segment(ip_header, tcp_header_without_options),
+                        timestamp)
 
-                new_outer_eth_header_swapped = make_ethernet_header_swap(new_outer_eth_header)
-                new_ip_header_swapped = make_ip_header_swap(new_ip_header)
-                new_nsh_header_decremented = make_nsh_decr_si(new_nsh_header)
+                if track_tcp_offsets:
+                    frame = outer_eth_header + ip_header + \
+                            make_tcp_segment_from_sf(ip_header,
+                                tcp_header_without_options) + \
+                            tcp_options + tcp_payload
 
-                new_eth_nsh_header_swapped = make_ethernet_header_swap(new_eth_nsh_header)
-
-                new_pkt = new_outer_eth_header_swapped + \
-                          new_ip_header_swapped + \
-                          new_udp_header + \
-                          new_vxlan_header + \
-                          new_eth_nsh_header_swapped + \
-                          new_nsh_header_decremented + \
-                          frame
+                new_pkt = make_encapsulated_frame(session_template, frame)
 
                 pf("   Sending packet encapsulated")
 
                 global sckt_encap
 
+                if qos is not None and len(new_pkt) < 4096:
+                    if not qos_enqueue(sckt_encap, new_pkt, get_template_spi(session_template), False):
+                        pf("   Packet dropped by QoS")
+                    new_pkt = None
+
                 while new_pkt:
                     pf("   Length of packet: "+ str(len(new_pkt)))
                     if len(new_pkt)>=4096 :
@@ -902,43 +2924,151 @@ def encapsulate_reply_packet(frame):
                         pf("   Packet sent")
 
             else:
-                pf("   Packet received, not matching session")
-                exit(-2)
+                global unmatched_frames
+                unmatched_frames += 1
+                pf("   Packet received, not matching session, dropped")
 
 
 # ************************************************
 #  Socket listeners
 # ************************************************
 
+def recv_batch(sckt, max_frames, timestamps=None):
+    """Waits for a frame, then takes up to max_frames already queued.
+    With a timestamps list, it is filled with their receive time in ns"""
+    if timestamps is not None:
+        return recv_batch_timestamped(sckt, max_frames, timestamps)
+    if low_latency:
+        frame, source = recv_spin(sckt.recvfrom, 65565)
+    else:
+        frame, source = sckt.recvfrom(65565)
+    frames = [frame]
+    while len(frames) < max_frames:
+        try:
+            frame, source = sckt.recvfrom(65565, socket.MSG_DONTWAIT)
+        except (BlockingIOError, socket.timeout):
+            break
+        frames.append(frame)
+    return frames
+
+
+def recv_batch_timestamped(sckt, max_frames, timestamps):
+    ancbufsize = socket.CMSG_SPACE(TIMESPEC_SIZE)
+    if low_latency:
+        (frame, ancdata, msg_flags, source) = recv_spin(sckt.recvmsg, 65565, ancbufsize)
+    else:
+        (frame, ancdata, msg_flags, source) = sckt.recvmsg(65565, ancbufsize)
+    frames = [frame]
+    timestamps.append(get_timestamp_ns(ancdata))
+    while len(frames) < max_frames:
+        try:
+            (frame, ancdata, msg_flags, source) = sckt.recvmsg(65565, ancbufsize,
+                socket.MSG_DONTWAIT)
+        except (BlockingIOError, socket.timeout):
+            break
+        frames.append(frame)
+        timestamps.append(get_timestamp_ns(ancdata))
+    return frames
+
+
+def process_batch(frames, timestamps, packet_function, histogram):
+    if qos is not None:
+        qos_begin_batch()
+    if timestamps is None:
+        for frame in frames:
+            packet_function(frame)
+    else:
+        for i in range(len(frames)):
+            packet_function(frames[i], timestamps[i] if measure_sf_latency else None)
+            histogram.add(time.time_ns() - timestamps[i])
+    if egress_queues:
+        qos_flush()
+
+
 def unencapsulating_loop():
 
     global sckt_encap
     global sckt_unencap_out
     global unencap_out_if
 
+    pin_current_thread()
+    histogram = get_latency_histogram(forwarding_latency, 'unencapsulating')
     while True:
-        frame, source = sckt_encap.recvfrom(65565)
-        unencapsulate_packet(frame)
+        timestamps = [] if timestamps_enabled() else None
+        frames = recv_batch(sckt_encap, batch_size, timestamps)
+        if verify_checksums:
+            (frames, timestamps) = filter_inner_checksums(frames, timestamps)
+        process_batch(frames, timestamps, unencapsulate_packet, histogram)
 
 
-def encapsulating_requests_loop():
+def encapsulating_requests_loop(replica=None):
 
     global sckt_unencap_in
     global encap_if
 
-    while True:
-        frame, source = sckt_unencap_in.recvfrom(65565)
-        encapsulate_request_packet(frame)
+    sckt = replica.sckt_in if replica is not None else sckt_unencap_in
+    pin_current_thread()
+    histogram = get_latency_histogram(forwarding_latency, 'encapsulating requests')
+    while replica is None or not replica.stopped:
+        timestamps = [] if timestamps_enabled() else None
+        try:
+            frames = recv_batch(sckt, batch_size, timestamps)
+        except socket.timeout:
+            continue
+        if replica is not None:
+            replica.rx_packets += len(frames)
+        process_batch(frames, timestamps, encapsulate_request_packet, histogram)
+    sckt.close()
 
 
-def encapsulating_replies_loop():
+def encapsulating_replies_loop(replica=None):
 
     global sckt_unencap_out
     global encap_if
 
+    sckt = replica.sckt_out if replica is not None else sckt_unencap_out
+    pin_current_thread()
+    histogram = get_latency_histogram(forwarding_latency, 'encapsulating replies')
+    while replica is None or not replica.stopped:
+        timestamps = [] if timestamps_enabled() else None
+        try:
+            frames = recv_batch(sckt, batch_size, timestamps)
+        except socket.timeout:
+            continue
+        if replica is not None:
+            replica.rx_packets += len(frames)
+        process_batch(frames, timestamps, encapsulate_reply_packet, histogram)
+    sckt.close()
+
+
+def replica_health_loop():
+    while True:
+        time.sleep(REPLICA_HEALTH_INTERVAL)
+        check_replicas_health()
+
+
+def expiry_loop():
+
+    global sessions
+    global mac_database
+    global tcp_offsets
+
     while True:
-        frame, source = sckt_unencap_out.recvfrom(65565)
-        encapsulate_reply_packet(frame)
+        time.sleep(session_timeout / 2)
+        evicted = expire_entries()
+        if evicted:
+            pf("   Expired sessions: " + str(evicted), LOG_INFO)
+
+
+def expire_entries():
+    """Removes what is older than session_timeout, returns the number of
+    sessions removed"""
+    evicted = sessions.evict_expired(session_timeout)
+    mac_database.evict_expired(session_timeout)
+    tcp_offsets.evict_expired(session_timeout)
+    flow_replicas.evict_expired(session_timeout)
+    latency_windows.evict_expired(session_timeout)
+    return evicted
 
 
 def setup_sockets():
@@ -960,14 +3090,1545 @@ def setup_sockets():
     sckt_unencap_in = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003))
     sckt_unencap_in.bind((unencap_in_if, 0))
 
+    for sckt in (sckt_encap, sckt_unencap_out, sckt_unencap_in):
+        setup_socket(sckt)
+
+    setup_replicas_sockets()
+
+
+def setup_replicas_sockets(make_socket_pair=None, replicas=None):
+    """Replicas without interfaces of their own (MAC mode) share the
+    default ones. make_socket_pair(replica) returns (sckt_in, sckt_out)"""
+
+    global replica_macs
+
+    if replicas is None:
+        replicas = all_replicas()
+    for replica in replicas:
+        if replica.sckt_in is not None:
+            continue
+        if replica.in_if is None:
+            replica.sckt_in = sckt_unencap_in
+            replica.sckt_out = sckt_unencap_out
+        elif make_socket_pair is not None:
+            (replica.sckt_in, replica.sckt_out) = make_socket_pair(replica)
+        else:
+            replica.sckt_out = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003))
+            replica.sckt_out.bind((replica.out_if, 0))
+            replica.sckt_in = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003))
+            replica.sckt_in.bind((replica.in_if, 0))
+            setup_socket(replica.sckt_out)
+            setup_socket(replica.sckt_in)
+        if replica.mac is not None:
+            replica_macs[replica.mac] = replica
+
+
+# ************************************************
+#  In-memory sockets
+# ************************************************
+
+class MemorySocket(object):
+    """In-process replacement of an AF_PACKET socket. Frames sent on one end
+    of a pair are received on the other end, like in a veth pair"""
+
+    def __init__(self, name):
+        self.name = name
+        self.rx = queue.Queue()
+        self.peer = None
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        pass
+
+    def setsockopt(self, level, option, value):
+        pass
+
+    def send(self, frame):
+        # Stamped on arrival, like the kernel does
+        self.peer.rx.put((bytes(frame), time.time_ns()))
+        return len(frame)
+
+    def _get(self, flags):
+        try:
+            if flags & socket.MSG_DONTWAIT:
+                return self.rx.get_nowait()
+            return self.rx.get(timeout=self.timeout)
+        except queue.Empty:
+            if flags & socket.MSG_DONTWAIT:
+                raise BlockingIOError()
+            raise socket.timeout()
+
+    def recvfrom(self, bufsize, flags=0):
+        (frame, timestamp) = self._get(flags)
+        return frame[:bufsize], (self.name, 0)
+
+    def recvmsg(self, bufsize, ancbufsize=0, flags=0):
+        (frame, timestamp) = self._get(flags)
+        ancdata = [(socket.SOL_SOCKET, SCM_TIMESTAMPNS, struct.pack(TIMESPEC_FMT,
+            timestamp // 1000000000, timestamp % 1000000000))]
+        return frame[:bufsize], ancdata, 0, (self.name, 0)
+
+
+def make_memory_socket_pair(name1, name2):
+    end1 = MemorySocket(name1)
+    end2 = MemorySocket(name2)
+    end1.peer = end2
+    end2.peer = end1
+    return end1, end2
+
+
+def setup_memory_sockets():
+    """Run the proxy without interfaces. The SF is emulated by a pair
+    forwarding 'out' to 'in' and back, unmodified. Returns the end of the
+    encapsulated side the SFF (e.g. the generator) has to use"""
+
+    global sckt_encap
+    global sckt_unencap_in
+    global sckt_unencap_out
+
+    (sckt_encap, sff_end) = make_memory_socket_pair('encap', 'sff')
+    (sckt_unencap_out, sckt_unencap_in) = make_memory_socket_pair(
+        'unencap_out', 'unencap_in')
+
+    def make_replica_socket_pair(replica):
+        (sckt_out, sckt_in) = make_memory_socket_pair(
+            replica.out_if, replica.in_if)
+        return sckt_in, sckt_out
+    setup_replicas_sockets(make_replica_socket_pair)
+    return sff_end
+
+
+def start_loops(daemon=False):
+    threads = [
+        threading.Thread(target=unencapsulating_loop, name="unencapsulating thread"),
+        threading.Thread(target=encapsulating_replies_loop, name="encapsulating replies thread"),
+        threading.Thread(target=encapsulating_requests_loop, name="encapsulating requests thread")]
+    for replica in all_replicas():
+        threads.extend(make_replica_loops(replica))
+    if low_latency and len(set(low_latency_cpus)) < len(threads):
+        pf("   Fewer --cpus than loops (" + str(len(threads)) + "), spinning loops will compete", LOG_INFO)
+    threads.append(threading.Thread(target=replica_health_loop, name="replica health thread"))
+    if session_timeout:
+        threads.append(threading.Thread(target=expiry_loop, name="expiry thread"))
+    if low_latency:
+        threads.append(threading.Thread(target=freeze_gc_loop, name="GC freeze thread"))
+    for t in threads:
+        t.daemon = daemon
+        t.start()
+    return threads
+
+
+def make_replica_loops(replica):
+    # The default sockets already have their loops
+    if replica.in_if is None or replica.sckt_in is sckt_unencap_in:
+        return []
+    replica.sckt_in.settimeout(REPLICA_STOP_INTERVAL)
+    replica.sckt_out.settimeout(REPLICA_STOP_INTERVAL)
+    return [threading.Thread(target=encapsulating_requests_loop,
+                args=(replica,), name="encapsulating requests thread " + replica.name),
+            threading.Thread(target=encapsulating_replies_loop,
+                args=(replica,), name="encapsulating replies thread " + replica.name)]
+
+
+# ************************************************
+#  Offline mode
+# ************************************************
+
+"""
+proxy.py --offline in.pcap out.pcap runs the packet functions over a
+capture instead of interfaces, without root. Every frame of in.pcap is
+taken as received on the encapsulated interface, what the proxy sends to
+the SF comes back from it unmodified (like with setup_memory_sockets), and
+the frames sent back to the SFF are written to out.pcap with the
+timestamp of the input frame they come from. --offline_sf writes the
+frames sent to the SF too.
+
+Frames go through generators one at a time, so the memory used does not
+depend on the size of the capture, only on the sessions (--max_sessions,
+--session_timeout). It is a single thread, which also gives the
+throughput of the packet functions on one core.
+"""
+
+# Virtual interface where a frame sent on one comes back from the SF.
+# Replicas with interfaces of their own add theirs, mapped to the default
+# interface with the same role
+OFFLINE_SF_PEER = {'unencap_out': 'unencap_in', 'unencap_in': 'unencap_out'}
+
+
+class OfflineSocket(object):
+    """Queues what the packet functions send, with the interface name"""
+
+    def __init__(self, name, sent):
+        self.name = name
+        self.sent = sent
+
+    def setsockopt(self, level, option, value):
+        pass
+
+    def send(self, frame):
+        self.sent.append((self.name, bytes(frame)))
+        return len(frame)
+
+
+def setup_offline_sockets():
+    """Returns the queue of (interface, frame) sent by the proxy"""
+
+    global sckt_encap
+    global sckt_unencap_in
+    global sckt_unencap_out
+
+    sent = collections.deque()
+    sckt_encap = OfflineSocket('encap', sent)
+    sckt_unencap_out = OfflineSocket('unencap_out', sent)
+    sckt_unencap_in = OfflineSocket('unencap_in', sent)
+
+    def make_socket_pair(replica):
+        OFFLINE_SF_PEER[replica.name + '_out'] = OFFLINE_SF_PEER['unencap_out']
+        OFFLINE_SF_PEER[replica.name + '_in'] = OFFLINE_SF_PEER['unencap_in']
+        return (OfflineSocket(replica.name + '_in', sent),
+            OfflineSocket(replica.name + '_out', sent))
+
+    setup_replicas_sockets(make_socket_pair)
+    return sent
+
+
+def process_offline_frame(frame, packet_function):
+    # A capture can hold anything: a frame the packet function cannot
+    # parse is dropped and counted, the run goes on
+    global malformed_frames
+    try:
+        process_batch([frame], None, packet_function, None)
+    except (struct.error, IndexError, ValueError) as e:
+        malformed_frames += 1
+        pf("   Malformed frame dropped: " + repr(e), LOG_INFO)
+
+
+def offline_pipeline(frames, sent):
+    """(timestamp, frame) received on the encapsulated interface ->
+    (timestamp, interface, frame) sent by the proxy, in order"""
+    for (timestamp, frame) in frames:
+        if verify_checksums:
+            (checked, timestamps) = filter_inner_checksums([frame], None)
+            if not checked:
+                continue
+        process_offline_frame(frame, unencapsulate_packet)
+        while sent:
+            (interface, frame_sent) = sent.popleft()
+            yield timestamp, interface, frame_sent
+            peer = OFFLINE_SF_PEER.get(interface)
+            if peer == 'unencap_in':
+                process_offline_frame(frame_sent, encapsulate_request_packet)
+            elif peer == 'unencap_out':
+                process_offline_frame(frame_sent, encapsulate_reply_packet)
+
+
+class OfflineStats(object):
+
+    def __init__(self):
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_to_sf = 0
+        self.frames_out = 0
+        self.frames_dropped = 0
+        self.start = time.perf_counter()
+        self.end = self.start
+
+    def __str__(self):
+        elapsed = max(self.end - self.start, 1e-9)
+        return ('frames_in(' + str(self.frames_in) + ') bytes_in(' + str(self.bytes_in)
+            + ') frames_to_sf(' + str(self.frames_to_sf) + ') frames_out(' + str(self.frames_out)
+            + ') frames_dropped(' + str(self.frames_dropped)
+            + ') seconds(' + '%.3f' % elapsed + ') pps(' + str(int(self.frames_in / elapsed)) + ')')
+
+
+def offline_main(in_file, out_file, sf_file=None):
+    stats = OfflineStats()
+
+    def count(frames):
+        for (timestamp, frame) in frames:
+            stats.frames_in += 1
+            stats.bytes_in += len(frame)
+            yield timestamp, frame
+
+    reader = PcapReader(in_file)
+    writer = PcapWriter(out_file)
+    sf_writer = PcapWriter(sf_file) if sf_file is not None else None
+    sent = setup_offline_sockets()
+    malformed_start = malformed_frames
+    try:
+        for (timestamp, interface, frame) in offline_pipeline(count(reader), sent):
+            if interface == 'encap':
+                stats.frames_out += 1
+                writer.write(frame, timestamp)
+            else:
+                stats.frames_to_sf += 1
+                if sf_writer is not None:
+                    sf_writer.write(frame, timestamp)
+    finally:
+        stats.frames_dropped = malformed_frames - malformed_start
+        stats.end = time.perf_counter()
+        reader.close()
+        writer.close()
+        if sf_writer is not None:
+            sf_writer.close()
+    print(str(stats))
+    sys.stdout.flush()
+    return 0
+
+# ************************************************
+#  Configuration file
+# ************************************************
+
+"""
+JSON file with the replica pools, reloaded on SIGHUP or from the control
+socket:
+
+  {
+    "replicas": ["name=sf1,in=veth2,out=veth3", "name=sf2,in=veth4,out=veth5,weight=2"],
+    "spi_replicas": {"20": ["name=sf3,mac=02:00:00:00:00:03"]},
+    "qos": {...}
+  }
+
+(see the QoS section for "qos").
+
+Replicas with interfaces of their own are matched across reloads by
+their interfaces, the others by name and MAC: a matched replica keeps its
+sockets, loops and connections, and takes the new name, MAC and weight.
+An interface cannot be used by two replicas. Removed replicas stop
+receiving new frames, their connections move to the replicas left, and
+their loops end and close their sockets.
+
+Reloads, from SIGHUP or the control socket, run one at a time. Nothing
+changes if the file is not valid or a new interface cannot be opened.
+"""
+
+config_file = None
+config_lock = threading.Lock()
+
+
+def get_replica_match_key(replica):
+    if replica.in_if is None:
+        return ('mac', replica.name, replica.mac)
+    return ('interfaces', replica.in_if, replica.out_if)
+
+
+def reload_config():
+    global replica_ring
+    global spi_replica_rings
+    global qos
+
+    with config_lock:
+        with open(config_file) as f:
+            config = json.load(f)
+        # Checked before anything changes
+        new_qos = QosConfig(config['qos']) if 'qos' in config else None
+        ring_specs = [config.get('replicas', [])] + list(config.get('spi_replicas', {}).values())
+        spis = [int(spi) for spi in config.get('spi_replicas', {})]
+        parsed = [[parse_replica_spec(spec) for spec in specs] for specs in ring_specs]
+
+        names = {}
+        interfaces = {}
+        for replica in [replica for replicas in parsed for replica in replicas]:
+            key = get_replica_match_key(replica)
+            if names.setdefault(key, replica.name) != replica.name:
+                raise ValueError('replicas ' + names[key] + ' and ' + replica.name
+                    + ' have the same interfaces')
+            for interface in (replica.in_if, replica.out_if):
+                if interface is None:
+                    continue
+                if interface in (encap_if, unencap_in_if, unencap_out_if):
+                    raise ValueError('interface ' + interface + ' is one of the proxy,'
+                        ' give the replica a mac instead')
+                if interfaces.setdefault(interface, key) != key:
+                    raise ValueError('interface ' + interface + ' used by two replicas')
+
+        # One replica per key, the one already running if there is one
+        existing = dict((get_replica_match_key(r), r) for r in all_replicas())
+        chosen = {}
+        new_replicas = []
+        for replica in [replica for replicas in parsed for replica in replicas]:
+            key = get_replica_match_key(replica)
+            if key not in chosen:
+                chosen[key] = existing.get(key, replica)
+                if chosen[key] is replica:
+                    new_replicas.append(replica)
+        try:
+            setup_replicas_sockets(replicas=new_replicas)
+        except Exception:
+            for replica in new_replicas:
+                if replica.in_if is not None:
+                    for sckt in (replica.sckt_in, replica.sckt_out):
+                        if sckt is not None:
+                            sckt.close()
+                if replica_macs.get(replica.mac) is replica:
+                    del replica_macs[replica.mac]
+            raise
+
+        # Nothing can fail from here on
+        for replica in [replica for replicas in parsed for replica in replicas]:
+            old = chosen[get_replica_match_key(replica)]
+            if old is not replica:
+                if old.mac != replica.mac:
+                    replica_macs.pop(old.mac, None)
+                (old.name, old.mac, old.weight) = (replica.name, replica.mac, replica.weight)
+                if old.mac is not None:
+                    replica_macs[old.mac] = old
+        for t in [t for replica in new_replicas for t in make_replica_loops(replica)]:
+            t.daemon = True
+            t.start()
+
+        def make_ring(replicas):
+            return ReplicaRing(chosen[get_replica_match_key(replica)] for replica in replicas)
+
+        replica_ring = make_ring(parsed[0])
+        spi_replica_rings = dict(zip(spis, [make_ring(replicas) for replicas in parsed[1:]]))
+
+        for (key, replica) in existing.items():
+            if key not in chosen:
+                replica.healthy = False
+                replica.stopped = True
+                if replica_macs.get(replica.mac) is replica:
+                    del replica_macs[replica.mac]
+
+        qos = new_qos
+        if qos is None:
+            qos_flush()
+        pf("Configuration reloaded: " + str(len(all_replicas())) + " replicas", LOG_INFO)
+
+
+def reload_config_logged(source):
+    """reload_config, returns why the configuration was not reloaded (the
+    old one is kept), None if it was"""
+    try:
+        reload_config()
+    except Exception as e:
+        # Whatever is wrong in the file must not take the proxy down
+        pf(source + ": configuration not reloaded: " + repr(e), LOG_INFO)
+        return repr(e)
+    return None
+
+
+def sighup_handler(signum, frame):
+    if config_file is None:
+        pf("SIGHUP: no configuration file to reload", LOG_INFO)
+        return
+    # In a thread: the handler may interrupt the main thread while it
+    # holds config_lock
+    threading.Thread(target=reload_config_logged, args=('SIGHUP', ),
+        name="reload thread", daemon=True).start()
+
+
+# ************************************************
+#  Control socket
+# ************************************************
+
+"""
+Unix stream socket taking one command per line and answering one JSON
+object per line, e.g. with: socat - UNIX-CONNECT:/run/sfc-proxy.sock
+
+  sessions [spi=N] [ip=A.B.C.D] [port=N] [limit=N] [cursor=S:P] [metadata=1]
+  macs
+  flush sessions [spi=N] [ip=A.B.C.D] [port=N]
+                     with their TCP offsets, replica choice and latency window
+  flush macs [mac=MAC]
+  replicas
+  log LEVEL          0 none, 1 info, 2 debug
+  batch N            frames taken from a socket per wake up
+  reload             same as SIGHUP
+  qos                token buckets and egress queues counters
+  latency            SF transit time per SPI and per replica (--sf_latency),
+                     forwarding latency per loop (--sf_latency or --low_latency)
+  stats
+
+It is served by its own thread, and session dumps go one shard at a time,
+so the packet threads are never stopped for long.
+"""
+
+CONTROL_DEFAULT_LIMIT = 100
+CONTROL_MAX_LIMIT = 10000
+
+
+def parse_session_key(key):
+    (eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port,
+        tcp_src_port) = struct.unpack('!6s6sH4s4sHH', key)
+    return eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port, tcp_src_port
+
+
+def make_session_match(params):
+    spi = int(params['spi']) if 'spi' in params else None
+    ip = socket.inet_aton(params['ip']) if 'ip' in params else None
+    port = int(params['port']) if 'port' in params else None
+    if spi is None and ip is None and port is None:
+        return None
+
+    def match(key, headers):
+        (eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port,
+            tcp_src_port) = parse_session_key(key)
+        if ip is not None and ip not in (ip_src, ip_dst):
+            return False
+        if port is not None and port not in (tcp_src_port, tcp_dst_port):
+            return False
+        if spi is not None and (struct.unpack('!L', headers[5][4:8])[0] >> 8) != spi:
+            return False
+        return True
+    return match
+
+
+def session_to_dict(key, headers, stats, metadata=False):
+    (eth_dst, eth_src, eth_type, ip_dst, ip_src, tcp_dst_port,
+        tcp_src_port) = parse_session_key(key)
+    nsh_sph = struct.unpack('!L', headers[5][4:8])[0]
+    session = collections.OrderedDict([
+        ('eth_src', mac2str(eth_src)), ('eth_dst', mac2str(eth_dst)),
+        ('ip_src', ip2str(ip_src)), ('ip_dst', ip2str(ip_dst)),
+        ('tcp_src_port', tcp_src_port), ('tcp_dst_port', tcp_dst_port),
+        ('nsh_spi', nsh_sph >> 8), ('nsh_si', nsh_sph & 0xFF),
+        ('outer_ip_src', ip2str(headers[1][12:16])),
+        ('outer_ip_dst', ip2str(headers[1][16:20]))])
+    if stats is not None:
+        for (name, value) in zip(('created', 'last_seen', 'pkts_to_sf',
+                'bytes_to_sf', 'pkts_from_sf', 'bytes_from_sf'), stats):
+            session[name] = value
+    if metadata:
+        session['nsh_md_type'] = get_nsh_layout(headers[5]).md_type
+        nsh_metadata = get_nsh_metadata(headers[5])
+        if nsh_metadata is not None and session['nsh_md_type'] == NSH_MD_TYPE_2:
+            nsh_metadata = [{'class': md_class, 'type': md_type, 'value': value.hex()}
+                for (md_class, md_type, value) in nsh_metadata]
+        session['nsh_metadata'] = nsh_metadata
+    return session
+
+
+def replica_to_dict(replica):
+    return collections.OrderedDict([
+        ('name', replica.name), ('in_if', replica.in_if), ('out_if', replica.out_if),
+        ('mac', mac2str(replica.mac) if replica.mac else None),
+        ('weight', replica.weight), ('healthy', replica.healthy),
+        ('tx_packets', replica.tx_packets), ('rx_packets', replica.rx_packets)])
+
+
+def control_command(words):
+    global log_level
+    global batch_size
+
+    command = words[0]
+    args = [w for w in words[1:] if '=' not in w]
+    params = dict(w.split('=', 1) for w in words[1:] if '=' in w)
+
+    if command == 'sessions':
+        cursor = (0, 0)
+        if 'cursor' in params:
+            cursor = tuple(int(x) for x in params['cursor'].split(':'))
+        limit = min(int(params.get('limit', CONTROL_DEFAULT_LIMIT)), CONTROL_MAX_LIMIT)
+        (found, next_cursor) = sessions.scan(cursor, limit, make_session_match(params))
+        metadata = params.get('metadata') == '1'
+        return {'sessions': [session_to_dict(*item, metadata=metadata) for item in found],
+                'cursor': '%d:%d' % next_cursor if next_cursor else None}
+
+    if command == 'macs':
+        return {'macs': dict((mac2str(mac), side.name) for (mac, side) in mac_database.items())}
+
+    if command == 'flush' and args == ['sessions']:
+        match = make_session_match(params)
+        if match is None:
+            flushed = len(sessions)
+            sessions.clear()
+            tcp_offsets.clear()
+            flow_replicas.clear()
+            latency_windows.clear()
+        else:
+            # forget_sessions drops the rest
+            flushed = sessions.evict_matching(match)
+        return {'flushed': flushed}
+
+    if command == 'flush' and args == ['macs']:
+        if 'mac' in params:
+            mac = bytes.fromhex(params['mac'].replace(':', ''))
+            return {'flushed': 1 if mac_database.evict(mac) is not None else 0}
+        flushed = len(mac_database)
+        mac_database.clear()
+        return {'flushed': flushed}
+
+    if command == 'replicas':
+        return {'replicas': [replica_to_dict(r) for r in replica_ring.replicas.values()],
+                'spi_replicas': dict((str(spi), [replica_to_dict(r) for r in ring.replicas.values()])
+                    for (spi, ring) in spi_replica_rings.items())}
+
+    if command == 'log' and len(args) == 1:
+        log_level = int(args[0])
+        return {'log': log_level}
+
+    if command == 'batch' and len(args) == 1 and int(args[0]) > 0:
+        batch_size = int(args[0])
+        return {'batch': batch_size}
+
+    if command == 'reload':
+        if config_file is None:
+            return {'error': 'no configuration file'}
+        error = reload_config_logged('reload')
+        if error is not None:
+            return {'error': error}
+        return {'reloaded': len(all_replicas())}
+
+    if command == 'qos':
+        return qos_to_dict()
+
+    if command == 'latency':
+        return {'spi': dict((str(spi), h.to_dict()) for (spi, h) in list(spi_latency.items())),
+                'replica': dict((name, h.to_dict()) for (name, h) in list(replica_latency.items())),
+                'forwarding': forwarding_latency_to_dict()}
+
+    if command == 'stats':
+        return {'sessions': len(sessions), 'slab_records': sessions.slab.used(),
+                'macs': len(mac_database), 'tcp_offsets': len(tcp_offsets),
+                'flow_replicas': len(flow_replicas), 'checksum_errors': checksum_errors,
+                'unmatched_frames': unmatched_frames, 'malformed_frames': malformed_frames,
+                'session_drops': sessions.dropped,
+                'log': log_level, 'batch': batch_size}
+
+    return {'error': 'unknown command: ' + ' '.join(words)}
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            words = line.decode(errors='replace').split()
+            if not words:
+                continue
+            try:
+                response = control_command(words)
+            except (ValueError, KeyError, OSError, struct.error) as e:
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+
+
+def start_control_socket(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socketserver.ThreadingUnixStreamServer(path, ControlHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="control thread")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# ************************************************
+#  Traffic generator
+# ************************************************
+
+"""
+Synthesises VxLAN-GPE/NSH encapsulated TCP flows as an SFF would send them:
+
+  outer Ethernet | IP | UDP 4790 | VxLAN-GPE | Ethernet (0x894F) | NSH | inner frame
+
+Every flow is a client -> server TCP connection. Phases:
+  handshake: SYN, SYN/ACK, ACK
+  data:      client data segment + server ACK, per data packet
+  fin:       FIN/ACK, FIN/ACK, ACK
+Both directions are encapsulated, because the SFF sends both through the SF.
+"""
+
+GEN_OUTER_MAC_SFF = b'\x02\x00\x00\x00\x01\x01'
+GEN_OUTER_MAC_PROXY = b'\x02\x00\x00\x00\x01\x02'
+GEN_OUTER_IP_SFF = socket.inet_aton('192.168.100.1')
+GEN_OUTER_IP_PROXY = socket.inet_aton('192.168.100.2')
+GEN_MAC_CLIENT = b'\x02\x00\x00\x00\x02\x01'
+GEN_MAC_SERVER = b'\x02\x00\x00\x00\x02\x02'
+GEN_IP_SERVER = socket.inet_aton('10.2.0.1')
+GEN_SERVER_PORT = 80
+# MD-type 2 context headers: a 4 byte and a 6 byte (padded) value
+GEN_NSH_TLVS = [(0x0101, 0x01, b'\x00\x00\x00\x2a'), (0x0101, 0x02, b'tenant')]
+
+TCP_FLAG_FIN = 0x01
+TCP_FLAG_SYN = 0x02
+TCP_FLAG_PSH = 0x08
+TCP_FLAG_ACK = 0x10
+
+
+def make_tcp_frame(eth_src, eth_dst, ip_src, ip_dst, tcp_src_port, tcp_dst_port,
+        seq, ack, flags, payload):
+    tcp_header_nt = StructTcpHeaderWithoutOptions(bytes(20))._replace(
+        tcp_src_port=tcp_src_port,
+        tcp_dst_port=tcp_dst_port,
+        tcp_seq_number=seq & 0xFFFFFFFF,
+        tcp_ack=ack & 0xFFFFFFFF,
+        tcp_byte_data_offset=5 << 4,
+        tcp_flags=flags,
+        tcp_win_size=65535)
+    ip_header_nt = StructIpHeader(bytes(20))._replace(
+        ip_ver_ihl_type=0x4500,
+        ip_time2live=64,
+        ip_protocol=6,
+        ip_src=ip_src,
+        ip_dst=ip_dst)
+    eth_header_nt = StructEthHeader(bytes(14))._replace(
+        eth_dst=eth_dst, eth_src=eth_src, eth_type=0x0800)
+    return eth_header_nt.pack() + make_ip_package(ip_header_nt.pack(),
+        tcp_header_nt.pack(), b'', payload)
+
+
+def make_vxlan_gpe_nsh_frame(nsh_spi, nsh_si, udp_src_port, inner_frame, md_type=NSH_MD_TYPE_1):
+    (inner_eth_header, inner_eth_payload) = parse_ethernet(inner_frame)
+    if md_type == NSH_MD_TYPE_2:
+        nsh_header = make_nsh_mdtype2(nsh_spi, nsh_si, GEN_NSH_TLVS)
+    else:
+        nsh_header = make_nsh_mdtype1(nsh_spi, nsh_si)
+    nsh_packet = (make_outer_ethernet_nsh_header(inner_eth_header)
+        + nsh_header + inner_frame)
+
+    vxlan_header_nt = StructVxLanGPEHeader(bytes(8))._replace(
+        vxlan_flags=0x0C, # I and P flags
+        next_proto=0x3, # Ethernet
+        vni=nsh_spi.to_bytes(3, byteorder='big'))
+    udp_payload = vxlan_header_nt.pack() + nsh_packet
+    udp_header_nt = StructUdpHeader(bytes(8))._replace(
+        udp_src_port=udp_src_port,
+        udp_dst_port=4790,
+        udp_data_length=8 + len(udp_payload))
+    ip_payload = udp_header_nt.pack() + udp_payload
+
+    ip_header_nt = StructIpHeader(bytes(20))._replace(
+        ip_ver_ihl_type=0x4500,
+        ip_time2live=64,
+        ip_protocol=17,
+        ip_src=GEN_OUTER_IP_SFF,
+        ip_dst=GEN_OUTER_IP_PROXY)
+    ip_header = make_ip_header(ip_header_nt.pack(), 20 + len(ip_payload))
+    outer_eth_header_nt = StructEthHeader(bytes(14))._replace(
+        eth_dst=GEN_OUTER_MAC_PROXY, eth_src=GEN_OUTER_MAC_SFF, eth_type=0x0800)
+    return outer_eth_header_nt.pack() + ip_header + ip_payload
+
+
+def generate_flow_frames(flow_index, nsh_spi, nsh_si, sizes, data_packets, phases,
+        md_type=NSH_MD_TYPE_1):
+    """Yields the encapsulated frames of one TCP connection"""
+    ip_client = struct.pack('!BBH', 10, 1, flow_index & 0xFFFF)
+    port_client = 1024 + flow_index % 64000
+    udp_src_port = 49152 + flow_index % 16384
+    seq_client = (flow_index * 7919) & 0xFFFFFFFF
+    seq_server = (flow_index * 104729) & 0xFFFFFFFF
+
+    def c2s(flags, payload=b''):
+        return make_vxlan_gpe_nsh_frame(nsh_spi, nsh_si, udp_src_port,
+            make_tcp_frame(GEN_MAC_CLIENT, GEN_MAC_SERVER, ip_client, GEN_IP_SERVER,
+                port_client, GEN_SERVER_PORT, seq_client, seq_server, flags, payload),
+            md_type)
+
+    def s2c(flags, payload=b''):
+        return make_vxlan_gpe_nsh_frame(nsh_spi, nsh_si, udp_src_port,
+            make_tcp_frame(GEN_MAC_SERVER, GEN_MAC_CLIENT, GEN_IP_SERVER, ip_client,
+                GEN_SERVER_PORT, port_client, seq_server, seq_client, flags, payload),
+            md_type)
+
+    if 'handshake' in phases:
+        yield c2s(TCP_FLAG_SYN)
+        seq_client += 1
+        yield s2c(TCP_FLAG_SYN | TCP_FLAG_ACK)
+        seq_server += 1
+        yield c2s(TCP_FLAG_ACK)
+
+    if 'data' in phases:
+        for i in range(data_packets):
+            size = sizes[(flow_index + i) % len(sizes)]
+            yield c2s(TCP_FLAG_PSH | TCP_FLAG_ACK, bytes(size))
+            seq_client += size
+            yield s2c(TCP_FLAG_ACK)
+
+    if 'fin' in phases:
+        yield c2s(TCP_FLAG_FIN | TCP_FLAG_ACK)
+        seq_client += 1
+        yield s2c(TCP_FLAG_FIN | TCP_FLAG_ACK)
+        seq_server += 1
+        yield c2s(TCP_FLAG_ACK)
+
+
+def generate_traffic(flows, spi_si_list, sizes, data_packets, phases, md_type=NSH_MD_TYPE_1,
+        first_flow=0):
+    """Interleaves the frames of all flows round-robin, building each frame
+    only when it is needed"""
+    active = collections.deque(
+        generate_flow_frames(first_flow + i, spi_si_list[i % len(spi_si_list)][0],
+            spi_si_list[i % len(spi_si_list)][1], sizes, data_packets, phases, md_type)
+        for i in range(flows))
+    while active:
+        flow = active.popleft()
+        frame = next(flow, None)
+        if frame is not None:
+            active.append(flow)
+            yield frame
+
+
+class GeneratorStats(object):
+
+    def __init__(self):
+        self.tx_packets = 0
+        self.tx_bytes = 0
+        self.rx_packets = 0
+        self.rx_bytes = 0
+        self.rx_wrong_si = 0
+        self.tx_start = None
+        self.tx_end = None
+        self.rx_end = None
+
+    def __str__(self):
+        tx_time = (self.tx_end or 0) - (self.tx_start or 0)
+        rx_time = (self.rx_end or 0) - (self.tx_start or 0)
+        return ("tx_packets(" + str(self.tx_packets) + ") tx_bytes(" + str(self.tx_bytes)
+            + ") tx_pps(" + str(int(self.tx_packets / tx_time) if tx_time > 0 else 0)
+            + ") rx_packets(" + str(self.rx_packets) + ") rx_bytes(" + str(self.rx_bytes)
+            + ") rx_pps(" + str(int(self.rx_packets / rx_time) if rx_time > 0 else 0)
+            + ") lost(" + str(self.tx_packets - self.rx_packets)
+            + ") rx_wrong_si(" + str(self.rx_wrong_si) + ")")
+
+
+def generator_receive(sckt, stats, sent_si, done, idle_timeout):
+    # Frames come back with the Service Index decremented by the proxy
+    sckt.settimeout(idle_timeout)
+    while True:
+        try:
+            frame, source = sckt.recvfrom(65565)
+        except socket.timeout:
+            if done.is_set():
+                return
+            continue
+        # Own frames looped back by the kernel
+        if len(source) > 2 and source[2] == socket.PACKET_OUTGOING:
+            continue
+        stats.rx_packets += 1
+        stats.rx_bytes += len(frame)
+        stats.rx_end = time.perf_counter()
+        nsh_offset = 14 + 20 + 8 + 8 + 14
+        if len(frame) >= nsh_offset + NSH_BASE_LENGTH:
+            nsh_header_nt = StructNshBaseHeader(frame[nsh_offset:nsh_offset + NSH_BASE_LENGTH])
+            if sent_si.get(nsh_header_nt.get_nsh_spi()) != nsh_header_nt.get_nsh_si() + 1:
+                stats.rx_wrong_si += 1
+
+
+def run_generator(frames, sckt, pps, sent_si, idle_timeout):
+    stats = GeneratorStats()
+    done = threading.Event()
+    receiver = threading.Thread(target=generator_receive, name="generator receiver",
+        args=(sckt, stats, sent_si, done, idle_timeout), daemon=True)
+    receiver.start()
+
+    stats.tx_start = time.perf_counter()
+    try:
+        for frame in frames:
+            if pps:
+                delay = stats.tx_start + stats.tx_packets / pps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sckt.send(frame)
+            stats.tx_packets += 1
+            stats.tx_bytes += len(frame)
+        stats.tx_end = time.perf_counter()
+    finally:
+        done.set()
+    receiver.join()
+    return stats
+
+
+def parse_spi_si_list(value):
+    spi_si_list = []
+    for item in value.split(','):
+        (spi, si) = item.split(':')
+        spi_si_list.append((int(spi), int(si)))
+    return spi_si_list
+
+
+def generator_main(argv):
+    parser = argparse.ArgumentParser(description='Generate VxLAN-GPE/NSH traffic'
+                                                 ' to load test the proxy',
+                                     prog='proxy.py generate',
+                                     usage='%(prog)s [options]',
+                                     add_help=True)
+
+    parser.add_argument('-o', '--output', choices=['memory', 'veth', 'pcap'],
+                        default='memory',
+                        help='Send to an in-process proxy, to an interface or to a pcap file')
+    parser.add_argument('-i', '--interface',
+                        help='Interface connected to the encap interface of the proxy (veth)')
+    parser.add_argument('-w', '--pcap_file',
+                        help='File to write the traffic to (pcap)')
+    parser.add_argument('-f', '--flows', type=int, default=10,
+                        help='Number of TCP flows')
+    parser.add_argument('-n', '--data_packets', type=int, default=10,
+                        help='Number of data packets per flow')
+    parser.add_argument('-s', '--sizes', default='64,512,1400',
+                        help='Comma separated TCP payload sizes, used in turns')
+    parser.add_argument('-p', '--spi_si', default='10:255',
+                        help='Comma separated SPI:SI values, used in turns by the flows')
+    parser.add_argument('--phases', default='handshake,data,fin',
+                        help='Comma separated phases of each flow: handshake, data, fin')
+    parser.add_argument('-r', '--pps', type=float, default=0,
+                        help='Target packets per second, 0 sends as fast as possible')
+    parser.add_argument('--idle_timeout', type=float, default=1.0,
+                        help='Seconds to wait for returning traffic after the last packet')
+    parser.add_argument('--md_type', type=int, choices=[NSH_MD_TYPE_1, NSH_MD_TYPE_2],
+                        default=NSH_MD_TYPE_1, help='NSH MD-type, 2 adds two context TLVs')
+    parser.add_argument('--replicas', type=int, default=1,
+                        help='Number of SF replicas of the in-process proxy')
+    parser.add_argument('--sf_latency', action='store_true',
+                        help='Measure the SF transit time in the in-process proxy')
+    parser.add_argument('--low_latency', '--low-latency', action='store_true',
+                        help='Run the in-process proxy in low latency mode')
+    parser.add_argument('--cpus', type=parse_cpu_list, default=[],
+                        help='Cores for the in-process proxy loops with --low_latency')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print the debugging output of the in-process proxy')
+
+    args = parser.parse_args(argv)
+
+    spi_si_list = parse_spi_si_list(args.spi_si)
+    sizes = [int(x) for x in args.sizes.split(',')]
+    phases = args.phases.split(',')
+    frames = generate_traffic(args.flows, spi_si_list, sizes, args.data_packets, phases,
+        args.md_type)
+
+    if args.output == 'pcap':
+        if args.pcap_file is None:
+            parser.print_help()
+            return -1
+        writer = PcapWriter(args.pcap_file)
+        count = 0
+        for frame in frames:
+            writer.write(frame)
+            count += 1
+        writer.close()
+        pf("Written " + str(count) + " frames to " + args.pcap_file, LOG_INFO)
+        return 0
+
+    if args.output == 'veth':
+        if args.interface is None:
+            parser.print_help()
+            return -1
+        global local_mac_if
+        local_mac_if = args.interface
+        sckt = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003))
+        sckt.bind((args.interface, 0))
+    else:
+        global log_level
+        global replica_ring
+        global measure_sf_latency
+        global low_latency
+        global low_latency_cpus
+        log_level = LOG_DEBUG if args.verbose else LOG_NONE
+        measure_sf_latency = args.sf_latency
+        low_latency = args.low_latency
+        low_latency_cpus = args.cpus
+        if args.replicas > 1:
+            replica_ring = ReplicaRing(SfReplica('sf' + str(i),
+                in_if='sf' + str(i) + '_in', out_if='sf' + str(i) + '_out')
+                for i in range(args.replicas))
+        sckt = setup_memory_sockets()
+        start_loops(daemon=True)
+
+    stats = run_generator(frames, sckt, args.pps, dict(spi_si_list), args.idle_timeout)
+    print(str(stats))
+    for replica in replica_ring.replicas.values():
+        print(str(replica))
+    for (spi, histogram) in sorted(spi_latency.items()):
+        print('SF latency SPI ' + str(spi) + ': ' + json.dumps(histogram.to_dict()))
+    for (name, histogram) in sorted(replica_latency.items()):
+        print('SF latency ' + name + ': ' + json.dumps(histogram.to_dict()))
+    for (name, histogram) in sorted(forwarding_latency.items()):
+        if histogram.count:
+            print('Forwarding latency ' + name + ': ' + json.dumps(histogram.to_dict()))
+    sys.stdout.flush()
+    return 0
+
+
+# ************************************************
+#  Microbenchmarks
+# ************************************************
+
+"""
+proxy.py bench times each packet helper on its own, on a frame built by
+the traffic generator, and compares with a baseline JSON file
+(bench_baseline.json next to proxy.py, --update rewrites it):
+
+  ns_per_op           best of BENCH_REPEAT runs, minus the cost of the loop
+  alloc_bytes_per_op  peak of the memory allocated while doing one op
+                      (tracemalloc), temporary objects included
+  blocks_per_op       memory blocks still allocated after each op, leaks
+
+A metric worse than its baseline by more than --tolerance (a fraction)
+is a regression and the exit code is 1. Allocation metrics are stable,
+times are not: a time over the limit is measured again, up to
+BENCH_CONFIRM_ROUNDS times, and only a time that stays over it, best of
+all the runs, is a regression. Times also depend on the machine: the
+baseline has to come from the machine running the comparison, run
+proxy.py bench --update there first. The baseline keeps the host name,
+times from another host are not compared.
+"""
+
+BENCH_DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'bench_baseline.json')
+BENCH_DEFAULT_TOLERANCE = 0.25
+BENCH_SESSION_SIZES = [1000, 100000, 1000000]
+BENCH_MIN_TIME = 0.2
+BENCH_REPEAT = 5
+BENCH_CONFIRM_ROUNDS = 3
+BENCH_ALLOC_OPS = 200
+BENCH_WARMUP_OPS = 5000
+# Below these, differences are noise
+BENCH_MIN_NS_DELTA = 20
+BENCH_MIN_BYTES_DELTA = 64
+BENCH_MIN_BLOCKS_DELTA = 0.05
+
+
+def make_bench_session_keys(count):
+    return [make_session_key(GEN_MAC_SERVER, GEN_MAC_CLIENT, 0x0800, GEN_IP_SERVER,
+        struct.pack('!BBH', 10, 1 + (i >> 16), i & 0xFFFF), GEN_SERVER_PORT, 1024 + i % 64000)
+        for i in range(count)]
+
+
+def make_benchmarks(session_sizes):
+    """List of (name, function doing one op)"""
+    inner_frame = make_tcp_frame(GEN_MAC_CLIENT, GEN_MAC_SERVER, b'\x0a\x01\x00\x01',
+        GEN_IP_SERVER, 1024, GEN_SERVER_PORT, 1000, 2000, TCP_FLAG_PSH | TCP_FLAG_ACK, bytes(512))
+    frame = make_vxlan_gpe_nsh_frame(10, 255, 49152, inner_frame)
+
+    (outer_eth_header, outer_eth_payload) = parse_ethernet(frame)
+    (ip_header, ip_payload) = parse_ip(outer_eth_payload)
+    (udp_header, udp_payload) = parse_udp(ip_payload)
+    (vxlan_header, vxlan_payload) = parse_vxlan_gpe(udp_payload)
+    (eth_nsh_header, eth_nsh_payload) = parse_ethernet(vxlan_payload)
+    (nsh_header, nsh_payload) = parse_nsh(eth_nsh_payload)
+    (inner_eth_header, inner_eth_payload) = parse_ethernet(nsh_payload)
+    (inner_ip_header, inner_ip_payload) = parse_ip(inner_eth_payload)
+    (tcp_header, tcp_options, tcp_payload) = parse_tcp(inner_ip_payload)
+    tcp_header_nt = StructTcpHeaderWithoutOptions(tcp_header)
+
+    benchmarks = [
+        ('parse_ethernet', lambda: parse_ethernet(frame)),
+        ('parse_ip', lambda: parse_ip(outer_eth_payload)),
+        ('parse_tcp', lambda: parse_tcp(inner_ip_payload)),
+        ('parse_nsh', lambda: parse_nsh(eth_nsh_payload)),
+        ('parse_vxlan_gpe', lambda: parse_vxlan_gpe(udp_payload)),
+        ('StructEthHeader', lambda: StructEthHeader(outer_eth_header)),
+        ('StructIpHeader', lambda: StructIpHeader(ip_header)),
+        ('StructUdpHeader', lambda: StructUdpHeader(udp_header)),
+        ('StructVxLanGPEHeader', lambda: StructVxLanGPEHeader(vxlan_header)),
+        ('StructNshBaseHeader', lambda: StructNshBaseHeader(nsh_header[:NSH_BASE_LENGTH])),
+        ('StructNshHeader', lambda: StructNshHeader(nsh_header)),
+        ('StructTcpHeaderWithoutOptions', lambda: StructTcpHeaderWithoutOptions(tcp_header)),
+        ('make_ethernet_header_swap', lambda: make_ethernet_header_swap(outer_eth_header)),
+        ('make_ip_header_swap', lambda: make_ip_header_swap(ip_header)),
+        ('make_nsh_decr_si', lambda: make_nsh_decr_si(nsh_header)),
+        ('make_nsh_mdtype1', lambda: make_nsh_mdtype1(10, 255)),
+        ('make_outer_ethernet_nsh_header', lambda: make_outer_ethernet_nsh_header(inner_eth_header)),
+        ('calculate_checksum', lambda: calculate_checksum(inner_ip_payload)),
+        ('calculate_tcp_checksum', lambda: calculate_tcp_checksum(inner_ip_header,
+            tcp_header, tcp_options, tcp_payload)),
+        ('make_session_key', lambda: make_session_key(GEN_MAC_SERVER, GEN_MAC_CLIENT,
+            0x0800, inner_ip_header[16:20], inner_ip_header[12:16],
+            getattr(tcp_header_nt, 'tcp_dst_port'), getattr(tcp_header_nt, 'tcp_src_port'))),
+    ]
+
+    headers = (outer_eth_header, ip_header, udp_header, vxlan_header, eth_nsh_header, nsh_header)
+    for size in session_sizes:
+        table = SessionTable(max_sessions=size)
+        keys = make_bench_session_keys(size)
+        for key in keys:
+            table.put(key, headers, len(nsh_payload))
+        # A stride over the keys, not to always hit the same cache lines
+        lookups = itertools.cycle(keys[::max(1, size // 1024)] if size > 1024 else keys)
+        benchmarks.append(('session_lookup_' + str(size),
+            lambda table=table, lookups=lookups: table.get_template(next(lookups), 580)))
+    return benchmarks
+
+
+def time_benchmark(function, min_time=BENCH_MIN_TIME, repeat=BENCH_REPEAT):
+    def loop(function, count):
+        start = time.perf_counter_ns()
+        for i in range(count):
+            function()
+        return time.perf_counter_ns() - start
+
+    count = 1
+    while loop(function, count) < min_time * 1e9 / repeat:
+        count *= 2
+    best = min(loop(function, count) for i in range(repeat))
+    overhead = min(loop(lambda: None, count) for i in range(repeat))
+    return max(best - overhead, 0) / count
+
+
+def measure_allocations(function, ops=BENCH_ALLOC_OPS):
+    import tracemalloc
+    gc.collect()
+    # Warm up caches (NSH layouts, struct formats) and refill the free
+    # lists of the interpreter, that a collection empties
+    for i in range(BENCH_WARMUP_OPS):
+        function()
+    blocks_before = sys.getallocatedblocks()
+    for i in range(ops):
+        function()
+    blocks = (sys.getallocatedblocks() - blocks_before) / ops
+
+    tracemalloc.start()
+    try:
+        total = 0
+        for i in range(ops):
+            tracemalloc.reset_peak()
+            (current, peak) = tracemalloc.get_traced_memory()
+            function()
+            total += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return total / ops, blocks
+
+
+def run_benchmarks(benchmarks):
+    results = collections.OrderedDict()
+    for (name, function) in benchmarks:
+        (alloc_bytes, blocks) = measure_allocations(function)
+        results[name] = collections.OrderedDict([
+            ('ns_per_op', round(time_benchmark(function), 1)),
+            ('alloc_bytes_per_op', round(alloc_bytes, 1)),
+            ('blocks_per_op', round(blocks, 2))])
+        pf('%-32s %10.1f ns/op %8.1f B/op %6.2f blocks/op' % (name,
+            results[name]['ns_per_op'], alloc_bytes, blocks), LOG_INFO)
+    return results
+
+
+BENCH_MIN_DELTAS = {'ns_per_op': BENCH_MIN_NS_DELTA, 'alloc_bytes_per_op': BENCH_MIN_BYTES_DELTA,
+    'blocks_per_op': BENCH_MIN_BLOCKS_DELTA}
+
+
+def is_regression(metric, value, reference, tolerance):
+    return value > reference * (1 + tolerance) and value - reference > BENCH_MIN_DELTAS[metric]
+
+
+def confirm_timings(results, baseline, tolerance, functions, rounds=BENCH_CONFIRM_ROUNDS):
+    """Times again the benchmarks slower than their baseline, keeping the
+    best time: another process on the CPU slows down a run, not all of them"""
+    for i in range(rounds):
+        slow = [name for (name, metrics) in results.items()
+            if baseline.get(name, {}).get('ns_per_op') is not None
+            and is_regression('ns_per_op', metrics['ns_per_op'], baseline[name]['ns_per_op'], tolerance)]
+        if not slow:
+            return
+        for name in slow:
+            ns_per_op = round(time_benchmark(functions[name]), 1)
+            results[name]['ns_per_op'] = min(results[name]['ns_per_op'], ns_per_op)
+            pf('%-32s %10.1f ns/op, timed again, best %.1f' % (name, ns_per_op,
+                results[name]['ns_per_op']), LOG_INFO)
+
+
+def compare_benchmarks(results, baseline, tolerance, metrics=None):
+    """Returns the list of regressions as strings, of the given metrics
+    (all if None)"""
+    regressions = []
+    for (name, values) in results.items():
+        if name not in baseline:
+            continue
+        for (metric, value) in values.items():
+            reference = baseline[name].get(metric)
+            if reference is None or (metrics is not None and metric not in metrics):
+                continue
+            if is_regression(metric, value, reference, tolerance):
+                regressions.append('%s %s: %s, baseline %s' % (name, metric, value, reference))
+    return regressions
+
+
+def bench_main(argv):
+    global log_level
+
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the packet helpers',
+                                     prog='proxy.py bench',
+                                     usage='%(prog)s [options]')
+    parser.add_argument('-b', '--baseline', default=BENCH_DEFAULT_BASELINE,
+                        help='Baseline JSON file')
+    parser.add_argument('-t', '--tolerance', type=float, default=BENCH_DEFAULT_TOLERANCE,
+                        help='Allowed regression, as a fraction of the baseline')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='Write the results as the new baseline')
+    parser.add_argument('-s', '--session_sizes', default=','.join(str(x) for x in BENCH_SESSION_SIZES),
+                        help='Comma separated number of sessions for the lookups')
+    parser.add_argument('-k', '--filter', default='',
+                        help='Only run the benchmarks whose name contains this')
+    parser.add_argument('-o', '--output',
+                        help='Also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    log_level = LOG_INFO
+    session_sizes = [int(x) for x in args.session_sizes.split(',') if x]
+    benchmarks = [(name, function) for (name, function) in make_benchmarks(session_sizes)
+        if args.filter in name]
+    results = run_benchmarks(benchmarks)
+    report = collections.OrderedDict([('python', sys.version.split()[0]),
+        ('host', socket.gethostname()), ('results', results)])
+
+    def write_output():
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    write_output()
+    if args.update:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                # Keep the benchmarks not run this time
+                previous = json.load(f).get('results', {})
+            previous.update(results)
+            report['results'] = previous
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        pf('Baseline written to ' + args.baseline, LOG_INFO)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        pf('No baseline ' + args.baseline + ', run with --update to create it', LOG_INFO)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('python') != report['python']:
+        pf('Baseline made with Python ' + str(baseline.get('python')) + ', not '
+            + report['python'], LOG_INFO)
+    metrics = None
+    if baseline.get('host', report['host']) != report['host']:
+        pf('Baseline made on ' + baseline['host'] + ', times not compared: run with --update'
+            ' on this host for a baseline of its own', LOG_INFO)
+        metrics = ['alloc_bytes_per_op', 'blocks_per_op']
+    else:
+        confirm_timings(results, baseline.get('results', {}), args.tolerance, dict(benchmarks))
+        # With the times measured again
+        write_output()
+    regressions = compare_benchmarks(results, baseline.get('results', {}), args.tolerance, metrics)
+    for regression in regressions:
+        pf('REGRESSION ' + regression, LOG_INFO)
+    if regressions:
+        return 1
+    pf('No regression over ' + str(int(args.tolerance * 100)) + '% of the baseline', LOG_INFO)
+    return 0
+
+
+# ************************************************
+#  Soak test
+# ************************************************
+
+"""
+proxy.py soak replays traffic through the three packet functions for a
+long time, on the in-memory path of the offline mode (single thread, no
+interfaces), and watches how the process ages. The traffic is either
+generated, with new flows on every round (the flow numbers keep going up,
+so the tables fill up like with real clients), or a capture replayed in
+a loop (--pcap).
+
+Every --sample_frames input frames, a sample is taken:
+
+  replay     frames in, to the SF and back to the SFF, sizes of the
+             tables (sessions, macs, tcp_offsets, flow_replicas) and a
+             CRC32 of every frame sent since the previous sample
+  measured   RSS, GC collections and tracked objects, pps and the mean
+             time per frame (building the generated frames included)
+
+The "replay" part only depends on the traffic and the code, not on the
+machine (the proxy takes GEN_OUTER_MAC_PROXY as its own MAC): diff it between two versions to see what changed in what the
+proxy does (not with --session_timeout, which expires by age). The
+"measured" part is checked for trends after --warmup samples, with a
+least squares fit (the median of the slopes between two samples for the
+time per frame, which other processes make noisy): RSS growing faster
+than --max_rss_growth MB per hour, the time per frame or a table growing
+by more than --max_latency_growth / --max_table_growth (fractions of
+their mean) over the run fail the soak test, exit code 1. New generated flows fill the
+session table until --max_sessions (small by default), from there on
+the least recently used sessions are evicted and the tables stay level:
+a larger --max_sessions needs a longer --duration, or --session_timeout.
+"""
+
+SOAK_DEFAULT_SAMPLE_FRAMES = 50000
+SOAK_DEFAULT_WARMUP = 2
+SOAK_DEFAULT_MAX_RSS_GROWTH = 16.0
+SOAK_DEFAULT_MAX_LATENCY_GROWTH = 0.25
+SOAK_DEFAULT_MAX_TABLE_GROWTH = 0.1
+# Generated flows are new on every round and never expire without
+# --session_timeout: the session table only levels off at its size limit,
+# which the default flows reach within the warmup samples
+SOAK_DEFAULT_MAX_SESSIONS = 4096
+# Below this RSS growth over the whole run, short runs included, it is noise
+SOAK_MIN_RSS_DELTA = 4 << 20
+# Generated flows wrap around here, so that the session keys repeat
+SOAK_MAX_FLOW = 1 << 24
+SOAK_TABLES = ['sessions', 'macs', 'tcp_offsets', 'flow_replicas']
+
+
+def get_rss():
+    """Resident memory of the process in bytes, None if unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # Only the peak is available, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def linear_fit(xs, ys):
+    """Slope and mean of ys of the least squares line through (xs, ys)"""
+    count = len(xs)
+    mean_x = sum(xs) / count
+    mean_y = sum(ys) / count
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if not variance:
+        return 0.0, mean_y
+    return sum((x - mean_x) * (y - mean_y) for (x, y) in zip(xs, ys)) / variance, mean_y
+
+
+def median_slope(xs, ys):
+    """Slope and mean of ys of the median of the slopes between every two
+    points (Theil-Sen): one slow window on a busy machine does not move it"""
+    slopes = sorted((ys[j] - ys[i]) / (xs[j] - xs[i])
+                    for i in range(len(xs)) for j in range(i + 1, len(xs)) if xs[j] != xs[i])
+    mean_y = sum(ys) / len(ys)
+    if not slopes:
+        return 0.0, mean_y
+    middle = len(slopes) // 2
+    if len(slopes) % 2:
+        return slopes[middle], mean_y
+    return (slopes[middle - 1] + slopes[middle]) / 2, mean_y
+
+
+def soak_frames(args):
+    """(timestamp, frame) received on the encapsulated interface, forever"""
+    if args.pcap is not None:
+        while True:
+            reader = PcapReader(args.pcap)
+            try:
+                empty = True
+                for item in reader:
+                    empty = False
+                    yield item
+            finally:
+                reader.close()
+            if empty:
+                return
+    spi_si_list = parse_spi_si_list(args.spi_si)
+    sizes = [int(x) for x in args.sizes.split(',')]
+    phases = args.phases.split(',')
+    first_flow = 0
+    while True:
+        for frame in generate_traffic(args.flows, spi_si_list, sizes, args.data_packets,
+                phases, args.md_type, first_flow):
+            yield 0, frame
+        first_flow = (first_flow + args.flows) % SOAK_MAX_FLOW
+
+
+def soak_replay_sample(frames_in, frames_to_sf, frames_out, frames_dropped, digest):
+    return collections.OrderedDict([('frames_in', frames_in),
+        ('frames_to_sf', frames_to_sf), ('frames_out', frames_out),
+        ('frames_dropped', frames_dropped),
+        ('sessions', len(sessions)), ('macs', len(mac_database)),
+        ('tcp_offsets', len(tcp_offsets)), ('flow_replicas', len(flow_replicas)),
+        ('digest', '%08x' % digest)])
+
+
+def soak_measured_sample(elapsed, frames, seconds):
+    return collections.OrderedDict([('elapsed', round(elapsed, 3)), ('rss', get_rss()),
+        ('gc_collections', [generation['collections'] for generation in gc.get_stats()]),
+        ('gc_objects', len(gc.get_objects())),
+        ('pps', int(frames / seconds) if seconds > 0 else 0),
+        ('ns_per_frame', round(seconds * 1e9 / frames, 1) if frames else 0)])
+
+
+def check_soak_trends(replay, measured, args):
+    """Returns the list of trends over the limits as strings"""
+    replay = replay[args.warmup:]
+    measured = measured[args.warmup:]
+    if len(measured) < 2:
+        return []
+    failures = []
+    elapsed = [sample['elapsed'] for sample in measured]
+    if None not in [sample['rss'] for sample in measured]:
+        (slope, mean) = linear_fit(elapsed, [sample['rss'] for sample in measured])
+        growth = slope * 3600 / (1 << 20)
+        if growth > args.max_rss_growth and slope * (elapsed[-1] - elapsed[0]) > SOAK_MIN_RSS_DELTA:
+            failures.append('rss: %.1f MB/hour, limit %.1f' % (growth, args.max_rss_growth))
+
+    def relative_growth(xs, ys, fit=linear_fit):
+        (slope, mean) = fit(xs, ys)
+        return slope * (xs[-1] - xs[0]) / mean if mean else 0.0
+
+    growth = relative_growth(elapsed, [sample['ns_per_frame'] for sample in measured], median_slope)
+    if growth > args.max_latency_growth:
+        failures.append('ns_per_frame: +%d%%, limit %d%%' % (growth * 100, args.max_latency_growth * 100))
+    frames_in = [sample['frames_in'] for sample in replay]
+    for table in SOAK_TABLES:
+        growth = relative_growth(frames_in, [sample[table] for sample in replay])
+        if growth > args.max_table_growth:
+            failures.append('%s: +%d%%, limit %d%%' % (table, growth * 100, args.max_table_growth * 100))
+    return failures
+
+
+def run_soak(args):
+    """Returns the replay and measured samples, and why the run stopped
+    early (None if it did not)"""
+    sent = setup_offline_sockets()
+    malformed_start = malformed_frames
+    error = None
+    replay = []
+    measured = []
+    frames_in = 0
+    frames_to_sf = 0
+    frames_out = 0
+    digest = 0
+    start = time.perf_counter()
+    window_start = start
+    window_frames = 0
+
+    def count(frames):
+        # The pipeline takes the next frame once all that the previous one
+        # caused has been sent, the samples fall between two frames
+        nonlocal frames_in, window_frames
+        for item in frames:
+            if args.frames and frames_in >= args.frames:
+                return
+            if frames_in and frames_in % args.sample_frames == 0:
+                sample()
+                if args.duration and time.perf_counter() - start >= args.duration:
+                    return
+            frames_in += 1
+            window_frames += 1
+            yield item
+
+    def sample():
+        nonlocal digest, window_start, window_frames
+        if session_timeout:
+            expire_entries()
+        now = time.perf_counter()
+        replay.append(soak_replay_sample(frames_in, frames_to_sf, frames_out,
+            malformed_frames - malformed_start, digest))
+        measured.append(soak_measured_sample(now - start, window_frames, now - window_start))
+        print(json.dumps(replay[-1]) + ' ' + json.dumps(measured[-1]))
+        sys.stdout.flush()
+        digest = 0
+        window_frames = 0
+        window_start = time.perf_counter()
+
+    try:
+        for (timestamp, interface, frame) in offline_pipeline(count(soak_frames(args)), sent):
+            if interface == 'encap':
+                frames_out += 1
+            else:
+                frames_to_sf += 1
+            digest = zlib.crc32(frame, digest)
+    except SystemExit as e:
+        # A packet function gave up: report it with what was sampled
+        error = 'exit(' + str(e.code) + ') at frame ' + str(frames_in)
+    if window_frames:
+        sample()
+    return replay, measured, error
+
+
+def soak_main(argv):
+    global log_level
+    global sessions
+    global track_tcp_offsets
+    global session_timeout
+
+    parser = argparse.ArgumentParser(description='Soak test of the packet functions'
+                                                 ' on the in-memory path',
+                                     prog='proxy.py soak',
+                                     usage='%(prog)s [options]')
+    parser.add_argument('-d', '--duration', type=float, default=60,
+                        help='Seconds to run, 0 for no limit (see --frames)')
+    parser.add_argument('--frames', type=int, default=0,
+                        help='Input frames to replay, 0 for no limit')
+    parser.add_argument('--sample_frames', type=int, default=SOAK_DEFAULT_SAMPLE_FRAMES,
+                        help='Input frames between samples')
+    parser.add_argument('--warmup', type=int, default=SOAK_DEFAULT_WARMUP,
+                        help='First samples left out of the trends')
+    parser.add_argument('--pcap',
+                        help='Capture to replay in a loop instead of generated traffic')
+    parser.add_argument('-f', '--flows', type=int, default=1000,
+                        help='New TCP flows on each round of generated traffic')
+    parser.add_argument('-n', '--data_packets', type=int, default=10,
+                        help='Number of data packets per flow')
+    parser.add_argument('-s', '--sizes', default='64,512,1400',
+                        help='Comma separated TCP payload sizes, used in turns')
+    parser.add_argument('-p', '--spi_si', default='10:255',
+                        help='Comma separated SPI:SI values, used in turns by the flows')
+    parser.add_argument('--phases', default='handshake,data,fin',
+                        help='Comma separated phases of each flow: handshake, data, fin')
+    parser.add_argument('--md_type', type=int, choices=[NSH_MD_TYPE_1, NSH_MD_TYPE_2],
+                        default=NSH_MD_TYPE_1, help='NSH MD-type, 2 adds two context TLVs')
+    parser.add_argument('-t', '--track_tcp_offsets', action='store_true',
+                        help='Fix TCP seq/ack numbers when the SF adds or removes bytes')
+    parser.add_argument('--session_timeout', type=float, default=0,
+                        help='Seconds without traffic before removing a session, checked at each sample')
+    parser.add_argument('--max_sessions', type=int, default=SOAK_DEFAULT_MAX_SESSIONS,
+                        help='Size limit of the session table, reached early on so that the tables level off')
+    parser.add_argument('--max_rss_growth', type=float, default=SOAK_DEFAULT_MAX_RSS_GROWTH,
+                        help='Allowed RSS growth in MB per hour')
+    parser.add_argument('--max_latency_growth', type=float, default=SOAK_DEFAULT_MAX_LATENCY_GROWTH,
+                        help='Allowed growth of the time per frame, as a fraction')
+    parser.add_argument('--max_table_growth', type=float, default=SOAK_DEFAULT_MAX_TABLE_GROWTH,
+                        help='Allowed growth of each table, as a fraction')
+    parser.add_argument('-o', '--output',
+                        help='JSON file for the samples and the result')
+    args = parser.parse_args(argv)
+    if args.sample_frames < 1:
+        parser.error('--sample_frames must be at least 1')
+    if not args.duration and not args.frames:
+        parser.error('--duration or --frames is needed')
+
+    log_level = LOG_NONE
+    track_tcp_offsets = args.track_tcp_offsets
+    session_timeout = args.session_timeout
+    sessions = SessionTable(max_sessions=args.max_sessions, on_evict=forget_sessions)
+    # NSH Ethernet source of the frames to the SFF, the same on every machine
+    interface_macs[None] = GEN_OUTER_MAC_PROXY
+
+    (replay, measured, error) = run_soak(args)
+    log_level = LOG_INFO
+    failures = check_soak_trends(replay, measured, args)
+
+    if args.output is not None:
+        report = collections.OrderedDict([('python', sys.version.split()[0]),
+            ('replay', replay), ('measured', measured), ('failures', failures), ('error', error)])
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    if error is not None:
+        pf('STOPPED ' + error, LOG_INFO)
+    for failure in failures:
+        pf('TREND ' + failure, LOG_INFO)
+    if failures or error is not None:
+        return 1
+    pf('No trend over the limits in ' + str(len(replay)) + ' samples', LOG_INFO)
+    return 0
+
 
 if __name__ == "__main__":
 
+    if len(sys.argv) > 1 and sys.argv[1] == 'generate':
+        sys.exit(generator_main(sys.argv[2:]))
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        sys.exit(bench_main(sys.argv[2:]))
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'soak':
+        sys.exit(soak_main(sys.argv[2:]))
 
     parser = argparse.ArgumentParser(description='Python3 script to emulate an SFC proxy,'
                                                  ' removing VxLAN and NSH headers',
                                      prog='proxy.py',
                                      usage='%(prog)s [options]',
+                                     epilog='Use "%(prog)s generate -h" for the traffic generator,'
+                                            ' "%(prog)s bench -h" for the microbenchmarks,'
+                                            ' "%(prog)s soak -h" for the soak test',
                                      add_help=True)
 
     parser.add_argument('-e', '--encap_if',
@@ -976,30 +4637,91 @@ if __name__ == "__main__":
                         help='Specify the interface accepting VxLAN/NSH traffic unencapsulated')
     parser.add_argument('-uout', '--unencap_out_if',
                         help='Specify the interface where VxLAN/NSH traffic is sent unencapsulated')
+    parser.add_argument('-t', '--track_tcp_offsets', action='store_true',
+                        help='Fix TCP seq/ack numbers when the SF adds or removes bytes')
+    parser.add_argument('--session_timeout', type=float, default=0,
+                        help='Seconds without traffic before removing a session, 0 never removes them')
+    parser.add_argument('--max_sessions', type=int, default=SLAB_DEFAULT_MAX_RECORDS,
+                        help='Size limit of the session table, least recently used sessions are dropped')
+    parser.add_argument('-r', '--replica', action='append', default=[],
+                        help='SF replica, repeat for each one: name=sf1,in=IF,out=IF[,weight=N]'
+                             ' or name=sf2,mac=MAC[,weight=N]. Without in/out/mac it uses'
+                             ' the default interfaces')
+    parser.add_argument('-c', '--config',
+                        help='JSON file with the replica pools, reloaded on SIGHUP')
+    parser.add_argument('-s', '--control_socket',
+                        help='Path of the Unix socket for inspection and control')
+    parser.add_argument('-b', '--batch_size', type=int, default=1,
+                        help='Frames taken from a socket on each wake up')
+    parser.add_argument('-l', '--log_level', type=int, default=LOG_DEBUG,
+                        help='0 none, 1 info, 2 debug (default)')
+    parser.add_argument('--sf_latency', action='store_true',
+                        help='Measure the time the SF holds each segment, per SPI and replica')
+    parser.add_argument('--low_latency', '--low-latency', action='store_true',
+                        help='Busy poll, pin the loops to --cpus and freeze the GC after warm up')
+    parser.add_argument('--verify_checksums', action='store_true',
+                        help='Drop encapsulated frames whose inner packet has a wrong checksum')
+    parser.add_argument('--offline', nargs=2, metavar=('IN_PCAP', 'OUT_PCAP'),
+                        help='Run over a capture of the encapsulated interface instead of interfaces')
+    parser.add_argument('--offline_sf', metavar='PCAP',
+                        help='With --offline, also write the frames sent to the SF')
+    parser.add_argument('--cpus', type=parse_cpu_list, default=[],
+                        help='Cores for the loop threads with --low_latency, e.g. 2,3,6-8')
 
     args = parser.parse_args()
 
-    if (args.encap_if is None) or (args.unencap_in_if is None) or (args.unencap_out_if is None):
+    if args.offline is None and ((args.encap_if is None) or (args.unencap_in_if is None)
+            or (args.unencap_out_if is None)):
         parser.print_help()
         sys.exit(-1)
 
-    pf("args.encap_if(" + str(args.encap_if) + ")")
-    pf("args.unencap_in_if(" + str(args.unencap_in_if) + ")")
-    pf("args.unencap_out_if(" + str(args.unencap_out_if) + ")")
+    if args.offline is not None and args.config is not None:
+        # The configuration can be reloaded, which opens interfaces
+        parser.error('--config cannot be used with --offline, use --replica')
+
+    if args.offline is None:
+        pf("args.encap_if(" + str(args.encap_if) + ")", LOG_INFO)
+        pf("args.unencap_in_if(" + str(args.unencap_in_if) + ")", LOG_INFO)
+        pf("args.unencap_out_if(" + str(args.unencap_out_if) + ")", LOG_INFO)
 
     encap_if = args.encap_if
+    # NSH Ethernet headers built here come from the encapsulated side
+    local_mac_if = encap_if
     unencap_in_if = args.unencap_in_if
     unencap_out_if = args.unencap_out_if
+    track_tcp_offsets = args.track_tcp_offsets
+    session_timeout = args.session_timeout
+    sessions = SessionTable(max_sessions=args.max_sessions, on_evict=forget_sessions)
+    config_file = args.config
+    batch_size = args.batch_size
+    log_level = args.log_level
+    measure_sf_latency = args.sf_latency
+    low_latency = args.low_latency
+    low_latency_cpus = args.cpus
+    verify_checksums = args.verify_checksums
+    try:
+        replica_ring = ReplicaRing([parse_replica_spec(spec) for spec in args.replica])
+    except ValueError as e:
+        parser.error(str(e))
+    for replica in replica_ring.replicas.values():
+        pf(str(replica), LOG_INFO)
+
+    if args.offline is not None:
+        sys.exit(offline_main(args.offline[0], args.offline[1], args.offline_sf))
 
     setup_sockets()
 
-    unencapsulating_thread = threading.Thread(target=unencapsulating_loop, name="unencapsulating thread")
-    encapsulating_replies_thread = threading.Thread(target=encapsulating_replies_loop, name="encapsulating replies thread")
-    encapsulating_requests_thread = threading.Thread(target=encapsulating_requests_loop, name="encapsulating requests thread")
+    start_loops()
 
-    unencapsulating_thread.start()
-    encapsulating_replies_thread.start()
-    encapsulating_requests_thread.start()
+    if config_file is not None:
+        reload_config()
+    signal.signal(signal.SIGHUP, sighup_handler)
+    if args.control_socket is not None:
+        start_control_socket(args.control_socket)
 
-    pf("v0.99 - Threads active - Listening...")
+    pf("v0.99 - Threads active - Listening...", LOG_INFO)
+
+    # Signal handlers run in the main thread
+    while True:
+        signal.pause()
 
@@ -0,0 +1,635 @@
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import proxy as P
+
+
+IP_CLIENT = socket.inet_aton('10.1.0.1')
+PORT_CLIENT = 5000
+
+
+def make_tcp_frame(client_to_server, seq, ack, flags, payload=b'', options=b'',
+        client_port=PORT_CLIENT):
+    """Inner frame between the generator client and server, with options"""
+    if client_to_server:
+        (eth_src, eth_dst, ip_src, ip_dst) = (P.GEN_MAC_CLIENT, P.GEN_MAC_SERVER,
+            IP_CLIENT, P.GEN_IP_SERVER)
+        (src_port, dst_port) = (client_port, P.GEN_SERVER_PORT)
+    else:
+        (eth_src, eth_dst, ip_src, ip_dst) = (P.GEN_MAC_SERVER, P.GEN_MAC_CLIENT,
+            P.GEN_IP_SERVER, IP_CLIENT)
+        (src_port, dst_port) = (P.GEN_SERVER_PORT, client_port)
+    tcp_header = P.StructTcpHeaderWithoutOptions(bytes(20))._replace(
+        tcp_src_port=src_port, tcp_dst_port=dst_port, tcp_seq_number=seq, tcp_ack=ack,
+        tcp_byte_data_offset=(5 + len(options) // 4) << 4, tcp_flags=flags,
+        tcp_win_size=65535).pack()
+    ip_header = P.StructIpHeader(bytes(20))._replace(ip_ver_ihl_type=0x4500,
+        ip_time2live=64, ip_protocol=6, ip_src=ip_src, ip_dst=ip_dst).pack()
+    ip_header = P.make_ip_header(ip_header, 20 + len(tcp_header) + len(options) + len(payload))
+    eth_header = P.StructEthHeader(bytes(14))._replace(eth_dst=eth_dst, eth_src=eth_src,
+        eth_type=0x0800).pack()
+    return eth_header + P.make_ip_package(ip_header, tcp_header, options, payload)
+
+
+def parse_tcp_frame(frame):
+    """(header named tuple, options, payload, checksum is right)"""
+    (ip_header, ip_payload) = P.parse_ip(frame[14:])
+    (header_without_options, options, payload) = P.parse_tcp(ip_payload)
+    header = P.StructTcpHeaderWithoutOptions(header_without_options)
+    checksum = P.calculate_tcp_checksum(ip_header, header_without_options, options, payload)
+    return header, options, payload, header.tcp_checksum == checksum
+
+
+def make_session_headers():
+    frame = P.make_vxlan_gpe_nsh_frame(10, 255, 49152, make_tcp_frame(True, 1, 0, P.TCP_FLAG_SYN))
+    (outer_eth_header, outer_eth_payload) = P.parse_ethernet(frame)
+    (ip_header, ip_payload) = P.parse_ip(outer_eth_payload)
+    (udp_header, udp_payload) = P.parse_udp(ip_payload)
+    (vxlan_header, vxlan_payload) = P.parse_vxlan_gpe(udp_payload)
+    (eth_nsh_header, eth_nsh_payload) = P.parse_ethernet(vxlan_payload)
+    (nsh_header, nsh_payload) = P.parse_nsh(eth_nsh_payload)
+    return (outer_eth_header, ip_header, udp_header, vxlan_header, eth_nsh_header, nsh_header)
+
+
+class ProxyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        P.log_level = P.LOG_NONE
+        P.interface_macs[None] = P.GEN_OUTER_MAC_PROXY
+        P.sessions = P.SessionTable(on_evict=P.forget_sessions)
+        for table in (P.mac_database, P.tcp_offsets, P.flow_replicas, P.latency_windows):
+            table.clear()
+        self.sent = P.setup_offline_sockets()
+
+    def tearDown(self):
+        P.track_tcp_offsets = False
+
+    def through_sf(self, inner_frame, sf=lambda frame: frame):
+        """Sends an inner frame through the proxy and the SF, returns the
+        frame the SF got and the inner frame sent back to the SFF"""
+        P.process_batch([P.make_vxlan_gpe_nsh_frame(10, 255, 49152, inner_frame)], None,
+            P.unencapsulate_packet, None)
+        (interface, to_sf) = self.sent.popleft()
+        from_sf = sf(to_sf)
+        if P.OFFLINE_SF_PEER[interface] == 'unencap_in':
+            P.process_batch([from_sf], None, P.encapsulate_request_packet, None)
+        else:
+            P.process_batch([from_sf], None, P.encapsulate_reply_packet, None)
+        (interface, to_sff) = self.sent.popleft()
+        self.assertEqual(interface, 'encap')
+        self.assertFalse(self.sent)
+        self.check_outer_headers(to_sff)
+        return to_sf, to_sff[len(to_sff) - len(from_sf):]
+
+    def check_outer_headers(self, frame):
+        (ip_header, ip_payload) = P.parse_ip(frame[14:])
+        ip_header_nt = P.StructIpHeader(ip_header)
+        self.assertEqual(ip_header_nt.ip_total_length, len(frame) - 14)
+        self.assertEqual(ip_header_nt.ip_hdr_checksum, P.calculate_ip_checksum(ip_header))
+        udp_header_nt = P.StructUdpHeader(ip_payload[:8])
+        self.assertEqual(udp_header_nt.udp_data_length, len(ip_payload))
+        self.assertEqual(udp_header_nt.udp_checksum, 0)
+
+
+class TestNsh(ProxyTestCase):
+
+    def test_md_type_1(self):
+        header = P.make_nsh_mdtype1(10, 255)
+        self.assertEqual(P.parse_nsh(header + b'payload'), (header, b'payload'))
+        self.assertEqual(P.get_nsh_metadata(header), [0, 0, 0, 0])
+
+    def test_md_type_2(self):
+        header = P.make_nsh_mdtype2(10, 255, P.GEN_NSH_TLVS)
+        self.assertEqual(len(header), 28)
+        self.assertEqual(P.parse_nsh(header + b'payload'), (header, b'payload'))
+        self.assertEqual(P.get_nsh_metadata(header), [(0x0101, 0x01, b'\x00\x00\x00\x2a'),
+            (0x0101, 0x02, b'tenant')])
+
+    def test_md_type_2_kept_through_sf(self):
+        inner_frame = make_tcp_frame(True, 1000, 0, P.TCP_FLAG_SYN)
+        P.process_batch([P.make_vxlan_gpe_nsh_frame(10, 255, 49152, inner_frame, P.NSH_MD_TYPE_2)],
+            None, P.unencapsulate_packet, None)
+        (interface, to_sf) = self.sent.popleft()
+        self.assertEqual(to_sf, inner_frame)
+        P.process_batch([to_sf], None, P.encapsulate_reply_packet, None)
+        (interface, to_sff) = self.sent.popleft()
+        nsh = to_sff[len(to_sff) - len(inner_frame) - 28:len(to_sff) - len(inner_frame)]
+        self.assertEqual(nsh, P.make_nsh_mdtype2(10, 254, P.GEN_NSH_TLVS))
+
+    def test_invalid_length(self):
+        md_type_1 = P.make_nsh_mdtype1(10, 255)
+        for packet in (b'', b'\x00', b'\x00\x06',
+                # Shorter than the base header, MD-type 1 not 24 bytes long
+                b'\x00\x01\x02\x03' + bytes(20), b'\x00\x07\x01\x03' + bytes(24),
+                # Longer than the packet
+                md_type_1[:20], b'\x00\x3f\x02\x03' + bytes(100)):
+            self.assertEqual(P.parse_nsh(packet), (None, packet))
+
+
+class TestTcpOffsets(ProxyTestCase):
+    """An SF adding 5 bytes to the first data segment of the client"""
+
+    def setUp(self):
+        super().setUp()
+        P.track_tcp_offsets = True
+        self.through_sf(make_tcp_frame(True, 1000, 0, P.TCP_FLAG_SYN))
+        self.through_sf(make_tcp_frame(False, 9000, 1001, P.TCP_FLAG_SYN | P.TCP_FLAG_ACK))
+
+        def inject(frame):
+            (header, options, payload, valid) = parse_tcp_frame(frame)
+            return frame[:14] + make_tcp_frame(True, header.tcp_seq_number,
+                header.tcp_ack, header.tcp_flags, b'added' + payload)[14:]
+
+        (to_sf, self.injected) = self.through_sf(make_tcp_frame(True, 1001, 9001,
+            P.TCP_FLAG_PSH | P.TCP_FLAG_ACK, bytes(10)), inject)
+
+    def test_outer_headers_after_injection(self):
+        # through_sf checked the outer lengths and checksum of the frame
+        self.assertEqual(len(parse_tcp_frame(self.injected)[2]), 15)
+
+    def test_seq_moved_after_injection(self):
+        (to_sf, to_sff) = self.through_sf(make_tcp_frame(True, 1011, 9001,
+            P.TCP_FLAG_PSH | P.TCP_FLAG_ACK, bytes(10)))
+        (header, options, payload, valid) = parse_tcp_frame(to_sff)
+        self.assertEqual(header.tcp_seq_number, 1016)
+        self.assertTrue(valid)
+
+    def test_ack_and_sack_moved_back(self):
+        sack = bytes([P.TCP_OPT_NOP, P.TCP_OPT_NOP, P.TCP_OPT_SACK, 10]) + struct.pack('!LL', 1016, 1026)
+        (to_sf, to_sff) = self.through_sf(make_tcp_frame(False, 9001, 1026, P.TCP_FLAG_ACK,
+            options=sack))
+        (header, options, payload, valid) = parse_tcp_frame(to_sf)
+        self.assertEqual(header.tcp_ack, 1021)
+        self.assertEqual(struct.unpack_from('!LL', options, 4), (1011, 1021))
+        self.assertTrue(valid)
+
+    def test_forgotten_after_close(self):
+        self.through_sf(make_tcp_frame(True, 1011, 9001, P.TCP_FLAG_FIN | P.TCP_FLAG_ACK))
+        self.through_sf(make_tcp_frame(False, 9001, 1017, P.TCP_FLAG_FIN | P.TCP_FLAG_ACK))
+        self.assertEqual(len(P.tcp_offsets), 1)
+        (to_sf, to_sff) = self.through_sf(make_tcp_frame(True, 1012, 9002, P.TCP_FLAG_ACK))
+        # The last ACK still gets its seq fixed
+        self.assertEqual(parse_tcp_frame(to_sff)[0].tcp_seq_number, 1017)
+        self.assertEqual(len(P.tcp_offsets), 0)
+
+    def test_forgotten_with_session(self):
+        P.sessions.evict_matching(lambda key, headers: True)
+        self.assertEqual(len(P.tcp_offsets), 0)
+
+
+class TestOfflinePipeline(ProxyTestCase):
+
+    def test_malformed_frames_dropped(self):
+        icmp = bytearray(make_tcp_frame(True, 1, 0, 0))
+        icmp[14 + 9] = 1
+        icmp = bytes(icmp[:14 + 20 + 8])
+        frames = [P.make_vxlan_gpe_nsh_frame(10, 255, 49152, make_tcp_frame(True, 1000, 0, P.TCP_FLAG_SYN)),
+            P.make_vxlan_gpe_nsh_frame(10, 255, 49152, icmp),
+            P.make_vxlan_gpe_nsh_frame(10, 255, 49152, make_tcp_frame(True, 1001, 0, P.TCP_FLAG_ACK))[:40],
+            P.make_vxlan_gpe_nsh_frame(10, 255, 49152, make_tcp_frame(True, 1001, 0, P.TCP_FLAG_ACK))]
+        with tempfile.TemporaryDirectory() as directory:
+            in_file = os.path.join(directory, 'in.pcap')
+            out_file = os.path.join(directory, 'out.pcap')
+            writer = P.PcapWriter(in_file)
+            for frame in frames:
+                writer.write(frame, 1.0)
+            writer.close()
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(P.offline_main(in_file, out_file), 0)
+            reader = P.PcapReader(out_file)
+            frames_out = [frame for (timestamp, frame) in reader]
+            reader.close()
+        self.assertEqual(len(frames_out), 2)
+        self.assertIn('frames_in(4)', output.getvalue())
+        self.assertIn('frames_dropped(2)', output.getvalue())
+
+
+class TestControl(ProxyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # 30 sessions on SPI 10, 20 on SPI 20
+        for port in range(1024, 1074):
+            P.process_batch([P.make_vxlan_gpe_nsh_frame(10 if port < 1054 else 20, 255, 49152,
+                make_tcp_frame(True, 1000, 0, P.TCP_FLAG_SYN, client_port=port))], None,
+                P.unencapsulate_packet, None)
+        self.sent.clear()
+
+    def scan(self, *params):
+        found = []
+        cursor = None
+        while True:
+            words = ['sessions', 'limit=7'] + list(params)
+            if cursor is not None:
+                words.append('cursor=' + cursor)
+            response = P.control_command(words)
+            self.assertLessEqual(len(response['sessions']), 7)
+            found.extend(response['sessions'])
+            cursor = response['cursor']
+            if cursor is None:
+                return found
+
+    def test_pages(self):
+        found = self.scan()
+        self.assertEqual(sorted(s['tcp_src_port'] for s in found), list(range(1024, 1074)))
+
+    def test_filters(self):
+        self.assertEqual(len(self.scan('spi=20')), 20)
+        self.assertTrue(all(s['nsh_spi'] == 20 for s in self.scan('spi=20')))
+        self.assertEqual([s['tcp_src_port'] for s in self.scan('port=1030')], [1030])
+        self.assertEqual(len(self.scan('ip=10.1.0.1', 'spi=10')), 30)
+        self.assertEqual(self.scan('ip=10.9.9.9'), [])
+
+    def test_flush(self):
+        self.assertEqual(P.control_command(['flush', 'sessions', 'spi=20']), {'flushed': 20})
+        self.assertEqual(len(P.sessions), 30)
+        self.assertEqual(P.control_command(['flush', 'sessions']), {'flushed': 30})
+        self.assertEqual(len(P.sessions), 0)
+
+
+class TestReload(unittest.TestCase):
+
+    def setUp(self):
+        P.log_level = P.LOG_NONE
+        self.saved = (P.replica_ring, P.spi_replica_rings, P.config_file, P.qos, dict(P.replica_macs))
+        self.directory = tempfile.TemporaryDirectory()
+        P.config_file = os.path.join(self.directory.name, 'config.json')
+        # A replica with interfaces of its own, already running
+        self.replica = P.SfReplica('sf1', in_if='sf1_in', out_if='sf1_out')
+        (self.replica.sckt_out, self.replica.sckt_in) = P.make_memory_socket_pair('sf1_out', 'sf1_in')
+        P.replica_ring = P.ReplicaRing([self.replica])
+        P.spi_replica_rings = {}
+
+    def tearDown(self):
+        (P.replica_ring, P.spi_replica_rings, P.config_file, P.qos, replica_macs) = self.saved
+        P.replica_macs.clear()
+        P.replica_macs.update(replica_macs)
+        self.directory.cleanup()
+
+    def write_config(self, config):
+        with open(P.config_file, 'w') as f:
+            json.dump(config, f)
+
+    def test_renamed_replica_keeps_its_sockets(self):
+        # New sockets would be AF_PACKET ones bound to interfaces that do not exist
+        self.write_config({'replicas': ['name=sf2,in=sf1_in,out=sf1_out,weight=2']})
+        P.reload_config()
+        self.assertEqual(list(P.replica_ring.replicas), ['sf2'])
+        replica = P.replica_ring.replicas['sf2']
+        self.assertIs(replica, self.replica)
+        self.assertEqual(replica.weight, 2)
+        self.assertFalse(replica.stopped)
+
+    def test_removed_replica_stopped(self):
+        self.write_config({'replicas': ['name=sf3,mac=02:00:00:00:00:03'],
+            'spi_replicas': {'20': ['name=sf3,mac=02:00:00:00:00:03']}})
+        P.reload_config()
+        self.assertTrue(self.replica.stopped)
+        self.assertFalse(self.replica.healthy)
+        self.assertIs(P.spi_replica_rings[20].replicas['sf3'], P.replica_ring.replicas['sf3'])
+        self.assertIs(P.replica_macs[b'\x02\x00\x00\x00\x00\x03'], P.replica_ring.replicas['sf3'])
+
+    def test_invalid_config_kept(self):
+        ring = P.replica_ring
+        for config in ({'replicas': [1]}, {'replicas': 'name=sf2,mac=02:00:00:00:00:02'},
+                {'replicas': ['name=sf2,in=sf1_in,out=sf1_out', 'name=sf3,in=sf1_in,out=sf1_out']},
+                {'replicas': ['name=sf2,in=sf1_in,out=sf2_out', 'name=sf3,in=sf3_in,out=sf2_out']}):
+            self.write_config(config)
+            self.assertIn('error', P.control_command(['reload']))
+            self.assertIs(P.replica_ring, ring)
+            self.assertFalse(self.replica.stopped)
+        with open(P.config_file, 'w') as f:
+            f.write('{')
+        self.assertIsNotNone(P.reload_config_logged('test'))
+        self.assertIs(P.replica_ring, ring)
+
+
+class TestSessionTable(unittest.TestCase):
+
+    def test_full_table_evicts(self):
+        evicted = []
+        table = P.SessionTable(max_sessions=8, num_shards=4, on_evict=evicted.extend)
+        headers = make_session_headers()
+        keys = [P.make_session_key(P.GEN_MAC_SERVER, P.GEN_MAC_CLIENT, 0x0800, P.GEN_IP_SERVER,
+            IP_CLIENT, P.GEN_SERVER_PORT, port) for port in range(1024, 1074)]
+        for key in keys:
+            self.assertTrue(table.put(key, headers, 100))
+            self.assertEqual(table.get_template(key), P.make_session_template(*headers))
+            self.assertLessEqual(len(table), 8)
+        self.assertEqual(table.slab.used(), len(table))
+        self.assertEqual(len(evicted), len(keys) - len(table))
+        self.assertFalse(set(evicted) & set(table.keys()))
+        self.assertEqual(table.dropped, 0)
+
+    def test_full_table_threads(self):
+        table = P.SessionTable(max_sessions=16, num_shards=4)
+        headers = make_session_headers()
+
+        def put_flows(first_port):
+            for port in range(first_port, first_port + 500):
+                table.put(P.make_session_key(P.GEN_MAC_SERVER, P.GEN_MAC_CLIENT, 0x0800,
+                    P.GEN_IP_SERVER, IP_CLIENT, P.GEN_SERVER_PORT, port), headers, 100)
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=put_flows, args=(1024 + i * 500, )) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        self.assertLessEqual(len(table), 16)
+        self.assertEqual(table.slab.used(), len(table))
+        self.assertIn(table.next_shard_to_evict, range(4))
+
+
+class TestUnmatchedFrames(ProxyTestCase):
+
+    def test_dropped(self):
+        unmatched = P.unmatched_frames
+        P.process_batch([make_tcp_frame(True, 1, 0, P.TCP_FLAG_ACK)], None,
+            P.encapsulate_request_packet, None)
+        self.assertEqual(P.unmatched_frames, unmatched + 1)
+        self.assertFalse(self.sent)
+
+
+class TestReplicaRing(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = P.ReplicaRing(P.SfReplica('sf' + str(i)) for i in range(3))
+        self.keys = [P.make_tcp_connection_key(struct.pack('!BBH', 10, 1, i), 1024 + i,
+            P.GEN_IP_SERVER, P.GEN_SERVER_PORT) for i in range(2000)]
+
+    def owners(self):
+        return dict((key, self.ring.lookup(P.stable_hash(key)).name) for key in self.keys)
+
+    def test_replica_joins(self):
+        before = self.owners()
+        self.ring.add(P.SfReplica('sf3'))
+        after = self.owners()
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(all(after[key] == 'sf3' for key in moved))
+        self.assertTrue(0.15 < len(moved) / len(self.keys) < 0.35)
+
+    def test_replica_leaves(self):
+        before = self.owners()
+        self.ring.remove('sf1')
+        after = self.owners()
+        for key in self.keys:
+            if before[key] == 'sf1':
+                self.assertNotEqual(after[key], 'sf1')
+            else:
+                self.assertEqual(after[key], before[key])
+
+    def test_unhealthy_skipped(self):
+        before = self.owners()
+        self.ring.replicas['sf2'].healthy = False
+        after = self.owners()
+        for key in self.keys:
+            self.assertNotEqual(after[key], 'sf2')
+            if before[key] != 'sf2':
+                self.assertEqual(after[key], before[key])
+
+    def test_replica_specs(self):
+        replica = P.parse_replica_spec('name=sf1,in=veth1,out=veth2,weight=2')
+        self.assertEqual((replica.name, replica.in_if, replica.out_if, replica.mac, replica.weight),
+            ('sf1', 'veth1', 'veth2', None, 2))
+        replica = P.parse_replica_spec('name=sf2,mac=02:00:00:00:00:01')
+        self.assertEqual((replica.in_if, replica.mac), (None, b'\x02\x00\x00\x00\x00\x01'))
+        for spec in ['name=sf1,in=veth1', 'name=sf1,out=veth2', 'in=veth1,out=veth2', 'sf1']:
+            with self.assertRaises(ValueError):
+                P.parse_replica_spec(spec)
+        with self.assertRaisesRegex(ValueError, 'in and out'):
+            P.parse_replica_spec('name=sf1,in=veth1,weight=2')
+
+
+def make_latency_segment(frame):
+    (ip_header, ip_payload) = P.parse_ip(frame[14:])
+    return P.latency_segment(ip_header, P.parse_tcp(ip_payload)[0])
+
+
+class TestSfLatency(ProxyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name in ('spi_latency', 'replica_latency'):
+            patcher = mock.patch.object(P, name, {})
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.key = b'session'
+
+    def test_through_sf(self):
+        frame = make_tcp_frame(True, 1000, 2000, P.TCP_FLAG_PSH | P.TCP_FLAG_ACK, bytes(100))
+        forwarding = P.LatencyHistogram()
+        with mock.patch.object(P, 'measure_sf_latency', True):
+            P.process_batch([P.make_vxlan_gpe_nsh_frame(10, 255, 49152, frame)], [1000000],
+                P.unencapsulate_packet, forwarding)
+            (interface, to_sf) = self.sent.popleft()
+            P.process_batch([to_sf], [1250000], P.encapsulate_request_packet, forwarding)
+        self.assertEqual(forwarding.count, 2)
+        self.assertEqual(P.spi_latency[10].to_dict()['min_ns'], 250000)
+        self.assertEqual(P.spi_latency[10].count, 1)
+
+    def test_segments_matched(self):
+        ack = make_tcp_frame(True, 1000, 2000, P.TCP_FLAG_ACK)
+        data = make_tcp_frame(True, 1000, 2000, P.TCP_FLAG_PSH | P.TCP_FLAG_ACK, bytes(100))
+        fin = make_tcp_frame(True, 1000, 2000, P.TCP_FLAG_FIN | P.TCP_FLAG_ACK)
+        # Same seq and ack: told apart by the payload length and the flags
+        self.assertEqual(len(set(make_latency_segment(f) for f in (ack, data, fin))), 3)
+        P.latency_to_sf(self.key, make_latency_segment(ack), 100, 10, 'sf1')
+        P.latency_to_sf(self.key, make_latency_segment(data), 200, 10, 'sf1')
+        P.latency_from_sf(self.key, make_latency_segment(fin), 1000)
+        self.assertNotIn(10, P.spi_latency)
+        P.latency_from_sf(self.key, make_latency_segment(data), 1000)
+        P.latency_from_sf(self.key, make_latency_segment(ack), 1000)
+        self.assertEqual((P.spi_latency[10].min, P.spi_latency[10].max), (800, 900))
+        self.assertEqual(P.replica_latency['sf1'].count, 2)
+        # Each segment is matched once
+        P.latency_from_sf(self.key, make_latency_segment(ack), 2000)
+        self.assertEqual(P.spi_latency[10].count, 2)
+
+    def test_negative_dropped(self):
+        segment = make_latency_segment(make_tcp_frame(True, 1, 0, P.TCP_FLAG_SYN))
+        P.latency_to_sf(self.key, segment, 5000, 10, None)
+        P.latency_from_sf(self.key, segment, 4000)
+        self.assertNotIn(10, P.spi_latency)
+        self.assertEqual(P.replica_latency, {})
+
+    def test_window_bounded(self):
+        for seq in range(P.LATENCY_WINDOW + 1):
+            P.latency_to_sf(self.key, (seq, 0, P.TCP_FLAG_ACK, 0), seq, 10, None)
+        self.assertEqual(len(P.latency_windows.get(self.key).sent), P.LATENCY_WINDOW)
+        P.latency_from_sf(self.key, (0, 0, P.TCP_FLAG_ACK, 0), 1000)
+        self.assertNotIn(10, P.spi_latency)
+        P.latency_from_sf(self.key, (1, 0, P.TCP_FLAG_ACK, 0), 1000)
+        self.assertEqual(P.spi_latency[10].count, 1)
+
+
+class TestBatchChecksums(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(1)
+        self.frames = [make_tcp_frame(True, i * 7, i * 3, P.TCP_FLAG_ACK,
+            bytes(rand.getrandbits(8) for j in range(rand.randint(0, 1400)))) for i in range(200)]
+
+    def check(self):
+        self.assertTrue(all(P.verify_checksums_batch(self.frames)))
+        bad = list(self.frames)
+        frame = bytearray(bad[5])
+        frame[-1] ^= 0xff
+        bad[5] = bytes(frame)
+        valid = list(P.verify_checksums_batch(bad))
+        self.assertEqual([i for i in range(len(bad)) if not valid[i]], [5])
+        expected = [(struct.unpack_from('!H', frame, 24)[0],
+            struct.unpack_from('!H', frame, 14 + 20 + 16)[0]) for frame in self.frames]
+        self.assertEqual(P.compute_checksums_batch(self.frames), expected)
+        encapsulated = [P.make_vxlan_gpe_nsh_frame(10, 255, 49152, frame) for frame in self.frames]
+        self.assertTrue(all(P.verify_checksums_batch(encapsulated,
+            [P.get_inner_l3_offset(frame) for frame in encapsulated])))
+
+    def test_numpy(self):
+        if P.load_numpy() is None:
+            self.skipTest('NumPy is not installed')
+        self.check()
+
+    def test_fallback(self):
+        with mock.patch.object(P, 'numpy', None), mock.patch.object(P, 'numpy_loaded', True):
+            self.check()
+
+
+class TestBench(unittest.TestCase):
+
+    def test_noisy_time_timed_again(self):
+        baseline = {'parse_ethernet': {'ns_per_op': 281.7, 'alloc_bytes_per_op': 720.0},
+            'parse_ip': {'ns_per_op': 369.2, 'alloc_bytes_per_op': 706.0}}
+        results = {'parse_ethernet': {'ns_per_op': 412.0, 'alloc_bytes_per_op': 720.0},
+            'parse_ip': {'ns_per_op': 370.0, 'alloc_bytes_per_op': 706.0}}
+        functions = {'parse_ethernet': None, 'parse_ip': None}
+        with mock.patch.object(P, 'time_benchmark', side_effect=[290.0]) as time_benchmark:
+            P.confirm_timings(results, baseline, P.BENCH_DEFAULT_TOLERANCE, functions)
+        time_benchmark.assert_called_once_with(None)
+        self.assertEqual(results['parse_ethernet']['ns_per_op'], 290.0)
+        self.assertEqual(P.compare_benchmarks(results, baseline, P.BENCH_DEFAULT_TOLERANCE), [])
+
+    def test_slow_every_time(self):
+        baseline = {'parse_ethernet': {'ns_per_op': 281.7}}
+        results = {'parse_ethernet': {'ns_per_op': 412.0}}
+        with mock.patch.object(P, 'time_benchmark', side_effect=[450.0, 405.0, 430.0]):
+            P.confirm_timings(results, baseline, P.BENCH_DEFAULT_TOLERANCE, {'parse_ethernet': None})
+        self.assertEqual(len(P.compare_benchmarks(results, baseline, P.BENCH_DEFAULT_TOLERANCE)), 1)
+        self.assertEqual(results['parse_ethernet']['ns_per_op'], 405.0)
+        self.assertEqual(P.compare_benchmarks(results, baseline, P.BENCH_DEFAULT_TOLERANCE,
+            ['alloc_bytes_per_op']), [])
+
+
+class RecordingSocket(object):
+
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame):
+        self.frames.append(bytes(frame))
+        return len(frame)
+
+
+class TestQos(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = P.TokenBucket(100, burst=5)
+        now = bucket.last
+        self.assertEqual([bucket.admit(now) for i in range(7)], [True] * 5 + [False] * 2)
+        # 100 pps: one token every 10 ms, never more than the burst
+        self.assertEqual([bucket.admit(now + 0.015) for i in range(2)], [True, False])
+        self.assertEqual(sum(bucket.admit(now + 10) for i in range(10)), 5)
+        self.assertEqual((bucket.passed, bucket.dropped), (11, 8))
+        # Time going back does not take tokens away nor give any
+        self.assertFalse(bucket.admit(now))
+
+    def test_strict_priority(self):
+        sckt = RecordingSocket()
+        queues = P.EgressQueues(sckt)
+        for (i, priority) in enumerate([3, 1, 0, 2, 1, 3, 0]):
+            self.assertTrue(queues.enqueue(bytes([priority, i]), priority, 2))
+        self.assertFalse(queues.enqueue(b'\x00\x07', 0, 2))
+        queues.drain(P.QosConfig({}))
+        self.assertEqual(sckt.frames, [b'\x00\x02', b'\x00\x06', b'\x01\x01', b'\x01\x04',
+            b'\x02\x03', b'\x03\x00', b'\x03\x05'])
+        self.assertEqual(queues.to_dict()['sent'], [2, 2, 1, 2])
+        self.assertEqual(queues.to_dict()['dropped'], [1, 0, 0, 0])
+
+    def test_drr_weights(self):
+        sckt = RecordingSocket()
+        queues = P.EgressQueues(sckt)
+        config = P.QosConfig({'scheduler': 'drr', 'weights': [3, 1, 1, 1]})
+        for i in range(12):
+            queues.enqueue(bytes([0]) * 1000, 0, 100)
+            queues.enqueue(bytes([3]) * 1000, 3, 100)
+        queues.drain(config)
+        order = [frame[0] for frame in sckt.frames]
+        self.assertEqual(len(order), 24)
+        # Each round adds 3 quanta to the deficit of priority 0, 1 to the
+        # one of priority 3, what is left over carries to the next round
+        self.assertEqual(order[:12], [0] * 4 + [3] + [0] * 5 + [3, 3])
+        self.assertEqual(queues.to_dict()['queued'], [0, 0, 0, 0])
+
+    def test_buckets_by_direction(self):
+        config = P.QosConfig({'spi': {'10': {'pps': 1, 'burst': 1, 'priority': 0}},
+            'sf': {'sf1': {'pps': 1, 'burst': 2}}})
+        sckt = RecordingSocket()
+        with mock.patch.object(P, 'qos', config), mock.patch.object(P, 'egress_queues', {}):
+            P.qos_begin_batch()
+            # To the SF: the tokens of the replica, not of the SPI
+            self.assertEqual([P.qos_enqueue(sckt, b'a', 10, True, 'sf1') for i in range(3)],
+                [True, True, False])
+            self.assertTrue(P.qos_enqueue(sckt, b'b', 10, True))
+            # Back to the SFF: the tokens of the SPI
+            self.assertEqual([P.qos_enqueue(sckt, b'c', 10, False) for i in range(2)], [True, False])
+            self.assertEqual(P.egress_queues[sckt].to_dict()['queued'], [4, 0, 0, 0])
+        self.assertEqual((config.sf_buckets['sf1'].passed, config.spi_buckets[10].passed), (2, 1))
+
+    def test_config_checked(self):
+        for config in [{'scheduler': 'fifo'}, {'weights': [1, 1]}, {'weights': [1, 0, 1, 1]},
+                {'spi': {'10': {'priority': P.QOS_PRIORITIES}}}]:
+            with self.assertRaises(ValueError):
+                P.QosConfig(config)
+
+
+class TestSoakTrends(unittest.TestCase):
+
+    def check(self, ns_per_frame, sessions):
+        args = mock.Mock(warmup=0, max_rss_growth=P.SOAK_DEFAULT_MAX_RSS_GROWTH,
+            max_latency_growth=P.SOAK_DEFAULT_MAX_LATENCY_GROWTH,
+            max_table_growth=P.SOAK_DEFAULT_MAX_TABLE_GROWTH)
+        replay = [{'frames_in': (i + 1) * 1000, 'sessions': sessions[i], 'macs': 2,
+            'tcp_offsets': 0, 'flow_replicas': 0} for i in range(len(sessions))]
+        measured = [{'elapsed': (i + 1) * 10.0, 'rss': 1 << 25, 'ns_per_frame': ns_per_frame[i]}
+            for i in range(len(ns_per_frame))]
+        return [failure.split(':')[0] for failure in P.check_soak_trends(replay, measured, args)]
+
+    def test_level(self):
+        self.assertEqual(self.check([180, 178, 175, 218, 213, 184, 221], [4096] * 7), [])
+        # One slow window at the end, another process on the CPU
+        self.assertEqual(self.check([160, 165, 162, 170, 230], [4096] * 5), [])
+
+    def test_growth(self):
+        self.assertEqual(self.check([100, 110, 120, 130, 140], [1000, 2000, 3000, 4000, 5000]),
+            ['ns_per_frame', 'sessions'])
+
+
+if __name__ == '__main__':
+    unittest.main()